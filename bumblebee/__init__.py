@@ -1,2 +1,22 @@
-from .actions import Transformer
-from .core import Convertor
+# imported when first used, so importing bumblebee (e.g. for a script's
+# --help) doesn't import pandas.
+_LAZY = {
+    'Transformer': 'actions',
+    'Convertor': 'core',
+    'Profiler': 'profiling',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        msg = 'module {!r} has no attribute {!r}'.format(__name__, name)
+        raise AttributeError(msg)
+    import importlib
+    module = importlib.import_module('.' + _LAZY[name], __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY))
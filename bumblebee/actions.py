@@ -1,7 +1,10 @@
+import ast
+import calendar
 import numpy as np
 import pandas as pd
 import re
-import yaml
+
+from . import dedup, planner, sketches, strings
 
 
 class UnknownActionError(Exception):
@@ -9,7 +12,7 @@ class UnknownActionError(Exception):
 
 
 class Transformer:
-    def __init__(self, list_of_actions):
+    def __init__(self, list_of_actions, optimize=False):
         self.actions = []
         for step in list_of_actions:
             try:
@@ -20,15 +23,114 @@ class Transformer:
                 instruction = []
             action = Action.factory(action_name, instruction)
             self.actions.append(action)
+        if optimize:
+            self.actions = planner.plan(self.actions)
 
-    def perform_instructions(self, input_data):
+    def perform_instructions(self, input_data, profiler=None):
+        """
+        profiler: a profiling.Profiler to record each action in, if given.
+        """
         output_data = input_data
-        for action in self.actions:
-            output_data = action.perform_instructions(output_data)
+        if profiler is None:
+            for action in self.actions:
+                output_data = action.perform_instructions(output_data)
+            return output_data
+        for index, action in enumerate(self.actions):
+            output_data = profiler.run(type(action).__name__, index,
+                                       action.perform_instructions,
+                                       output_data)
         return output_data
 
+    def columns_needed(self):
+        """
+        Set of input columns the actions need to produce the output, or None
+        if they could need any column.
+        """
+        needed = None
+        for action in reversed(self.actions):
+            needed = action.columns_needed_before(needed)
+        return needed
+
+    def columns_read(self):
+        """
+        Set of input columns whose values the actions read, or None if they
+        could read any column. Other columns just pass through to the output.
+        """
+        read = set()
+        for action in reversed(self.actions):
+            if action.only_removes_columns:
+                # dropping a column doesn't look at its values.
+                continue
+            read = action.columns_needed_before(read)
+            if read is None:
+                return None
+        return read
+
+    def split_row_local(self):
+        """
+        Returns two Transformers: one with the leading row-local actions,
+        which can be run on separate parts of the data, and one with the
+        rest, to run on the joined up result.
+        """
+        n = 0
+        while n < len(self.actions) and self.actions[n].row_local:
+            n += 1
+        row_local, rest = Transformer([]), Transformer([])
+        row_local.actions, rest.actions = self.actions[:n], self.actions[n:]
+        return row_local, rest
+
+    def perform_on_chunks(self, chunks):
+        """
+        chunks: iterable of DataFrames, e.g. from pd.read_csv(chunksize=...)
+        Returns a generator of transformed DataFrames.
+        """
+        for action in self.actions:
+            chunks = action.perform_on_chunks(chunks)
+        return chunks
+
+    def check_new_rows(self):
+        """
+        Returns True if the actions must be run on every row again whenever
+        rows are added, e.g. for only_keep_rows_where t == t.max(), which
+        can drop old rows once a new one is bigger.
+        Raises ValueError if perform_on_new_rows can't run these actions:
+        if one needs every row at once, e.g. ensure_column_is_in_this_format
+        number, and isn't after one giving all the output, e.g. sum_up_by.
+        """
+        for action in self.actions:
+            output = action.output_of_new_rows()
+            if output == 'all':
+                return False
+            if output == 'rerun':
+                return True
+            if output is None:
+                msg = '{} needs every row at once, so can\'t be run on ' \
+                      'new rows only'.format(type(action).__name__)
+                raise ValueError(msg)
+        return False
+
+    def perform_on_new_rows(self, new_rows, states=None):
+        """
+        For inputs that only grow: runs the actions on the rows added since
+        the last run, given the states the actions returned then (None the
+        first time).
+        Returns (output, whole, states): output is just the new output rows,
+        to add to the last run's, unless whole is True, when it's all of it.
+        See check_new_rows for the actions this can't run.
+        """
+        states = list(states or [None] * len(self.actions))
+        output_data, whole = new_rows, False
+        for i, action in enumerate(self.actions):
+            if whole:
+                output_data = action.perform_instructions(output_data)
+            else:
+                output_data, whole, states[i] = action.perform_on_new_rows(
+                    output_data, states[i])
+        return output_data, whole, states
+
     @classmethod
     def from_yaml(cls, filepath_or_buffer):
+        import yaml
         if isinstance(filepath_or_buffer, str):
             with open(filepath_or_buffer) as f:
                 actions = yaml.safe_load(f)
@@ -39,44 +141,129 @@ class Transformer:
 
 # abstract, never used.
 class Action:
+    """
+    An action owns the DataFrame passed to perform_instructions: it may
+    change it in place and return it, or return a new frame, and the caller
+    must not use the frame it passed in afterwards. So neither side has to
+    copy the data to be safe, and actions should only copy what they keep,
+    e.g. the rows that pass a filter.
+    """
+    # True if each row's output only depends on that row, so the action can
+    # be run on a chunk of the data at a time.
+    row_local = True
+    # True if the action only sets the columns in columns_written(), leaving
+    # the rows and every other column alone.
+    only_sets_columns = False
+    # True if the action only drops columns.
+    only_removes_columns = False
+    # True if the action only drops rows.
+    filters_rows = False
+    # True if each instruction is run one after the other, so the action can
+    # be split into one action per instruction, and neighbours joined up.
+    instructions_run_in_order = False
+
     def __init__(self, instructions):
         self.instructions = instructions
 
+    def columns_read(self):
+        """
+        Set of columns the action reads, or None if it could read any.
+        """
+        return None
+
+    def columns_written(self):
+        """
+        Set of columns the action writes, or None if it could write any.
+        """
+        return None
+
+    def columns_needed_before(self, needed):
+        """
+        needed: set of columns needed after this action, None for all.
+        Returns the set of columns needed before this action, None for all.
+        """
+        read = self.columns_read()
+        if needed is None or read is None:
+            return None
+        if self.only_sets_columns:
+            needed = needed - self.columns_written()
+        return needed | read
+
+    def split(self):
+        if self.instructions_run_in_order and len(self.instructions) > 1:
+            return [type(self)([i]) for i in self.instructions]
+        return [self]
+
+    def merge(self, other):
+        """
+        Returns one action doing the work of self then other, or None.
+        """
+        if self.instructions_run_in_order and type(other) is type(self):
+            return type(self)(self.instructions + other.instructions)
+        return None
+
+    def perform_on_chunks(self, chunks):
+        if self.row_local:
+            for chunk in chunks:
+                yield self.perform_instructions(chunk)
+        else:
+            # needs to see every row at once, so merge the chunks first.
+            chunks = list(chunks)
+            if chunks:
+                yield self.perform_instructions(pd.concat(chunks))
+
+    def output_of_new_rows(self):
+        """
+        What perform_on_new_rows gives: 'new' for the output of just the new
+        rows, 'all' for all the output, None if it can't be run. 'rerun' if
+        it can't, but running every row again gives the right output.
+        """
+        return 'new' if self.row_local else None
+
+    def perform_on_new_rows(self, new_rows, state):
+        """
+        See Transformer.perform_on_new_rows. Returns (output, whole, state),
+        the state being whatever the action needs from earlier runs.
+        """
+        if self.row_local:
+            return self.perform_instructions(new_rows), False, None
+        msg = '{} needs every row at once'.format(type(self).__name__)
+        raise ValueError(msg)
+
     @staticmethod
     def factory(action, instruction):
         # just calls different constructors based on passed action
-        action_classes = {
-            'change_date_or_time_format': ChangeDateFormat,
-            'copy_column': CopyAction,
-            'rename_column': RenameAction,
-            'extract_query_string': ExtractQueryStringAction,
-            'extract_text': ExtractTextAction,
-            'only_keep_these_columns': FilterColumnAction,
-            'only_keep_rows_where': FilterRowAction,
-            'only_edit_rows_where': EditSpecificRowsAction,
-            'run_these_formula': FormulaAction,
-            'remove_columns': RemoveColumnAction,
-            'remove_duplicates': RemoveDuplicatesAction,
-            'replace_text': ReplaceTextAction,
-            'add_text_at_end': AppendTextAction,
-            'add_text_at_start': PrependTextAction,
-            'sum_up_by': GroupBySumAction,
-            'make_column_names_lowercase': LowerCaseColumnNamesAction,
-            'make_column_names_alphanumeric': AlphaNumColumnNamesAction,
-            'ensure_column_is_in_this_format': ChangeColumnFormatAction,
-        }
         try:
-            action_class = action_classes[action]
-            return action_class(instruction)
+            action_class = ACTION_CLASSES[action]
         except KeyError:
             msg = 'action {} unknown'.format(action)
             raise UnknownActionError(msg)
+        # outside the try, so a missing instruction key isn't reported as an
+        # unknown action.
+        return action_class(instruction)
+
+
+class ColumnToColumnAction(Action):
+    """
+    Base for actions whose instructions each read a target_column and set a
+    result_column.
+    """
+    only_sets_columns = True
+    instructions_run_in_order = True
+
+    def columns_read(self):
+        return set(i['target_column'] for i in self.instructions)
+
+    def columns_written(self):
+        return set(i['result_column'] for i in self.instructions)
 
 
 class GroupBySumAction(Action):
     """
     self.instructions: list of columns to group by.
     """
+    row_local = False
+
     def perform_instructions(self, input_data):
         columns_to_group_by = self.instructions
         grouped = input_data.groupby(columns_to_group_by, as_index=False)
@@ -84,35 +271,330 @@ class GroupBySumAction(Action):
         output_data.reset_index()
         return output_data
 
+    def perform_on_chunks(self, chunks):
+        # sum each chunk into the sums so far, rather than joining them all.
+        sums = None
+        for chunk in chunks:
+            sums = self.perform_on_new_rows(chunk, sums)[0]
+        if sums is not None:
+            yield sums
+
+    def output_of_new_rows(self):
+        return 'all'
+
+    def perform_on_new_rows(self, new_rows, sums):
+        # sums add up, so the new rows just add to the last run's sums.
+        if sums is not None:
+            if not len(new_rows):
+                # their columns' types would be lost in the concat.
+                return sums.copy(), True, sums
+            new_rows = pd.concat([sums, new_rows], ignore_index=True)
+        output_data = self.perform_instructions(new_rows)
+        # a copy to keep, as the actions after may change the output.
+        return output_data, True, output_data.copy()
 
-class ChangeDateFormat(Action):
+
+class AggregateAction(Action):
+    """
+    self.instructions: dict
+        keys:
+            columns_to_group_by: list of columns
+            calculate: list of strings of form
+                'new_column_name = function(column_name)'
+    e.g.
+        columns_to_group_by:
+            - date
+        calculate:
+            - clicks = sum(clicks)
+            - visitors = approximate_distinct(user)
+            - slowest = approximate_quantile(load_time, 0.99)
+    functions: sum, count, min, max, mean, first, last,
+        approximate_distinct, approximate_quantile
+    Each chunk of rows is cut down to partial results, one row per group,
+    and merged with the last, so memory use grows with the groups, not the
+    rows.
+    """
+    row_local = False
+    # how partial results from two chunks are merged.
+    merge_functions = {'sum': 'sum', 'count': 'sum', 'min': 'min',
+                       'max': 'max', 'first': 'first', 'last': 'last'}
+
+    def __init__(self, instructions):
+        Action.__init__(self, instructions)
+        self.group_by = list(instructions['columns_to_group_by'])
+        self.calculations = [_parse_calculation(calculation)
+                             for calculation in instructions['calculate']]
+
+    def columns_read(self):
+        columns = [column for _, _, column, _ in self.calculations]
+        return set(self.group_by) | set(columns)
+
+    def columns_written(self):
+        results = [result_col for result_col, _, _, _ in self.calculations]
+        return set(self.group_by) | set(results)
+
+    def columns_needed_before(self, needed):
+        # the output is made from just these columns.
+        return self.columns_read()
+
+    def perform_instructions(self, input_data):
+        return self._finish(self._partial(input_data))
+
+    def perform_on_chunks(self, chunks):
+        state = None
+        for chunk in chunks:
+            state = self._merge(state, self._partial(chunk))
+        if state is not None:
+            yield self._finish(state)
+
+    def output_of_new_rows(self):
+        return 'all'
+
+    def perform_on_new_rows(self, new_rows, state):
+        if state is None or len(new_rows):
+            state = self._merge(state, self._partial(new_rows))
+        return self._finish(state), True, state
+
+    def _partial_columns(self):
+        """
+        List of (partial column, column, function, merge function).
+        """
+        partial_columns = []
+        for i, (_, function, column, _) in enumerate(self.calculations):
+            if function == 'mean':
+                partial_columns.append(('{} sum'.format(i), column, 'sum',
+                                        'sum'))
+                partial_columns.append(('{} count'.format(i), column,
+                                        'count', 'sum'))
+            elif function in self.merge_functions:
+                partial_columns.append((str(i), column, function,
+                                        self.merge_functions[function]))
+        return partial_columns
+
+    def _group_ids(self, keys):
+        """
+        Returns (group number of each row, number of groups, the keys of
+        each group). Rows with a missing key get no group, as with groupby.
+        """
+        grouped = keys.groupby(self.group_by, sort=False, observed=True)
+        ids = grouped.ngroup().values
+        ids = np.where(np.isnan(ids), -1, ids).astype(np.intp)
+        n = ids.max() + 1 if len(ids) else 0
+        first_rows = np.unique(ids[ids >= 0], return_index=True)[1]
+        first_rows = np.flatnonzero(ids >= 0)[first_rows]
+        return ids, n, keys.take(first_rows).reset_index(drop=True)
+
+    def _partial(self, input_data):
+        ids, n, keys = self._group_ids(input_data[self.group_by])
+        if (ids < 0).any():
+            rows = np.flatnonzero(ids >= 0)
+            input_data, ids = input_data.take(rows), ids[rows]
+        aggregations = dict((name, (column, function)) for
+                            name, column, function, _ in
+                            self._partial_columns())
+        state = {'keys': keys, 'n': n, 'registers': {}, 'buckets': {}}
+        state['partials'] = _aggregate(input_data, ids, n, aggregations)
+        for i, (_, function, column, _) in enumerate(self.calculations):
+            if function == 'approximate_distinct':
+                state['registers'][i] = sketches.distinct_registers(
+                    ids, input_data[column], n)
+            elif function == 'approximate_quantile':
+                state['buckets'][i] = sketches.quantile_buckets(
+                    ids, input_data[column])
+        return state
+
+    def _merge(self, state, partial):
+        if state is None:
+            return partial
+        keys = pd.concat([state['keys'], partial['keys']], ignore_index=True)
+        ids, n, keys = self._group_ids(keys)
+        partials = pd.concat([state['partials'], partial['partials']],
+                             ignore_index=True)
+        aggregations = dict((name, (name, merge_function)) for
+                            name, _, _, merge_function in
+                            self._partial_columns())
+        merged = {'keys': keys, 'n': n, 'registers': {}, 'buckets': {}}
+        merged['partials'] = _aggregate(partials, ids, n, aggregations)
+        for i, registers in state['registers'].items():
+            registers = np.vstack([registers, partial['registers'][i]])
+            merged['registers'][i] = sketches.merge_registers(ids, registers,
+                                                              n)
+        for i, buckets in state['buckets'].items():
+            # renumber each side's groups to the merged groups.
+            new_buckets = partial['buckets'][i]
+            buckets = buckets.assign(group=ids[buckets['group'].values])
+            new_groups = ids[state['n'] + new_buckets['group'].values]
+            new_buckets = new_buckets.assign(group=new_groups)
+            merged['buckets'][i] = sketches.merge_buckets(
+                pd.concat([buckets, new_buckets], ignore_index=True))
+        return merged
+
+    def _finish(self, state):
+        output_data = state['keys'].copy()
+        partials = state['partials']
+        for i, calculation in enumerate(self.calculations):
+            result_col, function, _, argument = calculation
+            if function == 'mean':
+                values = (partials['{} sum'.format(i)] /
+                          partials['{} count'.format(i)]).values
+            elif function == 'approximate_distinct':
+                values = sketches.distinct_count(state['registers'][i])
+            elif function == 'approximate_quantile':
+                values = sketches.quantile(state['buckets'][i], state['n'],
+                                           argument)
+            else:
+                values = partials[str(i)].values
+            output_data[result_col] = values
+        # in order of the groups, as groupby gives them.
+        output_data = output_data.sort_values(self.group_by, kind='mergesort')
+        return output_data.reset_index(drop=True)
+
+
+class ChangeDateFormat(ColumnToColumnAction):
     """
     self.instructions: list of dicts
         keys:
             target_column
             result_column
             date_format
+    date_format is made up of (case as shown, unless both are given):
+        YYYY/yyyy  year, e.g. 2014     YY/yy  year, e.g. 14
+        MM/mm      month, e.g. 01      MMMM  January     MMM  Jan
+        DD/dd      day, e.g. 13        dddd  Monday      ddd  Mon
+        hh/HH      hour, 00-23, or 01-12 if AM/PM is used
+        mm/MM      minutes, when right after hours or before seconds
+        ss/SS      seconds             fff   milliseconds
+        AM/PM      AM or PM
+    anything else is copied as is.
     """
+    def __init__(self, instructions):
+        Action.__init__(self, instructions)
+        # work out each date_format once, not on every call.
+        self.date_formats = [_parse_date_format(i['date_format'])
+                             for i in self.instructions]
+
     def perform_instructions(self, input_data):
-        for instruction in self.instructions:
+        for instruction, date_format in zip(self.instructions,
+                                            self.date_formats):
             result_col = instruction['result_column']
-            date_format = instruction['date_format']
-            date_format_strings = (
-                # TODO: hour/minute/second support.
-                ('YYYY', '%Y'),
-                ('YY', '%y'),
-                ('MM', '%m'),
-                ('DD', '%d'),
-            )
-            for date_str, strformat in date_format_strings:
-                date_format = date_format.replace(date_str, strformat)
-                date_format = date_format.replace(date_str.lower(), strformat)
-            format_date = lambda x: x.strftime(date_format)
-            dates = input_data[instruction['target_column']].dropna()
-            input_data[result_col] = dates.map(format_date)
+            dates = input_data[instruction['target_column']]
+            # format each distinct date once, as dates tend to repeat.
+            codes, unique_dates = pd.factorize(dates)
+            formatted = _format_dates(pd.DatetimeIndex(unique_dates),
+                                      date_format)
+            result = np.append(formatted, np.nan)[codes]
+            input_data[result_col] = pd.Series(result, index=input_data.index)
         return input_data
 
 
+_DATE_FORMAT_TOKENS = re.compile(
+    'AM/PM|YYYY|yyyy|YY|yy|MMMM|MMM|MM|mm|dddd|ddd|DD|dd|hh|HH|ss|SS|fff')
+
+
+def _parse_date_format(date_format):
+    """
+    Splits a date_format, e.g. 'DD/MM/YYYY hh:mm', into a list of
+    (field, literal text) pairs, one of which is None.
+    """
+    pieces = []
+    position = 0
+    for match in _DATE_FORMAT_TOKENS.finditer(date_format):
+        pieces.append((None, date_format[position:match.start()]))
+        pieces.append((match.group(), None))
+        position = match.end()
+    pieces.append((None, date_format[position:]))
+    pieces = [piece for piece in pieces if piece != (None, '')]
+
+    twelve_hour = 'AM/PM' in date_format
+    tokens = [token for token, _ in pieces if token is not None]
+    fields = []
+    n = 0
+    for token, literal in pieces:
+        if token is None:
+            fields.append((None, literal))
+            continue
+        before = tokens[n - 1] if n else None
+        after = tokens[n + 1] if n + 1 < len(tokens) else None
+        n += 1
+        if token.upper() == 'MM':
+            minutes = before in ('hh', 'HH') or after in ('ss', 'SS')
+            field = 'minute' if minutes else 'month'
+        elif token.upper() == 'HH':
+            field = 'hour12' if twelve_hour else 'hour'
+        else:
+            field = {
+                'AM/PM': 'am_pm',
+                'YYYY': 'year', 'yyyy': 'year',
+                'YY': 'short_year', 'yy': 'short_year',
+                'MMMM': 'month_name', 'MMM': 'short_month_name',
+                'DD': 'day', 'dd': 'day',
+                'dddd': 'weekday_name', 'ddd': 'short_weekday_name',
+                'ss': 'second', 'SS': 'second',
+                'fff': 'millisecond',
+            }[token]
+        fields.append((field, None))
+    return fields
+
+
+_TWO_DIGITS = np.array(['{:02d}'.format(i) for i in range(100)],
+                       dtype=object)
+_THREE_DIGITS = np.array(['{:03d}'.format(i) for i in range(1000)],
+                         dtype=object)
+_MONTH_NAMES = np.array([None] + list(calendar.month_name[1:]), dtype=object)
+_SHORT_MONTH_NAMES = np.array([None] + list(calendar.month_abbr[1:]),
+                              dtype=object)
+_WEEKDAY_NAMES = np.array(list(calendar.day_name), dtype=object)
+_SHORT_WEEKDAY_NAMES = np.array(list(calendar.day_abbr), dtype=object)
+
+
+def _date_field(dates, field):
+    """
+    dates: DatetimeIndex with no missing values.
+    Returns an array of strings for that part of each date.
+    """
+    if field == 'year':
+        years, positions = np.unique(dates.year, return_inverse=True)
+        year_strings = np.array(['{:04d}'.format(year) for year in years],
+                                dtype=object)
+        return year_strings[positions]
+    if field == 'short_year':
+        return _TWO_DIGITS[np.asarray(dates.year) % 100]
+    if field == 'month':
+        return _TWO_DIGITS[np.asarray(dates.month)]
+    if field == 'month_name':
+        return _MONTH_NAMES[np.asarray(dates.month)]
+    if field == 'short_month_name':
+        return _SHORT_MONTH_NAMES[np.asarray(dates.month)]
+    if field == 'day':
+        return _TWO_DIGITS[np.asarray(dates.day)]
+    if field == 'weekday_name':
+        return _WEEKDAY_NAMES[np.asarray(dates.weekday)]
+    if field == 'short_weekday_name':
+        return _SHORT_WEEKDAY_NAMES[np.asarray(dates.weekday)]
+    if field == 'hour':
+        return _TWO_DIGITS[np.asarray(dates.hour)]
+    if field == 'hour12':
+        return _TWO_DIGITS[(np.asarray(dates.hour) + 11) % 12 + 1]
+    if field == 'am_pm':
+        return np.where(np.asarray(dates.hour) < 12, 'AM', 'PM').astype(object)
+    if field == 'minute':
+        return _TWO_DIGITS[np.asarray(dates.minute)]
+    if field == 'second':
+        return _TWO_DIGITS[np.asarray(dates.second)]
+    if field == 'millisecond':
+        return _THREE_DIGITS[np.asarray(dates.microsecond) // 1000]
+
+
+def _format_dates(dates, date_format):
+    formatted = np.full(len(dates), '', dtype=object)
+    for field, literal in date_format:
+        if field is None:
+            formatted = formatted + literal
+        else:
+            formatted = formatted + _date_field(dates, field)
+    return formatted
+
+
 class AlphaNumColumnNamesAction(Action):
     """
     """
@@ -136,6 +618,21 @@ class ChangeColumnFormatAction(Action):
     """
     self.instructions: list of dicts
     """
+    only_sets_columns = True
+    instructions_run_in_order = True
+
+    @property
+    def row_local(self):
+        # int or float is decided by looking at every row.
+        formats = [list(i.values())[0] for i in self.instructions]
+        return 'number' not in formats
+
+    def columns_read(self):
+        return set(list(i.keys())[0] for i in self.instructions)
+
+    def columns_written(self):
+        return self.columns_read()
+
     def perform_instructions(self, input_data):
         output_data = input_data
         for instruction in self.instructions:
@@ -145,13 +642,16 @@ class ChangeColumnFormatAction(Action):
                 output_data[column] = pd.to_datetime(output_data[column])
             elif column_format == 'text':
                 original = output_data[column]
-                output_data[column] = original.astype(str).str.replace('\.0$',
-                                                                       '')
+                text = strings.as_text(original)
+                if text is None:
+                    text = original.astype(str).str.replace('\.0$', '')
+                output_data[column] = text
 
             elif column_format == 'number':
                 dtype = output_data[column].dtype
-                if (not np.issubdtype(dtype, int) and
-                        not np.issubdtype(dtype, float)):
+                # pandas' checks, as numpy's fail on e.g. Arrow strings.
+                if (not pd.api.types.is_integer_dtype(dtype) and
+                        not pd.api.types.is_float_dtype(dtype)):
                     output_data[column] = output_data[column].str.replace(',',
                                                                           '')
                     output_data[column] = output_data[column].str.replace('$',
@@ -164,7 +664,7 @@ class ChangeColumnFormatAction(Action):
         return output_data
 
 
-class AppendTextAction(Action):
+class AppendTextAction(ColumnToColumnAction):
     """
     self.instructions: list of dicts
         keys:
@@ -183,7 +683,7 @@ class AppendTextAction(Action):
         return output_data
 
 
-class PrependTextAction(Action):
+class PrependTextAction(ColumnToColumnAction):
     """
     self.instructions: list of dicts
         keys:
@@ -201,7 +701,7 @@ class PrependTextAction(Action):
         return output_data
 
 
-class ReplaceTextAction(Action):
+class ReplaceTextAction(ColumnToColumnAction):
     """
     self.instructions: list of dicts
         keys:
@@ -221,14 +721,20 @@ class ReplaceTextAction(Action):
             elif text_to_find == '$':
                 result = output_data[col] + replacement
             else:
-                result = output_data[col].str.replace(text_to_find,
-                                                      replacement)
+                values = output_data[col]
+                result = strings.replace(values, text_to_find, replacement)
+                if result is None and strings.is_arrow_strings(values):
+                    # with Python's re, keeping the column Arrow strings.
+                    result = values.astype(object).str.replace(
+                        text_to_find, replacement).astype(values.dtype)
+                elif result is None:
+                    result = values.str.replace(text_to_find, replacement)
             result_col = instruction['result_column']
             output_data[result_col] = result
         return output_data
 
 
-class ExtractTextAction(Action):
+class ExtractTextAction(ColumnToColumnAction):
     """
     self.instructions: dict
     keys:
@@ -242,11 +748,14 @@ class ExtractTextAction(Action):
             result_col = instruction['result_column']
             regex = instruction['regex']
             text = input_data[text_col]
-            input_data[result_col] = text.str.extract(regex, re.VERBOSE)
+            extracted = strings.extract(text, regex)
+            if extracted is None:
+                extracted = text.str.extract(regex, re.VERBOSE)
+            input_data[result_col] = extracted
         return input_data
 
 
-class ExtractQueryStringAction(Action):
+class ExtractQueryStringAction(ColumnToColumnAction):
     """
     self.instructions: list of dicts
     keys:
@@ -254,24 +763,52 @@ class ExtractQueryStringAction(Action):
         query_string
         target_column
     """
-    def perform_instructions(self, input_data):
-        regex_instructions = []
+    def __init__(self, instructions):
+        Action.__init__(self, instructions)
+        # instructions in a row on the same column share one pass over it.
+        self.groups = []
         for instruction in self.instructions:
-            result_col = instruction['result_column']
-            regex = """
-                .*          # anything at the start
-                [?&]        # query string prececed by & or ?
-                {} =        # extract x query string.
-                ([^&#]*)    # capture up until & or #
-            """.format(instruction['query_string'])
-            regex_instruction = {
-                'target_column': instruction['target_column'],
-                'result_column': result_col,
-                'regex': regex,
-            }
-            regex_instructions.append(regex_instruction)
-        a = ExtractTextAction(regex_instructions)
-        return a.perform_instructions(input_data)
+            col = instruction['target_column']
+            if self.groups and self.groups[-1][0] == col:
+                written = [i['result_column'] for i in self.groups[-1][1]]
+                if col not in written:
+                    self.groups[-1][1].append(instruction)
+                    continue
+            self.groups.append((col, [instruction]))
+        self.patterns = []
+        for _, group in self.groups:
+            keys = tuple(str(i['query_string']) for i in group)
+            self.patterns.append(_query_string_pattern(keys))
+
+    def perform_instructions(self, input_data):
+        for (text_col, group), pattern in zip(self.groups, self.patterns):
+            found = input_data[text_col].str.findall(pattern)
+            # a key given more than once gets its last value, as before.
+            parsed = [dict(pairs) if isinstance(pairs, list) else {}
+                      for pairs in found]
+            keys = [str(i['query_string']) for i in group]
+            values = pd.DataFrame(parsed, index=input_data.index,
+                                  columns=sorted(set(keys)), dtype=object)
+            for key, instruction in zip(keys, group):
+                input_data[instruction['result_column']] = values[key]
+        return input_data
+
+
+# compiled query string patterns, shared by every action and chunk.
+_query_string_patterns = {}
+
+
+def _query_string_pattern(keys):
+    """
+    Pattern finding every key=value in a URL, for any of the keys, where the
+    key follows ? or & and the value runs up until & or #.
+    """
+    if keys not in _query_string_patterns:
+        names = '|'.join(re.escape(key) for key in keys)
+        # a lookahead, so matches can overlap like they did with .*[?&]key=
+        regex = '(?=[?&]({})=([^&#]*))'.format(names)
+        _query_string_patterns[keys] = re.compile(regex)
+    return _query_string_patterns[keys]
 
 
 class FilterRowAction(Action):
@@ -281,11 +818,46 @@ class FilterRowAction(Action):
     'a < 2'
     '10 < temp < 20'
     """
+    filters_rows = True
+    instructions_run_in_order = True
+
+    @property
+    def row_local(self):
+        return all(_is_row_wise(instruction)
+                   for instruction in self.instructions)
+
+    def output_of_new_rows(self):
+        # a new row can change which old rows are kept.
+        return 'new' if self.row_local else 'rerun'
+
+    def columns_read(self):
+        names = set()
+        for instruction in self.instructions:
+            names |= _names_in_expression(instruction)
+        return names
+
+    def columns_written(self):
+        return set()
+
     def perform_instructions(self, input_data):
+        # each clause runs on the rows kept by the ones before. Row-wise
+        # clauses give the same answer on every row, so they're run on the
+        # whole input and joined into one mask, with no copy. Others, e.g.
+        # t == t.max(), need the kept rows taken out first.
+        mask = np.ones(len(input_data), dtype=bool)
         for instruction in self.instructions:
-            # .copy to shut SettingWithCopyWarning from Pandas.
-            input_data = input_data.copy().query(instruction)
-        return input_data
+            if _is_row_wise(instruction) or mask.all():
+                mask &= np.asarray(input_data.eval(instruction), dtype=bool)
+            else:
+                positions = np.flatnonzero(mask)
+                kept = input_data.take(positions)
+                matches = np.asarray(kept.eval(instruction), dtype=bool)
+                mask[positions[~matches]] = False
+        if mask.all():
+            return input_data
+        # .take, unlike boolean indexing, doesn't mark the result as a copy,
+        # so later actions can set columns on it without a warning.
+        return input_data.take(np.flatnonzero(mask))
 
 
 class EditSpecificRowsAction(Action):
@@ -298,15 +870,30 @@ class EditSpecificRowsAction(Action):
         - rows_match: 1 < b < 3
           run_these_formula: a = 666
     """
+    @property
+    def row_local(self):
+        for instruction in self.instructions:
+            if not FilterRowAction([instruction['rows_match']]).row_local:
+                return False
+            actions = Transformer(instruction['list_of_actions'])
+            if not all(action.row_local for action in actions.actions):
+                return False
+        return True
+
     def perform_instructions(self, input_data):
         output_data = input_data
         for instruction in self.instructions:
             filter_instruction = instruction['rows_match']
             filter_row_action = FilterRowAction([filter_instruction])
             filtered_data = filter_row_action.perform_instructions(output_data)
+            if filtered_data is output_data:
+                # every row matched, and the actions may change what they're
+                # given.
+                filtered_data = output_data.copy()
             actions = Transformer(instruction['list_of_actions'])
             transformed = actions.perform_instructions(filtered_data)
-            output_data.loc[transformed.index] = transformed
+            output_data.loc[transformed.index] = transformed[
+                output_data.columns]
         return input_data
 
 
@@ -314,6 +901,17 @@ class FilterColumnAction(Action):
     """
     self.instructions: list of columns to keep
     """
+    only_removes_columns = True
+
+    def columns_read(self):
+        return set(self.instructions)
+
+    def columns_written(self):
+        return set()
+
+    def columns_needed_before(self, needed):
+        return set(self.instructions)
+
     def perform_instructions(self, input_data):
         output_data = input_data.loc[:, self.instructions]
         return output_data
@@ -323,31 +921,139 @@ class RemoveColumnAction(Action):
     """
     self.instructions: list of columns to drop
     """
+    only_removes_columns = True
+
+    def __init__(self, instructions):
+        Action.__init__(self, instructions)
+        # columns whose actions the planner dropped, so are only there if
+        # they were read in.
+        self.may_be_missing = set()
+
+    def columns_read(self):
+        return set(self.instructions)
+
+    def columns_written(self):
+        return set()
+
+    def removed_columns(self):
+        return set(self.instructions)
+
     def perform_instructions(self, input_data):
-        output_data = input_data.drop(self.instructions, axis='columns')
+        columns = [col for col in self.instructions
+                   if col in input_data or col not in self.may_be_missing]
+        output_data = input_data.drop(columns, axis='columns')
         return output_data
 
 
 class RemoveDuplicatesAction(Action):
     """
-    self.instructions: list of columns to drop duplicate values
+    self.instructions: list of columns to drop duplicate values, or dict
+        keys:
+            columns: list of columns
+            keep_in_memory_up_to_megabytes: (optional)
+            spill_to_directory: (optional)
+    Keeps the first of each set of duplicates. When run a chunk at a time,
+    rows are compared by 64-bit hashes of their values, and the hashes seen
+    move to disk once they take more memory than the limit.
+    duplicates_dropped: how many rows the last run dropped.
     """
+    row_local = False
+
+    def __init__(self, instructions):
+        Action.__init__(self, instructions)
+        if isinstance(instructions, dict):
+            self.columns = list(instructions.get('columns') or [])
+            megabytes = instructions.get('keep_in_memory_up_to_megabytes')
+            self.spill_directory = instructions.get('spill_to_directory')
+        else:
+            self.columns = list(instructions)
+            megabytes, self.spill_directory = None, None
+        self.max_bytes = None
+        if megabytes is not None:
+            self.max_bytes = megabytes * 1024 ** 2
+        self.duplicates_dropped = 0
+
+    def columns_read(self):
+        # no columns given means compare every column.
+        return set(self.columns) or None
+
+    def columns_written(self):
+        return set()
+
     def perform_instructions(self, input_data):
-        output_data = input_data.drop_duplicates(self.instructions)
+        output_data = input_data.drop_duplicates(self.columns or None)
+        self.duplicates_dropped = len(input_data) - len(output_data)
         return output_data
 
+    def perform_on_chunks(self, chunks):
+        # keeps just the hashes of rows seen, not the rows.
+        seen = dedup.SeenKeys(self.max_bytes, self.spill_directory)
+        self.duplicates_dropped = 0
+        try:
+            for chunk in chunks:
+                keep = seen.add(dedup.row_hashes(chunk, self.columns))
+                self.duplicates_dropped = seen.duplicates
+                yield chunk.take(np.flatnonzero(keep))
+        finally:
+            seen.close()
+
+    def output_of_new_rows(self):
+        return 'new'
+
+    def perform_on_new_rows(self, new_rows, seen):
+        """
+        seen: dedup.SeenKeys of the hashes of the rows kept so far, which,
+        unlike the values, don't depend on the types each run's rows were
+        parsed as.
+        """
+        if seen is None:
+            seen = dedup.SeenKeys()
+        duplicates = seen.duplicates
+        keep = seen.add(dedup.row_hashes(new_rows, self.columns))
+        self.duplicates_dropped = seen.duplicates - duplicates
+        return new_rows.take(np.flatnonzero(keep)), False, seen
+
 
 class RenameAction(Action):
     """
     self.instructions: list of strings of form:
     'new_column_name = old_column_name'
     """
-    def perform_instructions(self, input_data):
+    def renamed_columns(self):
         renames = {}
         for instruction in self.instructions:
             new_col, old_col = instruction.split('=')
             new_col, old_col = new_col.strip(), old_col.strip()
             renames[old_col] = new_col
+        return renames
+
+    def columns_read(self):
+        return set(self.renamed_columns())
+
+    def columns_needed_before(self, needed):
+        if needed is None:
+            return None
+        renames = self.renamed_columns()
+        before = set(c for c in needed if renames.get(c, c) == c)
+        before |= set(old for old, new in renames.items() if new in needed)
+        return before
+
+    def merge(self, other):
+        if type(other) is not type(self):
+            return None
+        # renames in one action happen all at once, so work out where each
+        # column ends up after both.
+        first, second = self.renamed_columns(), other.renamed_columns()
+        renames = {}
+        for old_col in set(first) | set(second):
+            col = first.get(old_col, old_col)
+            renames[old_col] = second.get(col, col)
+        instructions = ['{} = {}'.format(new, old)
+                        for old, new in sorted(renames.items()) if old != new]
+        return type(self)(instructions)
+
+    def perform_instructions(self, input_data):
+        renames = self.renamed_columns()
         output_data = input_data.rename(columns=renames)
         return output_data
 
@@ -357,6 +1063,15 @@ class CopyAction(Action):
     self.instructions: list of strings of form:
     'new_column_name = old_column_name'
     """
+    only_sets_columns = True
+    instructions_run_in_order = True
+
+    def columns_read(self):
+        return set(i.split('=')[1].strip() for i in self.instructions)
+
+    def columns_written(self):
+        return set(i.split('=')[0].strip() for i in self.instructions)
+
     def perform_instructions(self, input_data):
         # TODO: refactor out 2 common lines? worth it?
         for instruction in self.instructions:
@@ -372,19 +1087,177 @@ class FormulaAction(Action):
     e.g.
     'fahrenheit = celsius * 9 / 5 + 32'
     """
-    def perform_instructions(self, input_data):
+    only_sets_columns = True
+    instructions_run_in_order = True
+
+    @property
+    def row_local(self):
+        return all(_is_row_wise(instruction.split('=', 1)[1])
+                   for instruction in self.instructions)
+
+    def output_of_new_rows(self):
+        # a new row can change the old rows' values, e.g. of b - b.mean().
+        return 'new' if self.row_local else 'rerun'
+
+    def columns_read(self):
+        names = set()
         for instruction in self.instructions:
+            value = instruction.split('=', 1)[1].strip()
+            names |= _names_in_expression(value)
             try:
-                input_data.eval(instruction)
-            except (ValueError, SyntaxError):
-                # These hacks exists as .eval only works with numbers, not text
-                result_col, value = instruction.split(' = ', maxsplit=1)
-                if value[0] in ['"', "'"]:
-                    # set to a string
-                    input_data[result_col] = value[1:-1]
-                else:
-                    try:
-                        input_data[result_col] = input_data[value]
-                    except KeyError:
-                        input_data[result_col] = value
+                compile(value, '<formula>', 'eval')
+            except SyntaxError:
+                # could be a column name that isn't valid python, e.g. spaces.
+                names.add(value)
+        return names
+
+    def columns_written(self):
+        return set(i.split('=', 1)[0].strip() for i in self.instructions)
+
+    def __init__(self, instructions):
+        Action.__init__(self, instructions)
+        # parse each formula once, not on every chunk.
+        self.steps = _compile_formulas(self.instructions)
+
+    def perform_instructions(self, input_data):
+        for kind, result_col, value in self.steps:
+            if kind == 'expression':
+                input_data.eval(value, inplace=True)
+            elif kind == 'text':
+                input_data[result_col] = value
+            elif kind == 'column':
+                input_data[result_col] = input_data[value]
+            elif value in input_data:
+                input_data[result_col] = input_data[value]
+            else:
+                input_data[result_col] = value
         return input_data
+
+
+def _compile_formulas(formulas):
+    """
+    Returns a list of (kind, result column, value) steps, where kind is one
+    of:
+        expression: value is formulas for DataFrame.eval. Formulas in a row
+            are run by one eval.
+        text: value is the text to set the column to.
+        column: value is the column to copy.
+        column_or_text: value is a column to copy if there is one, otherwise
+            the text to set the column to, e.g. for names with spaces.
+    """
+    steps = []
+    for formula in formulas:
+        step = _compile_formula(formula)
+        if step[0] == 'expression' and steps and steps[-1][0] == 'expression':
+            formulas = steps[-1][2] + '\n' + step[2]
+            steps[-1] = ('expression', None, formulas)
+        else:
+            steps.append(step)
+    return steps
+
+
+def _compile_formula(formula):
+    result_col, _, value = formula.partition('=')
+    result_col, value = result_col.strip(), value.strip()
+    if len(value) > 1 and value[0] in ['"', "'"] and value[-1] == value[0]:
+        # .eval only works with numbers, not text.
+        return ('text', result_col, value[1:-1])
+    if re.match(r'^[A-Za-z_]\w*$', result_col):
+        try:
+            tree = ast.parse(value, mode='eval').body
+        except SyntaxError:
+            tree = None
+        if isinstance(tree, ast.Name):
+            return ('column', result_col, value)
+        if tree is not None:
+            return ('expression', None, '{} = {}'.format(result_col, value))
+    return ('column_or_text', result_col, value)
+
+
+def _parse_calculation(calculation):
+    """
+    'new_column = function(column)' to (new_column, function, column,
+    argument), argument being the quantile for approximate_quantile.
+    """
+    functions = ['sum', 'count', 'min', 'max', 'mean', 'first', 'last',
+                 'approximate_distinct', 'approximate_quantile']
+    match = re.match(r'^(.+?)=\s*(\w+)\s*\((.+)\)\s*$', calculation)
+    if match is None or match.group(2) not in functions:
+        msg = 'calculation {!r} not understood'.format(calculation)
+        raise ValueError(msg)
+    result_col, function, column = match.groups()
+    argument = None
+    if function == 'approximate_quantile':
+        # column names can have commas, the quantile can't.
+        column, _, argument = column.rpartition(',')
+        argument = float(argument)
+    return result_col.strip(), function, column.strip(), argument
+
+
+def _aggregate(input_data, ids, n, aggregations):
+    """
+    aggregations: {result column: (column, function)}
+    Returns a DataFrame of n rows, row i the results for the rows in group i.
+    """
+    if not aggregations:
+        return pd.DataFrame(index=pd.RangeIndex(n))
+    output_data = input_data.groupby(ids).agg(**aggregations)
+    return output_data.reset_index(drop=True)
+
+
+def _names_in_expression(expression):
+    """
+    Set of names an eval/query expression could refer to as columns.
+    Errs on the side of including too many.
+    """
+    # drop string literals, they can't refer to columns.
+    expression = re.sub("'[^']*'" + '|"[^"]*"', ' ', expression)
+    names = set(re.findall(r'`([^`]*)`', expression))
+    expression = re.sub(r'`[^`]*`', ' ', expression)
+    # any letters, as in Python names, e.g. température.
+    for match in re.finditer(r'[^\W\d]\w*', expression):
+        preceded_by = expression[:match.start()].rstrip()[-1:]
+        if preceded_by not in ('.', '@'):
+            names.add(match.group())
+    return names - set(['and', 'or', 'not', 'in', 'True', 'False'])
+
+
+def _is_row_wise(expression):
+    """
+    Whether an eval/query expression gives each row a value from that row
+    alone. Calls, attributes and indexing, e.g. b - b.mean() or
+    t == t.max(), can look at every row.
+    """
+    # backticks quote column names that aren't Python names.
+    expression = re.sub(r'`[^`]*`', '_column', expression)
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError:
+        # a formula's column name or text, e.g. with spaces.
+        return True
+    return not any(isinstance(node, (ast.Call, ast.Attribute, ast.Subscript))
+                   for node in ast.walk(tree))
+
+
+# YAML name of each action, for Action.factory.
+ACTION_CLASSES = {
+    'change_date_or_time_format': ChangeDateFormat,
+    'copy_column': CopyAction,
+    'rename_column': RenameAction,
+    'extract_query_string': ExtractQueryStringAction,
+    'extract_text': ExtractTextAction,
+    'only_keep_these_columns': FilterColumnAction,
+    'only_keep_rows_where': FilterRowAction,
+    'only_edit_rows_where': EditSpecificRowsAction,
+    'run_these_formula': FormulaAction,
+    'remove_columns': RemoveColumnAction,
+    'remove_duplicates': RemoveDuplicatesAction,
+    'replace_text': ReplaceTextAction,
+    'add_text_at_end': AppendTextAction,
+    'add_text_at_start': PrependTextAction,
+    'sum_up_by': GroupBySumAction,
+    'aggregate_by': AggregateAction,
+    'make_column_names_lowercase': LowerCaseColumnNamesAction,
+    'make_column_names_alphanumeric': AlphaNumColumnNamesAction,
+    'ensure_column_is_in_this_format': ChangeColumnFormatAction,
+}
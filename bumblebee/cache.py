@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import pandas as pd
+import six
+
+# input files content_hashes.json remembers at most.
+_MAX_CONTENT_HASHES = 10000
+
+# hash of bumblebee's own code, see _code_hash.
+_CODE_HASH = None
+
+
+class ResultCache:
+    """
+    Stores transform outputs on disk in directory, keyed on a hash of the
+    spec and of the input file's content, so re-running an unchanged spec
+    on an unchanged file just reads the stored output back.
+
+    Outputs are pickled, so a hit gives back exactly what transform made,
+    types and missing values included (parquet, for one, reads missing
+    text back as None rather than NaN). As reading a pickle can run code,
+    directory is made readable and writable by this user only, and an
+    existing one anyone else could write to is refused: don't share it
+    between users. Once the stored outputs take more than max_bytes, the
+    least recently used are deleted.
+
+    hits and misses count lookups in this process.
+    """
+    def __init__(self, directory, max_bytes=1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        check_private(directory)
+
+    def key_for(self, spec, filepath_or_buffer):
+        """
+        Returns the key for spec (a dict of options) run on the input, or
+        None if the input can't be fingerprinted, e.g. a buffer. The key
+        changes with bumblebee's code and the pandas version, as either
+        can change the output.
+        """
+        if not isinstance(filepath_or_buffer, six.string_types):
+            return None
+        digest = hashlib.sha1()
+        digest.update(_code_hash().encode('ascii'))
+        digest.update(pd.__version__.encode('ascii'))
+        spec_text = json.dumps(spec, sort_keys=True, default=str)
+        digest.update(spec_text.encode('utf-8'))
+        digest.update(self._content_hash(filepath_or_buffer).encode('ascii'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the output stored under key, or None.
+        """
+        path = self._path(key, '.pickle')
+        try:
+            output_data = pd.read_pickle(path)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        # mark as recently used, for eviction.
+        os.utime(path, None)
+        self.hits += 1
+        return output_data
+
+    def put(self, key, output_data):
+        write_aside(self._path(key, '.pickle'), output_data.to_pickle)
+        self._evict()
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pickle'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                # another process got there first.
+                pass
+            total -= size
+
+    def _content_hash(self, filepath):
+        """
+        Hash of the file's content. Remembered against the file's size and
+        modification time, so an unchanged file isn't read again to hash it.
+        """
+        filepath = os.path.realpath(filepath)
+        stat = os.stat(filepath)
+        fingerprint = [stat.st_size, stat.st_mtime_ns]
+        index_path = os.path.join(self.directory, 'content_hashes.json')
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            index = {}
+        known = index.get(filepath)
+        if known is not None and known[:2] == fingerprint:
+            return known[2]
+        digest = hashlib.sha1()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1024 ** 2), b''):
+                digest.update(block)
+        # files hashed longest ago last, and none that are gone.
+        index.pop(filepath, None)
+        index = dict((path, entry) for path, entry in index.items()
+                     if os.path.exists(path))
+        while len(index) >= _MAX_CONTENT_HASHES:
+            del index[next(iter(index))]
+        index[filepath] = fingerprint + [digest.hexdigest()]
+        write_aside(index_path, lambda f: json.dump(index, f), mode='w')
+        return digest.hexdigest()
+
+
+def _code_hash():
+    """
+    Hash of the source of bumblebee's modules, read once per process.
+    """
+    global _CODE_HASH
+    if _CODE_HASH is None:
+        package = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.sha1()
+        for name in sorted(os.listdir(package)):
+            if name.endswith('.py'):
+                digest.update(name.encode('utf-8'))
+                with open(os.path.join(package, name), 'rb') as f:
+                    digest.update(f.read())
+        _CODE_HASH = digest.hexdigest()
+    return _CODE_HASH
+
+
+def write_aside(path, write, mode='wb'):
+    """
+    Calls write with a new file in path's directory, then moves it to
+    path, so readers never see a half written file. The file has a name
+    of its own, so threads writing the same path don't clash, and is
+    readable by this user only.
+    """
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp',
+                                     dir=directory or '.')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def check_private(path):
+    """
+    Raises ValueError if a user other than this one could have written
+    path, so that unpickling what's there could run their code.
+    """
+    if not hasattr(os, 'getuid'):
+        # e.g. Windows, where files don't have these permissions.
+        return
+    stat = os.stat(path)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+        msg = '{} can be written by other users, so isn\'t safe to read ' \
+              'pickles from'.format(path)
+        raise ValueError(msg)
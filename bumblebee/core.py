@@ -1,10 +1,23 @@
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
 import numpy as np
+import os
 import pandas as pd
-import re
 import six
-import yaml
+from six.moves import cPickle as pickle
 
-from .actions import Transformer
+from . import planner, readers, strings, writers
+from .cache import ResultCache, check_private, write_aside
+from .actions import FilterRowAction, Transformer
+
+# rows read to pick compact column types, see compact_dtypes.
+_SAMPLE_ROWS = 10000
+# start of files written by Convertor.compile, followed by the options as
+# JSON. Bump the number if what follows it changes.
+_COMPILED_HEADER = b'bumblebee compiled spec 1\n'
 
 
 class Convertor:
@@ -18,17 +31,78 @@ class Convertor:
                  only_load_these_columns=None,
                  column_separator=',',
                  read_from_row_that_starts_with=None,
-                 list_of_actions=None):
+                 read_from_first_or_last_matching_row='last',
+                 list_of_actions=None,
+                 optimize_list_of_actions=False,
+                 filter_rows_while_reading=False,
+                 read_in_chunks_of_rows=100000,
+                 compact_dtypes=False,
+                 output_format='csv',
+                 partition_output_by=None,
+                 string_engine='python',
+                 cache_results_in_directory=None,
+                 cache_size_limit_in_megabytes=1024):
+        # as given, for compile.
+        options = dict(locals())
+        del options['self']
+        self.options = options
+        # the options, to tell if a cached result came from the same spec.
+        spec = dict(options)
+        del spec['cache_results_in_directory']
+        del spec['cache_size_limit_in_megabytes']
+        self.spec = spec
+        if data_format != 'csv':
+            readers.reader(data_format)
+        # csv, or a format in readers. Options for the layout of a csv file,
+        # e.g. column_separator, don't apply to the other formats.
         self.data_format = data_format
         self.encoding = encoding
         self.read_from_row_that_starts_with = read_from_row_that_starts_with
+        if read_from_first_or_last_matching_row not in ('first', 'last'):
+            msg = 'read_from_first_or_last_matching_row must be first or last'
+            raise ValueError(msg)
+        match = read_from_first_or_last_matching_row
+        self.read_from_first_or_last_matching_row = match
         self.column_separator = column_separator
         column_formats = read_these_columns_in_these_formats or {}
         self.read_these_columns_in_these_formats = column_formats
         self.only_load_these_columns = only_load_these_columns or []
 
         list_of_actions = list_of_actions or []
-        self.action_list = Transformer(list_of_actions)
+        self.action_list = Transformer(list_of_actions,
+                                       optimize=optimize_list_of_actions)
+        self.read_in_chunks_of_rows = read_in_chunks_of_rows
+        # only_keep_rows_where clauses run on each chunk as it's read, so the
+        # rows they drop are never all in memory at once.
+        self.filters_applied_while_reading = []
+        if filter_rows_while_reading:
+            actions = self.action_list.actions
+            filters, actions = planner.take_filters_for_reading(actions)
+            self.action_list.actions = actions
+            self.filters_applied_while_reading = filters
+        # store columns the actions don't read in smaller types: text with
+        # few distinct values as category, numbers in the narrowest type
+        # that holds them exactly.
+        self.compact_dtypes = compact_dtypes
+        # check now, rather than after transforming the data.
+        writers.writer_class(output_format)
+        self.output_format = output_format
+        self.partition_output_by = partition_output_by
+        # arrow: store text columns as Arrow strings, which take less memory
+        # and which the text actions run on with pyarrow's kernels.
+        if string_engine not in ('python', 'arrow'):
+            msg = 'string_engine must be python or arrow'
+            raise ValueError(msg)
+        if string_engine == 'arrow':
+            strings.check_pyarrow()
+        self.string_engine = string_engine
+        self.result_cache = None
+        if cache_results_in_directory is not None:
+            max_bytes = cache_size_limit_in_megabytes * 1024 ** 2
+            self.result_cache = ResultCache(cache_results_in_directory,
+                                            max_bytes)
+        # a profiling.Profiler, to record each step of transform in.
+        self.profiler = None
 
         header_row = column_headers_are_on_row_number
         self.column_headers_are_on_row_number = header_row
@@ -37,6 +111,8 @@ class Convertor:
 
     @classmethod
     def from_yaml(cls, filepath_or_buffer):
+        # imported here, so loading a compiled spec doesn't import yaml.
+        import yaml
         if isinstance(filepath_or_buffer, str):
             with open(filepath_or_buffer) as f:
                 config = yaml.safe_load(f)
@@ -44,6 +120,7 @@ class Convertor:
             config = yaml.safe_load(filepath_or_buffer)
         kwargs = {}
         options = [
+            'data_format',
             'column_separator',
             'encoding',
             'column_headers_are_on_row_number',
@@ -51,7 +128,17 @@ class Convertor:
             'read_these_columns_in_these_formats',
             'only_load_these_columns',
             'read_from_row_that_starts_with',
+            'read_from_first_or_last_matching_row',
             'list_of_actions',
+            'optimize_list_of_actions',
+            'filter_rows_while_reading',
+            'read_in_chunks_of_rows',
+            'compact_dtypes',
+            'output_format',
+            'partition_output_by',
+            'string_engine',
+            'cache_results_in_directory',
+            'cache_size_limit_in_megabytes',
         ]
         for option in options:
             if option in config:
@@ -59,43 +146,591 @@ class Convertor:
         o = cls(**kwargs)
         return o
 
+    @classmethod
+    def from_compiled(cls, filepath):
+        """
+        Makes a Convertor from a file written by compile.
+        """
+        with open(filepath, 'rb') as f:
+            if f.read(len(_COMPILED_HEADER)) != _COMPILED_HEADER:
+                msg = '{} isn\'t a spec compiled by this version of ' \
+                      'bumblebee'.format(filepath)
+                raise ValueError(msg)
+            options = json.loads(f.read().decode('utf-8'))
+        return cls(**options)
+
+    @classmethod
+    def from_spec_file(cls, filepath):
+        """
+        Reads a spec compiled by compile, or else a YAML one.
+        """
+        with open(filepath, 'rb') as f:
+            is_compiled = f.read(len(_COMPILED_HEADER)) == _COMPILED_HEADER
+        if is_compiled:
+            return cls.from_compiled(filepath)
+        return cls.from_yaml(filepath)
+
+    def compile(self, filepath):
+        """
+        Writes the options this Convertor was made with to filepath, as
+        JSON, so from_compiled can make it again without importing yaml.
+        It's plain data, so reading one can't run code, and the options
+        are checked again as a YAML spec's are. ValueError is raised, naming
+        the option, if JSON would give any of them back changed, e.g. a
+        number used as a key, or a YAML date that isn't in quotes.
+        """
+        for option, value in self.options.items():
+            _check_json_keeps(value, option)
+        options = json.dumps(self.options)
+        with open(filepath, 'wb') as f:
+            f.write(_COMPILED_HEADER)
+            f.write(options.encode('utf-8'))
+
     def transform(self, filepath_or_buffer):
-        input_data = self.extract(filepath_or_buffer)
-        output_data = self.action_list.perform_instructions(input_data)
+        key = None
+        if self.result_cache is not None:
+            key = self.result_cache.key_for(self.spec, filepath_or_buffer)
+        if key is not None:
+            output_data = self.result_cache.get(key)
+            if output_data is not None:
+                return output_data
+        if self.profiler is None:
+            input_data = self.extract(filepath_or_buffer)
+        else:
+            input_data = self.profiler.run('extract', None, self.extract,
+                                           filepath_or_buffer)
+        output_data = self.action_list.perform_instructions(input_data,
+                                                            self.profiler)
+        if key is not None:
+            self.result_cache.put(key, output_data)
+        return output_data
+
+    def transform_iter(self, filepath_or_buffer, chunksize=100000):
+        """
+        Like transform, but reads the input chunksize rows at a time and
+        yields the output a chunk at a time, so memory use is bounded by
+        chunksize rather than by the size of the file.
+
+        Actions that need every row at once (e.g. sum_up_by, or clauses and
+        formulas such as t == t.max()) are run on the merged output of the
+        actions before them.
+        """
+        chunks = self.extract_iter(filepath_or_buffer, chunksize)
+        for output_data in self.action_list.perform_on_chunks(chunks):
+            yield output_data
+
+    def transform_many_iter(self, filepaths, chunksize=100000):
+        """
+        Like transform_iter, but reads the files one after the other as if
+        they were one, so e.g. remove_duplicates drops rows repeated across
+        files, while only holding a chunk of rows at a time.
+        """
+        chunks = itertools.chain.from_iterable(
+            self.extract_iter(filepath, chunksize) for filepath in filepaths)
+        for output_data in self.action_list.perform_on_chunks(chunks):
+            yield output_data
+
+    def load(self, filepath_or_buffer, destination):
+        """
+        Transforms the input a chunk at a time, as in transform_iter, and
+        writes each chunk of output to destination as soon as it's made, in
+        output_format. So neither the output nor its text is ever all in
+        memory.
+
+        Each chunk's column types are picked from its own rows, so they can
+        differ from transform's, e.g. a number column written as 5 in one
+        chunk and 7.0 in a later one. Use save to match transform. parquet
+        and feather files keep the first chunk's types, or for columns
+        empty in it the type of their first values, and ValueError is
+        raised if a later chunk's values don't fit them, see
+        writers.ArrowWriter.
+
+        destination: path, or a file-like object for csv. A directory if
+            partition_output_by is set.
+        """
+        with self.open_writer(destination) as writer:
+            chunks = self.transform_iter(filepath_or_buffer,
+                                         self.read_in_chunks_of_rows)
+            for output_data in chunks:
+                writer.write(output_data)
+
+    def save(self, filepath_or_buffer, destination):
+        """
+        Writes transform's output to destination, in output_format. See
+        load for destination.
+        """
+        output_data = self.transform(filepath_or_buffer)
+        with self.open_writer(destination) as writer:
+            writer.write(output_data)
+
+    def load_pipelined(self, filepaths, destination, queue_size=2):
+        """
+        Like load, but reads the next chunk while transforming this one and
+        writing the one before, so slow storage and the actions overlap.
+        The files are read one after the other as if they were one, as in
+        transform_many_iter. See pipeline.load_pipelined.
+        """
+        from .pipeline import load_pipelined
+        if isinstance(filepaths, six.string_types):
+            filepaths = [filepaths]
+        load_pipelined(self, filepaths, destination, queue_size)
+
+    def open_writer(self, destination):
+        return writers.open_writer(self.output_format, destination,
+                                   self.partition_output_by)
+
+    def transform_many(self, filepaths, workers=None, output_directory=None):
+        """
+        Transforms each file, spread over a pool of worker processes. Each
+        worker is sent this Convertor once, rather than re-reading the YAML.
+
+        workers: number of processes, defaults to the number of CPUs.
+        output_directory: if given (and made if missing), each file's
+            output is written there by save, under the file's name (with
+            the extension of the output_format, if not csv), and the list
+            of written paths is returned. Otherwise all the output is
+            returned as one DataFrame, in the order of filepaths.
+        """
+        filepaths = list(filepaths)
+        if output_directory is not None:
+            names = [os.path.basename(path) for path in filepaths]
+            if len(set(names)) != len(names):
+                msg = 'input files must have different names'
+                raise ValueError(msg)
+            for path in filepaths:
+                output_path = os.path.join(output_directory,
+                                           self._output_name(path))
+                # writing would empty the file while it's being read.
+                if _same_file(path, output_path):
+                    msg = 'output for {} would overwrite it'.format(path)
+                    raise ValueError(msg)
+            # here, rather than in each worker.
+            os.makedirs(output_directory, exist_ok=True)
+        jobs = [(path, output_directory) for path in filepaths]
+        results = _map_in_workers(self, _transform_in_worker, jobs, workers)
+        if output_directory is not None:
+            return results
+        return pd.concat(results, ignore_index=True)
+
+    def transform_parallel(self, filepath, workers=None):
+        """
+        Transforms one file using several processes: the data rows are split
+        into byte ranges at line breaks, each range is parsed and run through
+        the leading row-local actions in its own process, and the results
+        are joined back up in order. Any actions from the first one that
+        needs every row (e.g. sum_up_by, or a clause such as t == t.max())
+        then run on the joined up result.
+
+        Assumes no quoted values span lines. Buffers, encodings such as
+        UTF-16, and formats other than csv fall back to transform.
+        """
+        if not (isinstance(filepath, six.string_types) and
+                _is_ascii_compatible(self.encoding) and
+                self.data_format == 'csv'):
+            return self.transform(filepath)
+        workers = workers or multiprocessing.cpu_count()
+        header, ranges = self._split_into_byte_ranges(filepath, workers)
+        jobs = [(filepath, header, start, end) for start, end in ranges]
+        results = _map_in_workers(self, _transform_byte_range, jobs, workers)
+        outputs = []
+        rows_before = 0
+        for rows, output_data in results:
+            # number rows as if the whole file had been read at once.
+            output_data.index = output_data.index + rows_before
+            rows_before += rows
+            outputs.append(output_data)
+        if not outputs:
+            return self.transform(filepath)
+        _, rest = self.action_list.split_row_local()
+        return rest.perform_instructions(_concat_chunks(outputs))
+
+    def transform_new_rows(self, filepath, checkpoint_path, destination=None):
+        """
+        For csv files that only grow, e.g. logs: parses and transforms only
+        the rows added since the last call with this checkpoint_path, and
+        returns their output. If an action needs every row (sum_up_by,
+        aggregate_by), or the checkpoint started over, all the output is
+        returned instead, the same as transform's. That's also the case for
+        clauses and formulas that need every row, e.g. t == t.max(), which
+        are run on every row again each time. Other actions that need every
+        row, e.g. ensure_column_is_in_this_format number (which looks at
+        every row to pick int or float), can only come after one of those,
+        or ValueError is raised.
+
+        The checkpoint holds how far the file has been read, its header, and
+        what actions that need every row kept from earlier runs: sum_up_by's
+        sums, hashes of the rows remove_duplicates kept. It starts over if
+        the spec or header changed, or the file was cut or replaced. A last
+        row without a line break is left for next time, as it may be half
+        written. It's a pickle, so it's written readable by this user only,
+        and one anyone else could have written raises ValueError.
+
+        destination: if given, a csv file to keep all the output in: the new
+            rows' output is added to its end, or it's written again when all
+            the output was returned. It's written before the checkpoint, so
+            a crash in between adds those rows again next time.
+        """
+        if (self.data_format != 'csv' or
+                not _is_ascii_compatible(self.encoding) or
+                self.number_of_rows_to_skip_at_file_end):
+            msg = ('only csv files in an ASCII compatible encoding, with no '
+                   'rows to skip at the end, can be read incrementally')
+            raise ValueError(msg)
+        rerun = self.action_list.check_new_rows()
+        if destination is not None and (self.output_format != 'csv' or
+                                        self.partition_output_by):
+            msg = 'only csv output can be added to'
+            raise ValueError(msg)
+        f, header = self._open_after_header_row(filepath)
+        try:
+            start = f.tell()
+            # every row is read again if the actions need them all.
+            checkpoint = None if rerun else _load_checkpoint(checkpoint_path)
+            if not (checkpoint and checkpoint['spec'] == self.spec and
+                    checkpoint['header'] == header and
+                    _ends_with(f, checkpoint['offset'], checkpoint['tail'])):
+                checkpoint = {'spec': self.spec, 'header': header,
+                              'offset': start, 'tail': b'', 'rows': 0,
+                              'states': None}
+            offset = checkpoint['offset']
+            end = _end_of_last_line(f, offset)
+            tail = _read_range(f, max(start, end - _TAIL_BYTES), end)
+            kwargs = self._parse_kwargs()
+            kwargs['filepath_or_buffer'] = _FileRange(f, offset, end,
+                                                      header=header)
+            input_data = pd.read_csv(**kwargs)
+        finally:
+            f.close()
+        rows = len(input_data)
+        # number rows as if the whole file had been read at once.
+        input_data.index = input_data.index + checkpoint['rows']
+        input_data = self._after_parsing(input_data)
+        if rerun:
+            output_data = self.action_list.perform_instructions(input_data)
+            whole, states = True, None
+        else:
+            output_data, whole, states = self.action_list.perform_on_new_rows(
+                input_data, checkpoint['states'])
+        if destination is not None:
+            if whole or checkpoint['states'] is None:
+                with self.open_writer(destination) as writer:
+                    writer.write(output_data)
+            elif len(output_data):
+                with io.open(destination, 'a', encoding='utf-8',
+                             newline='') as f:
+                    output_data.to_csv(f, index=False, header=False)
+        checkpoint.update(offset=end, tail=tail,
+                          rows=checkpoint['rows'] + rows, states=states)
+        _save_checkpoint(checkpoint_path, checkpoint)
         return output_data
 
     def extract(self, filepath_or_buffer):
+        if self.data_format != 'csv':
+            return _concat_chunks(self._read_chunks(filepath_or_buffer, None))
+        if self.filters_applied_while_reading:
+            chunks = self.extract_iter(filepath_or_buffer,
+                                       self.read_in_chunks_of_rows)
+            return _concat_chunks(chunks)
+        kwargs = self._read_csv_kwargs(filepath_or_buffer)
+        try:
+            input_data = pd.read_csv(**kwargs)
+        finally:
+            _close_if_opened(kwargs['filepath_or_buffer'], filepath_or_buffer)
+        # c engine doesn't support skipfooter, so we'll do manually unless the
+        # footer was already cut off before parsing.
+        if self._footer_left_to_skip(kwargs):
+            end_slice = -self.number_of_rows_to_skip_at_file_end
+            input_data = input_data.iloc[:end_slice]
+        input_data = self._after_parsing(input_data)
+        return input_data
+
+    def extract_iter(self, filepath_or_buffer, chunksize=100000):
+        if self.data_format != 'csv':
+            for input_data in self._read_chunks(filepath_or_buffer,
+                                                chunksize):
+                yield input_data
+            return
+        kwargs = self._read_csv_kwargs(filepath_or_buffer)
+        kwargs['chunksize'] = chunksize
+        reader = None
+        try:
+            reader = pd.read_csv(**kwargs)
+            chunks = iter(reader)
+            nrows = self._footer_left_to_skip(kwargs)
+            if nrows:
+                chunks = _drop_last_rows(chunks, nrows)
+            for input_data in chunks:
+                yield self._after_parsing(input_data)
+        finally:
+            if reader is not None:
+                reader.close()
+            _close_if_opened(kwargs['filepath_or_buffer'], filepath_or_buffer)
+
+    def _read_chunks(self, filepath_or_buffer, chunksize):
+        """
+        Reads a data_format other than csv, only the columns the actions
+        need, skipping what the pushed down filters rule out where the
+        format allows.
+        """
+        read = readers.reader(self.data_format)
+        formats = self.read_these_columns_in_these_formats
+        conditions = planner.conditions_on_columns(
+            self.filters_applied_while_reading)
+        chunks = read(filepath_or_buffer, chunksize=chunksize,
+                      columns=self._columns_to_load(), conditions=conditions,
+                      encoding=self.encoding,
+                      text_columns=formats.get('text', []))
+        for input_data in chunks:
+            input_data = self._apply_column_formats(input_data)
+            yield self._after_parsing(input_data)
+
+    def _apply_column_formats(self, input_data):
+        # what read_csv does with read_these_columns_in_these_formats, for
+        # formats that already have types.
+        formats = self.read_these_columns_in_these_formats
+        for col in formats.get('date', []):
+            if (col in input_data and
+                    not pd.api.types.is_datetime64_any_dtype(input_data[col])):
+                input_data[col] = pd.to_datetime(input_data[col],
+                                                 dayfirst=True)
+        for col in formats.get('text', []):
+            if col in input_data and input_data[col].dtype != object:
+                values = input_data[col]
+                input_data[col] = values.astype(str).where(values.notna())
+        return input_data
+
+    def _read_csv_kwargs(self, filepath_or_buffer, sample_dtypes=True):
+        kwargs = self._parse_kwargs()
+        kwargs['filepath_or_buffer'] = filepath_or_buffer
+        kwargs['skiprows'] = self.column_headers_are_on_row_number - 1
+        if self.read_from_row_that_starts_with:
+            f = self._open_at_header_row(filepath_or_buffer)
+            kwargs['filepath_or_buffer'] = f
+            kwargs['skiprows'] = 0
+        passed_filename = isinstance(filepath_or_buffer, six.string_types)
+        if (self.number_of_rows_to_skip_at_file_end and passed_filename and
+                _is_ascii_compatible(self.encoding)):
+            f = kwargs['filepath_or_buffer']
+            if f is filepath_or_buffer:
+                f = open(filepath_or_buffer, 'rb')
+            nrows = self.number_of_rows_to_skip_at_file_end
+            header_rows = kwargs['skiprows'] + 1
+            f = _FileRange.without_last_rows(f, nrows, header_rows)
+            kwargs['filepath_or_buffer'] = f
+        if ((self.compact_dtypes or self.string_engine == 'arrow') and
+                sample_dtypes and passed_filename):
+            # only files can be read twice, buffers are converted later.
+            dtypes = kwargs.get('dtype', {})
+            dtypes.update(self._dtypes_in_sample(filepath_or_buffer))
+            kwargs['dtype'] = dtypes
+        return kwargs
+
+    def _dtypes_in_sample(self, filepath):
+        """
+        {column: dtype} to parse columns in, from the first rows of the file:
+        'category' for the text columns we may compact that have few
+        distinct values, and Arrow strings for the other text columns with
+        string_engine arrow, so they're never whole object columns.
+        """
+        kwargs = self._read_csv_kwargs(filepath, sample_dtypes=False)
+        kwargs['nrows'] = _SAMPLE_ROWS
+        try:
+            sample = pd.read_csv(**kwargs)
+        finally:
+            _close_if_opened(kwargs['filepath_or_buffer'], filepath)
+        formats = self.read_these_columns_in_these_formats
+        text_cols = formats.get('text', [])
+        dtypes = {}
+        if self.string_engine == 'arrow':
+            converted = (set(formats.get('date', [])) |
+                         set(formats.get('number', [])))
+            for col in sample:
+                values = sample[col]
+                if (values.dtype == object and col not in converted and
+                        pd.api.types.infer_dtype(values) == 'string'):
+                    dtypes[col] = strings.ARROW_STRINGS
+        if self.compact_dtypes:
+            for col in self._columns_to_compact(sample):
+                values = sample[col]
+                if values.dtype == object or col in text_cols:
+                    if _has_few_distinct_values(values):
+                        dtypes[col] = 'category'
+        return dtypes
+
+    def _parse_kwargs(self):
+        # read_csv options for how to parse, as opposed to where to read.
         kwargs = {
-            'filepath_or_buffer': filepath_or_buffer,
-            'skiprows': self.column_headers_are_on_row_number - 1,
             'infer_datetime_format': True,
             'sep': self.column_separator,
             'encoding': self.encoding,
             'dayfirst': True,
         }
+        needed = self._columns_to_load()
         if self.read_these_columns_in_these_formats:
             if 'date' in self.read_these_columns_in_these_formats:
                 date_cols = self.read_these_columns_in_these_formats['date']
+                if needed is not None:
+                    date_cols = [col for col in date_cols if col in needed]
                 kwargs['parse_dates'] = date_cols
             if 'text' in self.read_these_columns_in_these_formats:
                 text_cols = self.read_these_columns_in_these_formats['text']
-                kwargs['dtype'] = {col: str for col in text_cols}
+                text_dtype = str
+                if self.string_engine == 'arrow':
+                    text_dtype = strings.ARROW_STRINGS
+                kwargs['dtype'] = {col: text_dtype for col in text_cols}
 
         if self.only_load_these_columns:
             kwargs['usecols'] = self.only_load_these_columns
+        elif needed is not None:
+            kwargs['usecols'] = lambda col: col in needed
+        return kwargs
+
+    def _split_into_byte_ranges(self, filepath, pieces):
+        """
+        Returns (header line, list of up to pieces (start, end) byte ranges
+        of the data rows, each ending at a line break).
+        """
+        f, header = self._open_after_header_row(filepath)
+        try:
+            start = f.tell()
+            end = os.fstat(f.fileno()).st_size
+            if self.number_of_rows_to_skip_at_file_end:
+                nrows = self.number_of_rows_to_skip_at_file_end
+                end = _find_offset_of_last_rows(f, nrows, 0)
+            if end <= start:
+                return header, []
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                bounds = [start]
+                for i in range(1, pieces):
+                    target = start + (end - start) * i // pieces
+                    line_break = mm.find(b'\n', max(target, bounds[-1]), end)
+                    if line_break == -1:
+                        break
+                    bounds.append(line_break + 1)
+            finally:
+                mm.close()
+        finally:
+            f.close()
+        bounds.append(end)
+        ranges = [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+        return header, ranges
+
+    def _open_after_header_row(self, filepath):
+        """
+        Returns (binary file positioned at the first data row, header line).
+        """
         if self.read_from_row_that_starts_with:
-            row_start = self.read_from_row_that_starts_with
-            header_row = _find_line_number_starting_with(filepath_or_buffer,
-                                                         row_start)
-            kwargs['skiprows'] = header_row - 1
+            f = self._open_at_header_row(filepath)
+        else:
+            f = open(filepath, 'rb')
+            for _ in range(self.column_headers_are_on_row_number - 1):
+                f.readline()
+        return f, f.readline()
 
-        input_data = pd.read_csv(**kwargs)
-        # c engine doesn't support skipfooter, so we'll do manually.
-        if self.number_of_rows_to_skip_at_file_end:
-            end_slice = -self.number_of_rows_to_skip_at_file_end
-            input_data = input_data.iloc[:end_slice]
+    def _after_parsing(self, input_data):
+        input_data = self._convert_number_columns(input_data)
+        # before filtering, so the types are picked from what was parsed.
+        if self.compact_dtypes:
+            input_data = self._compact_columns(input_data)
+        if self.string_engine == 'arrow':
+            # text columns read_csv wasn't told were text: from buffers, the
+            # other formats, or text after the first rows of a file.
+            input_data = strings.to_arrow_strings(input_data)
+        if self.filters_applied_while_reading:
+            filters = FilterRowAction(self.filters_applied_while_reading)
+            input_data = filters.perform_instructions(input_data)
+        return input_data
+
+    def _columns_to_compact(self, input_data):
+        """
+        Columns of input_data whose values no action reads, so storing them
+        in another type can't change what the actions do.
+        """
+        read = self.action_list.columns_read()
+        if read is None:
+            return []
+        if self.filters_applied_while_reading:
+            filters = FilterRowAction(self.filters_applied_while_reading)
+            read = read | filters.columns_read()
+        formats = self.read_these_columns_in_these_formats
+        read = read | set(formats.get('date', []))
+        read = read | set(formats.get('number', []))
+        return [col for col in input_data if col not in read]
+
+    def _compact_columns(self, input_data):
+        for col in self._columns_to_compact(input_data):
+            values = input_data[col]
+            if values.dtype == object:
+                if _has_few_distinct_values(values):
+                    input_data[col] = values.astype('category')
+            elif values.dtype.kind == 'i':
+                input_data[col] = pd.to_numeric(values, downcast='integer')
+            elif values.dtype.kind == 'f':
+                input_data[col] = _compact_floats(values)
+        return input_data
+
+    def _footer_left_to_skip(self, kwargs):
+        if isinstance(kwargs['filepath_or_buffer'], _FileRange):
+            return 0
+        return self.number_of_rows_to_skip_at_file_end
+
+    def _open_at_header_row(self, filepath_or_buffer):
+        """
+        Returns the input positioned at the start of the row that starts with
+        read_from_row_that_starts_with, so the parser reads on from there
+        rather than reading the file a second time.
+        """
+        text = self.read_from_row_that_starts_with
+        match = self.read_from_first_or_last_matching_row
+        passed_filename = isinstance(filepath_or_buffer, six.string_types)
+        if passed_filename and _is_ascii_compatible(self.encoding):
+            f = open(filepath_or_buffer, 'rb')
+            offset = _find_offset_starting_with(f, text.encode(self.encoding),
+                                                match)
+        elif passed_filename:
+            f = io.open(filepath_or_buffer, encoding=self.encoding)
+            offset = _find_line_starting_with(f, text, match)
+        else:
+            f = filepath_or_buffer
+            offset = _find_line_starting_with(f, text, match)
+        if offset is None:
+            _close_if_opened(f, filepath_or_buffer)
+            msg = 'no row starts with {!r}'.format(text)
+            raise ValueError(msg)
+        f.seek(offset)
+        return f
+
+    def _output_name(self, filepath):
+        name = os.path.basename(filepath)
+        if (self.output_format == self.data_format == 'csv' and
+                not self.partition_output_by):
+            return name
+        name = os.path.splitext(name)[0]
+        if self.partition_output_by:
+            # a directory of partitions.
+            return name
+        return name + writers.writer_class(self.output_format).extension
+
+    def _columns_to_load(self):
+        """
+        Set of columns the actions use, so the rest needn't be parsed, or
+        None if every column should be loaded.
+        """
+        if self.only_load_these_columns:
+            return set(self.only_load_these_columns)
+        needed = self.action_list.columns_needed()
+        if needed is not None and self.filters_applied_while_reading:
+            filters = FilterRowAction(self.filters_applied_while_reading)
+            needed = needed | filters.columns_read()
+        return needed
+
+    def _convert_number_columns(self, input_data):
         if 'number' in self.read_these_columns_in_these_formats:
+            needed = self._columns_to_load()
             for col in self.read_these_columns_in_these_formats['number']:
+                if needed is not None and col not in needed:
+                    continue
                 dtype = input_data[col].dtype
                 if (not np.issubdtype(dtype, int) and
                         not np.issubdtype(dtype, float)):
@@ -108,19 +743,320 @@ class Convertor:
         return input_data
 
 
-def _find_line_number_starting_with(filepath_or_buffer, text):
-    passed_filename = isinstance(filepath_or_buffer, six.string_types)
-    if passed_filename:
-        f = open(filepath_or_buffer)
-    else:
-        f = filepath_or_buffer
+def _check_json_keeps(value, where):
+    """
+    Raises ValueError if value would read back from JSON changed.
+    where: the option and keys leading to value, for the message.
+    """
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if not isinstance(key, six.string_types):
+                read_back = list(json.loads(json.dumps({key: None})))[0]
+                msg = '{}: key {!r} would be read back from a compiled ' \
+                      'spec as {!r}. Quote it in the YAML'.format(
+                          where, key, read_back)
+                raise ValueError(msg)
+            _check_json_keeps(item, '{}: {}'.format(where, key))
+    elif isinstance(value, (list, tuple)):
+        for i, item in enumerate(value):
+            _check_json_keeps(item, '{}[{}]'.format(where, i))
+    elif not (value is None or
+              isinstance(value, (bool, int, float) + six.string_types)):
+        msg = '{}: {!r} can\'t be kept in a compiled spec. Quote it in ' \
+              'the YAML'.format(where, value)
+        raise ValueError(msg)
 
-    line_number = None
-    for i, line in enumerate(f, 1):
-        if line.startswith(text):
-            line_number = i
-    if passed_filename:
+
+# the Convertor used by transform_many in this worker process.
+_worker_convertor = None
+
+
+def _start_worker(convertor):
+    global _worker_convertor
+    _worker_convertor = convertor
+
+
+def _map_in_workers(convertor, function, jobs, workers=None):
+    if workers == 1:
+        _start_worker(convertor)
+        return [function(job) for job in jobs]
+    pool = multiprocessing.Pool(workers, initializer=_start_worker,
+                                initargs=(convertor,))
+    try:
+        return pool.map(function, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _transform_byte_range(job):
+    filepath, header, start, end = job
+    convertor = _worker_convertor
+    kwargs = convertor._parse_kwargs()
+    kwargs['filepath_or_buffer'] = _FileRange(open(filepath, 'rb'), start, end,
+                                              header=header)
+    try:
+        input_data = pd.read_csv(**kwargs)
+    finally:
+        kwargs['filepath_or_buffer'].close()
+    rows = len(input_data)
+    input_data = convertor._after_parsing(input_data)
+    row_local, _ = convertor.action_list.split_row_local()
+    return rows, row_local.perform_instructions(input_data)
+
+
+def _transform_in_worker(job):
+    filepath, output_directory = job
+    if output_directory is None:
+        return _worker_convertor.transform(filepath)
+    output_path = os.path.join(output_directory,
+                               _worker_convertor._output_name(filepath))
+    _worker_convertor.save(filepath, output_path)
+    return output_path
+
+
+def _same_file(path, other_path):
+    if os.path.exists(path) and os.path.exists(other_path):
+        # also catches hard links.
+        return os.path.samefile(path, other_path)
+    return os.path.realpath(path) == os.path.realpath(other_path)
+
+
+def _concat_chunks(chunks):
+    """
+    One DataFrame from chunks, leaving out empty chunks so they don't affect
+    the column types.
+    """
+    first = None
+    kept = []
+    for chunk in chunks:
+        if first is None:
+            first = chunk
+        if len(chunk):
+            kept.append(chunk)
+    if kept:
+        _share_categories(kept)
+        return pd.concat(kept)
+    return first
+
+
+def _share_categories(chunks):
+    # concat turns categorical columns into text unless every chunk has the
+    # same categories.
+    for col in chunks[0]:
+        values = [chunk[col] for chunk in chunks if col in chunk]
+        if (len(values) < 2 or
+                not all(isinstance(v.dtype, pd.CategoricalDtype)
+                        for v in values)):
+            continue
+        categories = pd.api.types.union_categoricals(values).categories
+        for chunk in chunks:
+            chunk[col] = chunk[col].cat.set_categories(categories)
+
+
+def _has_few_distinct_values(values):
+    # worth a category if each value is repeated twice on average.
+    return values.nunique() * 2 <= values.count()
+
+
+def _compact_floats(values):
+    """
+    values as float32 if that holds every value exactly, otherwise values
+    unchanged. Whole numbers stay floats, so they're still written as 1.0.
+    """
+    narrowed = values.astype(np.float32)
+    if ((narrowed == values) | values.isna()).all():
+        return narrowed
+    return values
+
+
+# bytes before a checkpoint's offset kept to tell if the file was replaced.
+_TAIL_BYTES = 256
+
+
+def _load_checkpoint(checkpoint_path):
+    try:
+        f = open(checkpoint_path, 'rb')
+    except (IOError, OSError):
+        return None
+    with f:
+        # as unpickling it can run code.
+        check_private(checkpoint_path)
+        return pickle.load(f)
+
+
+def _save_checkpoint(checkpoint_path, checkpoint):
+    # written aside then moved, so a crash never leaves half a checkpoint.
+    write_aside(checkpoint_path, lambda f: pickle.dump(
+        checkpoint, f, pickle.HIGHEST_PROTOCOL))
+
+
+def _read_range(f, start, end):
+    f.seek(start)
+    return f.read(end - start)
+
+
+def _ends_with(f, offset, tail):
+    # True if the file is still offset long at least, with tail before it.
+    size = os.fstat(f.fileno()).st_size
+    if offset > size:
+        return False
+    return _read_range(f, offset - len(tail), offset) == tail
+
+
+def _end_of_last_line(f, start):
+    """
+    Offset just after the last line break from start on, or start if none.
+    """
+    size = os.fstat(f.fileno()).st_size
+    if size <= start:
+        return start
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return mm.rfind(b'\n', start, size) + 1 or start
+    finally:
+        mm.close()
+
+
+def _drop_last_rows(chunks, nrows):
+    """
+    Yield chunks minus the last nrows rows of the whole stream, holding back
+    just enough rows to know where the stream ends.
+    """
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            chunk = pd.concat([pending, chunk])
+        pending = chunk.iloc[-nrows:]
+        if len(chunk) > nrows:
+            yield chunk.iloc[:-nrows]
+
+
+def _is_ascii_compatible(encoding):
+    return '\n,'.encode(encoding) == b'\n,'
+
+
+def _close_if_opened(f, filepath_or_buffer):
+    # only close files we opened, not buffers the caller passed in.
+    if f is not filepath_or_buffer:
         f.close()
-    else:
-        f.seek(0)
-    return line_number
+
+
+class _FileRange(io.RawIOBase):
+    """
+    Read-only view of the bytes [start, end) of a file opened in binary mode,
+    so the parser never sees anything outside that range.
+    """
+    def __init__(self, f, start, end, header=b''):
+        # header: bytes to read before the range, e.g. the column names.
+        self.f = f
+        self.start = start
+        self.end = end
+        self.header = header
+        self.f.seek(start)
+
+    @classmethod
+    def without_last_rows(cls, f, nrows, header_rows=1):
+        """
+        The range from the current position of f up to the start of its last
+        nrows non-blank lines.
+        """
+        start = f.tell()
+        end = _find_offset_of_last_rows(f, nrows, header_rows)
+        return cls(f, start, end)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.header:
+            n = min(len(b), len(self.header))
+            b[:n] = self.header[:n]
+            self.header = self.header[n:]
+            return n
+        remaining = self.end - self.f.tell()
+        if remaining <= 0:
+            return 0
+        data = self.f.read(min(len(b), remaining))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.f.close()
+        super(_FileRange, self).close()
+
+
+def _find_offset_of_last_rows(f, nrows, header_rows=1):
+    """
+    f: file opened in binary mode.
+    Returns the byte offset where the last nrows non-blank lines of f start,
+    found by searching back from the end of the file. Never cuts into the
+    first header_rows lines from the current position of f.
+    """
+    start = f.tell()
+    size = os.fstat(f.fileno()).st_size
+    if size == start:
+        return size
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        header_end = start
+        for _ in range(header_rows):
+            header_end = mm.find(b'\n', header_end) + 1 or size
+        end = size
+        counted = 0
+        while counted < nrows and end > header_end:
+            i = mm.rfind(b'\n', header_end, end - 1)
+            line_start = i + 1 if i != -1 else header_end
+            if mm[line_start:end].strip(b'\r\n'):
+                counted += 1
+            end = line_start
+    finally:
+        mm.close()
+    return end
+
+
+def _find_offset_starting_with(f, text, match='last'):
+    """
+    f: file opened in binary mode.
+    Returns the byte offset of the first or last line starting with text,
+    found by searching the memory-mapped file, or None.
+    """
+    if os.fstat(f.fileno()).st_size == 0:
+        return None
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        at_start = mm[:len(text)] == text
+        if match == 'first':
+            if at_start:
+                return 0
+            i = mm.find(b'\n' + text)
+        else:
+            i = mm.rfind(b'\n' + text)
+            if i == -1 and at_start:
+                return 0
+        if i == -1:
+            return None
+        return i + 1
+    finally:
+        mm.close()
+
+
+def _find_line_starting_with(f, text, match='last'):
+    """
+    f: file or buffer opened in text mode.
+    Returns the position (as given by f.tell()) of the first or last line
+    starting with text, or None. Stops reading at the first match if
+    match == 'first'.
+    """
+    offset = None
+    position = f.tell()
+    line = f.readline()
+    while line:
+        if line.startswith(text):
+            offset = position
+            if match == 'first':
+                break
+        position = f.tell()
+        line = f.readline()
+    return offset
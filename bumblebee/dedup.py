@@ -0,0 +1,113 @@
+"""
+Telling rows seen before from new ones, a chunk at a time, by 64-bit
+hashes of their values rather than the values themselves.
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+def row_hashes(input_data, columns=None):
+    """
+    64-bit hash of each row's values in columns (default every column).
+    Equal values hash the same whatever the column's type in the chunk,
+    e.g. 1 in an int column and 1.0 in a float column with gaps.
+    """
+    columns = columns or list(input_data.columns)
+    hashes = np.zeros(len(input_data), dtype=np.uint64)
+    for column in columns:
+        # wraps around on overflow, which is fine for mixing hashes.
+        hashes = hashes * np.uint64(1000003) ^ _column_hashes(
+            input_data[column])
+    return hashes
+
+
+def _column_hashes(values):
+    if pd.api.types.is_bool_dtype(values) and not values.hasnans:
+        values = values.astype(np.int64)
+    if pd.api.types.is_integer_dtype(values) and not values.hasnans:
+        return pd.util.hash_array(values.values.astype(np.int64))
+    if pd.api.types.is_numeric_dtype(values):
+        numbers = values.astype(np.float64).values
+        hashes = pd.util.hash_array(numbers)
+        whole = (np.isfinite(numbers) & (numbers == np.floor(numbers)) &
+                 (np.abs(numbers) < 2.0 ** 63))
+        hashes[whole] = pd.util.hash_array(numbers[whole].astype(np.int64))
+        return hashes
+    return pd.util.hash_pandas_object(values, index=False).values
+
+
+class SeenKeys:
+    """
+    Set of 64-bit hashes, kept as sorted arrays. Arrays are merged as they
+    grow, so there are only a few to search. Once they take more than
+    max_bytes, they're merged into one written to a memory mapped file in
+    spill_directory (default: a temporary directory), so the set can grow
+    beyond memory. Call close() to delete the files.
+
+    duplicates counts the hashes passed to add that were seen before.
+    """
+    def __init__(self, max_bytes=None, spill_directory=None):
+        self.max_bytes = max_bytes
+        self.spill_directory = spill_directory
+        self.in_memory = []
+        self.spilled = []
+        self.duplicates = 0
+        self._directory = None
+
+    def __len__(self):
+        return sum(len(run) for run in self.in_memory + self.spilled)
+
+    def add(self, hashes):
+        """
+        Adds hashes, returning a mask of those not seen before, counting
+        only the first of any repeated among them as not seen.
+        """
+        unique, first = np.unique(hashes, return_index=True)
+        is_new = np.ones(len(unique), dtype=bool)
+        for run in self.in_memory + self.spilled:
+            if len(run):
+                positions = np.searchsorted(run, unique)
+                positions = np.minimum(positions, len(run) - 1)
+                is_new &= run[positions] != unique
+        keep = np.zeros(len(hashes), dtype=bool)
+        keep[first[is_new]] = True
+        self.duplicates += len(hashes) - int(keep.sum())
+        self._add_run(unique[is_new])
+        return keep
+
+    def close(self):
+        if self._directory is not None:
+            self.spilled = []
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+    def _add_run(self, run):
+        self.in_memory.append(run)
+        # merge runs of similar size, so there are only log(n) of them.
+        while (len(self.in_memory) > 1 and
+               len(self.in_memory[-2]) <= len(self.in_memory[-1])):
+            last = self.in_memory.pop()
+            self.in_memory[-1] = np.sort(np.concatenate([self.in_memory[-1],
+                                                         last]))
+        in_memory_bytes = sum(run.nbytes for run in self.in_memory)
+        if self.max_bytes is not None and in_memory_bytes > self.max_bytes:
+            run = np.sort(np.concatenate(self.in_memory))
+            self.spilled.append(self._spill(run))
+            self.in_memory = []
+
+    def _spill(self, run):
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix='bumblebee-dedup-',
+                                               dir=self.spill_directory)
+        path = os.path.join(self._directory,
+                            'run-{}.u64'.format(len(self.spilled)))
+        spilled = np.memmap(path, dtype=np.uint64, mode='w+',
+                            shape=(len(run),))
+        spilled[:] = run
+        spilled.flush()
+        del spilled
+        return np.memmap(path, dtype=np.uint64, mode='r', shape=(len(run),))
@@ -0,0 +1,93 @@
+"""
+Loading with reading, transforming and writing overlapped: while one chunk
+is transformed, the next is read and parsed and the one before is written.
+Each stage runs in its own thread, driven by asyncio, with bounded queues
+between them so a slow stage holds the others back rather than letting
+chunks pile up in memory.
+"""
+import asyncio
+import itertools
+
+# marks the end of a queue's chunks.
+_DONE = object()
+
+
+def load_pipelined(convertor, filepaths, destination, queue_size=2):
+    """
+    Like Convertor.load on the files read one after the other as if they
+    were one (see transform_many_iter), but with its stages overlapped.
+
+    queue_size: chunks that can wait between one stage and the next.
+    """
+    return asyncio.run(load_async(convertor, filepaths, destination,
+                                  queue_size))
+
+
+async def load_async(convertor, filepaths, destination, queue_size=2):
+    """
+    load_pipelined, for callers already running an event loop.
+    """
+    loop = asyncio.get_running_loop()
+    parsed = asyncio.Queue(queue_size)
+    transformed = asyncio.Queue(queue_size)
+    chunksize = convertor.read_in_chunks_of_rows
+    chunks = itertools.chain.from_iterable(
+        convertor.extract_iter(filepath, chunksize) for filepath in filepaths)
+
+    def queued_chunks():
+        # run in the transform thread, so wait on the loop for each chunk.
+        while True:
+            chunk = asyncio.run_coroutine_threadsafe(parsed.get(),
+                                                     loop).result()
+            if chunk is _DONE:
+                return
+            yield chunk
+
+    outputs = convertor.action_list.perform_on_chunks(queued_chunks())
+    with convertor.open_writer(destination) as writer:
+        stages = [
+            asyncio.ensure_future(_pass_on(loop, chunks, parsed)),
+            asyncio.ensure_future(_pass_on(loop, outputs, transformed)),
+            asyncio.ensure_future(_write(loop, transformed, writer)),
+        ]
+        try:
+            await _run_stages(stages)
+        finally:
+            # so a thread waiting on a stage that failed can finish.
+            for queue in [parsed, transformed]:
+                _end(queue)
+
+
+async def _pass_on(loop, iterator, queue):
+    """
+    Puts each item of iterator, got in a thread, on queue, then _DONE.
+    """
+    while True:
+        item = await loop.run_in_executor(None, next, iterator, _DONE)
+        await queue.put(item)
+        if item is _DONE:
+            return
+
+
+async def _write(loop, queue, writer):
+    while True:
+        output_data = await queue.get()
+        if output_data is _DONE:
+            return
+        await loop.run_in_executor(None, writer.write, output_data)
+
+
+async def _run_stages(stages):
+    done, pending = await asyncio.wait(stages,
+                                       return_when=asyncio.FIRST_EXCEPTION)
+    for stage in pending:
+        stage.cancel()
+    for stage in done:
+        # raises the stage's exception, if it failed.
+        stage.result()
+
+
+def _end(queue):
+    while not queue.empty():
+        queue.get_nowait()
+    queue.put_nowait(_DONE)
@@ -0,0 +1,238 @@
+"""
+Rewrites a list of actions into one that gives the same output for less work.
+
+Used by Transformer(list_of_actions, optimize=True).
+"""
+import ast
+import io
+import tokenize
+
+
+def plan(actions):
+    actions = _split(actions)
+    actions = _remove_unused_work(actions)
+    actions = _filter_rows_early(actions)
+    actions = _merge_neighbours(actions)
+    return actions
+
+
+def _split(actions):
+    # one instruction per action, so each can be moved or dropped by itself.
+    split_actions = []
+    for action in actions:
+        split_actions.extend(action.split())
+    return split_actions
+
+
+def _remove_unused_work(actions):
+    """
+    Drops actions whose result columns are thrown away (e.g. by
+    only_keep_these_columns or remove_columns) before anything reads them.
+    """
+    needed = None
+    # column: the remove_columns action that drops it before anything after
+    # this point reads it.
+    removed = {}
+    kept = []
+    for action in reversed(actions):
+        if action.only_sets_columns:
+            written = action.columns_written()
+            used = written - set(removed)
+            if needed is not None:
+                used &= needed
+            if not used:
+                # the column may now not be there to remove.
+                for col in written & set(removed):
+                    removed[col].may_be_missing.add(col)
+                continue
+        needed = action.columns_needed_before(needed)
+        kept.append(action)
+        removed_columns = getattr(action, 'removed_columns', None)
+        if removed_columns is not None:
+            removed.update(dict.fromkeys(removed_columns(), action))
+            continue
+        read = action.columns_read()
+        written = action.columns_written()
+        if read is None or written is None:
+            removed = {}
+        else:
+            for col in read | written:
+                removed.pop(col, None)
+    kept.reverse()
+    return kept
+
+
+def _filter_rows_early(actions):
+    """
+    Moves only_keep_rows_where clauses ahead of the actions before them, as
+    far as the columns they depend on allow, so those actions see fewer rows.
+    """
+    planned = []
+    for action in actions:
+        position = len(planned)
+        if action.filters_rows:
+            names = action.columns_read()
+            while position:
+                if not _can_filter_before(planned[position - 1], names):
+                    break
+                position -= 1
+        planned.insert(position, action)
+    return planned
+
+
+def _can_filter_before(action, names):
+    # only past actions that are row-wise, e.g. not c = a - a.mean(), whose
+    # values would change with fewer rows.
+    if names is None or action.filters_rows or not action.row_local:
+        return False
+    if action.only_sets_columns:
+        return not action.columns_written() & names
+    if action.only_removes_columns:
+        return True
+    renamed_columns = getattr(action, 'renamed_columns', None)
+    if renamed_columns is not None:
+        renames = renamed_columns()
+        return not names & (set(renames) | set(renames.values()))
+    return False
+
+
+def _merge_neighbours(actions):
+    # e.g. two rename_column steps in a row become one.
+    merged = []
+    for action in actions:
+        if merged:
+            combined = merged[-1].merge(action)
+            if combined is not None:
+                merged[-1] = combined
+                continue
+        merged.append(action)
+    return merged
+
+
+def take_filters_for_reading(actions):
+    """
+    Takes the only_keep_rows_where clauses that are simple comparisons on
+    input columns, so they can be run on each chunk as the file is read.
+    Returns (list of clauses, list of the actions left to run).
+    """
+    clauses = []
+    remaining = []
+    # once a clause depends on every row (e.g. t == t.max()), the ones after
+    # it must see only the rows it kept, so stay where they are.
+    whole_table_clause_seen = False
+    for action in actions:
+        if not action.filters_rows:
+            remaining.append(action)
+            continue
+        kept = []
+        for clause in action.instructions:
+            simple = _is_simple_comparison(clause)
+            names = type(action)([clause]).columns_read()
+            earlier = [a for a in remaining if not a.filters_rows]
+            if (simple and not whole_table_clause_seen and
+                    all(_can_filter_before(a, names) for a in earlier)):
+                clauses.append(clause)
+            else:
+                kept.append(clause)
+            whole_table_clause_seen = whole_table_clause_seen or not simple
+        if kept:
+            remaining.append(type(action)(kept))
+    return clauses, remaining
+
+
+def conditions_on_columns(clauses):
+    """
+    List of (column, operator, value) conditions, e.g. ('temp', '>', 10),
+    that every row kept by the clauses meets, for skipping parts of a file
+    that can't match. Parts of clauses that aren't a plain and of
+    comparisons are left out, so rows meeting the conditions still need
+    the clauses run on them.
+    """
+    conditions = []
+    for clause in clauses:
+        tree = _parse_clause(clause)
+        if tree is not None:
+            conditions.extend(_conditions_in(tree))
+    return conditions
+
+
+_OPERATORS = {ast.Eq: '==', ast.NotEq: '!=', ast.Lt: '<', ast.LtE: '<=',
+              ast.Gt: '>', ast.GtE: '>=', ast.In: 'in', ast.NotIn: 'not in'}
+# a < b is b > a.
+_FLIPPED = {'==': '==', '!=': '!=', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+
+def _conditions_in(node):
+    conditions = []
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        for value in node.values:
+            conditions.extend(_conditions_in(value))
+    elif isinstance(node, ast.Compare):
+        operands = [node.left] + node.comparators
+        for left, op, right in zip(operands, node.ops, operands[1:]):
+            op = _OPERATORS.get(type(op))
+            if op is None:
+                continue
+            if isinstance(left, ast.Name) and _is_literal(right):
+                conditions.append((left.id, op, ast.literal_eval(right)))
+            elif (isinstance(right, ast.Name) and _is_literal(left) and
+                    op in _FLIPPED):
+                conditions.append((right.id, _FLIPPED[op],
+                                   ast.literal_eval(left)))
+    return conditions
+
+
+_COMPARISONS = (ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+                ast.In, ast.NotIn)
+
+
+def _is_simple_comparison(clause):
+    """
+    True for e.g. "state == 'VIC' & 10 < temp", comparisons of columns with
+    literal values joined by and/or.
+    """
+    tree = _parse_clause(clause)
+    return tree is not None and _is_simple_node(tree)
+
+
+def _parse_clause(clause):
+    """
+    The Python expression tree of a query clause, or None if it isn't one.
+    """
+    # query gives & and | the precedence of and/or. Only operators are
+    # swapped, not the same characters in text, e.g. name == 'A&B'.
+    words = {'&': 'and', '|': 'or'}
+    try:
+        tokens = []
+        readline = io.StringIO(clause.strip()).readline
+        for token in tokenize.generate_tokens(readline):
+            text = token.string
+            if token.type == tokenize.OP and text in words:
+                tokens.append((tokenize.NAME, words[text]))
+            else:
+                tokens.append((token.type, text))
+        return ast.parse(tokenize.untokenize(tokens), mode='eval').body
+    except (SyntaxError, tokenize.TokenError):
+        return None
+
+
+def _is_simple_node(node):
+    if isinstance(node, ast.BoolOp):
+        return all(_is_simple_node(value) for value in node.values)
+    if isinstance(node, ast.Compare):
+        if not all(isinstance(op, _COMPARISONS) for op in node.ops):
+            return False
+        operands = [node.left] + node.comparators
+        if not any(isinstance(operand, ast.Name) for operand in operands):
+            return False
+        return all(isinstance(operand, ast.Name) or _is_literal(operand)
+                   for operand in operands)
+    return False
+
+
+def _is_literal(node):
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return all(_is_literal(element) for element in node.elts)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return _is_literal(node.operand)
+    return isinstance(node, ast.Constant)
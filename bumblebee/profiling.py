@@ -0,0 +1,81 @@
+import json
+import time
+
+import pandas as pd
+
+
+class Profiler:
+    """
+    Records how long each step of a transform took and what it did to the
+    data. Pass to Transformer.perform_instructions, or set as
+    Convertor.profiler.
+
+    steps: list of dicts, one per step run, with keys
+        step: 'extract', or the class of the action
+        index: position in the list of actions, None for extract
+        wall_seconds, cpu_seconds
+        rows_in, rows_out: None where the input isn't a DataFrame
+        columns_added, columns_removed: lists of column names
+        memory_change_bytes: output's size less the input's, not counting
+            what text columns point to
+    callback: if given, called with each step's dict as it's recorded,
+        e.g. to send it to a metrics system.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.steps = []
+
+    def run(self, step, index, function, input_data):
+        """
+        Returns function(input_data), recording it as step.
+        """
+        # before running, as actions may change their input in place.
+        columns_in = _columns(input_data)
+        rows_in = _rows(input_data)
+        size_in = _size(input_data)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        output_data = function(input_data)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        columns_out = _columns(output_data)
+        record = {
+            'step': step,
+            'index': index,
+            'wall_seconds': wall,
+            'cpu_seconds': cpu,
+            'rows_in': rows_in,
+            'rows_out': _rows(output_data),
+            'columns_added': [c for c in columns_out if c not in columns_in],
+            'columns_removed': [c for c in columns_in
+                                if c not in columns_out],
+            'memory_change_bytes': _size(output_data) - size_in,
+        }
+        self.steps.append(record)
+        if self.callback is not None:
+            self.callback(record)
+        return output_data
+
+    def total_seconds(self):
+        return sum(step['wall_seconds'] for step in self.steps)
+
+    def to_json(self, **kwargs):
+        # column names can be numbers etc., so make them text.
+        return json.dumps(self.steps, default=str, **kwargs)
+
+
+def _rows(data):
+    if isinstance(data, pd.DataFrame):
+        return len(data)
+    return None
+
+
+def _columns(data):
+    if isinstance(data, pd.DataFrame):
+        return list(data.columns)
+    return []
+
+
+def _size(data):
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(index=True, deep=False).sum())
+    return 0
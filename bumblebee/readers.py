@@ -0,0 +1,157 @@
+import pandas as pd
+import six
+
+
+class UnknownDataFormatError(Exception):
+    pass
+
+
+def reader(data_format):
+    """
+    Returns the function reading data_format, other than csv, which the
+    Convertor reads itself. Each is called as
+        read(filepath_or_buffer, chunksize=None, columns=None, conditions=(),
+             encoding='utf-8', text_columns=())
+    and returns an iterator of DataFrames, of chunksize rows, or just one
+    if chunksize is None.
+        columns: set of columns to read, None for all.
+        conditions: (column, operator, value) conditions every wanted row
+            meets, as from planner.conditions_on_columns. Readers may use
+            them to skip data, but needn't drop every row not meeting them.
+        text_columns: columns to read as text, rather than guess the type.
+    """
+    readers = {
+        'parquet': read_parquet,
+        'feather': read_feather,
+        'jsonl': read_json_lines,
+    }
+    try:
+        return readers[data_format]
+    except KeyError:
+        msg = 'data format {} unknown'.format(data_format)
+        raise UnknownDataFormatError(msg)
+
+
+def read_parquet(filepath_or_buffer, chunksize=None, columns=None,
+                 conditions=(), encoding='utf-8', text_columns=()):
+    """
+    Only reads the columns wanted, from the row groups whose min/max
+    statistics show they could have rows meeting the conditions.
+    """
+    _import_pyarrow()
+    import pyarrow.parquet
+    parquet_file = pyarrow.parquet.ParquetFile(filepath_or_buffer)
+    try:
+        names = _columns_in(parquet_file.schema_arrow.names, columns)
+        row_groups = [i for i in range(parquet_file.num_row_groups)
+                      if _row_group_could_match(parquet_file.metadata, i,
+                                                conditions)]
+        if not row_groups:
+            empty = parquet_file.schema_arrow.empty_table().select(names)
+            yield empty.to_pandas()
+        elif chunksize is None:
+            table = parquet_file.read_row_groups(row_groups, columns=names)
+            yield table.to_pandas()
+        else:
+            batches = parquet_file.iter_batches(chunksize, row_groups, names)
+            for batch in batches:
+                yield batch.to_pandas()
+    finally:
+        parquet_file.close()
+
+
+def read_feather(filepath_or_buffer, chunksize=None, columns=None,
+                 conditions=(), encoding='utf-8', text_columns=()):
+    """
+    Files are memory mapped, so only the columns and chunks converted to
+    DataFrames are read into memory, if the file isn't compressed.
+    """
+    _import_pyarrow()
+    import pyarrow.feather
+    memory_map = isinstance(filepath_or_buffer, six.string_types)
+    table = pyarrow.feather.read_table(filepath_or_buffer,
+                                       memory_map=memory_map)
+    table = table.select(_columns_in(table.column_names, columns))
+    if chunksize is None:
+        yield table.to_pandas()
+        return
+    for batch in table.to_batches(max_chunksize=chunksize):
+        yield batch.to_pandas()
+
+
+def read_json_lines(filepath_or_buffer, chunksize=None, columns=None,
+                    conditions=(), encoding='utf-8', text_columns=()):
+    """
+    One JSON object per line, each a row.
+    """
+    kwargs = {
+        'lines': True,
+        'encoding': encoding,
+        'dtype': dict((col, str) for col in text_columns) or True,
+        # like read_csv, only read dates when asked to.
+        'convert_dates': False,
+    }
+    if chunksize is None:
+        chunks = [pd.read_json(filepath_or_buffer, **kwargs)]
+    else:
+        chunks = pd.read_json(filepath_or_buffer, chunksize=chunksize,
+                              **kwargs)
+    try:
+        for input_data in chunks:
+            if columns is not None:
+                input_data = input_data.loc[:, _columns_in(input_data,
+                                                           columns)]
+            yield input_data
+    finally:
+        if chunksize is not None:
+            chunks.close()
+
+
+def _columns_in(names, columns):
+    # names in their order in the file.
+    return [name for name in names if columns is None or name in columns]
+
+
+def _row_group_could_match(metadata, i, conditions):
+    row_group = metadata.row_group(i)
+    statistics = {}
+    for j in range(row_group.num_columns):
+        column = row_group.column(j)
+        if column.statistics is not None and column.statistics.has_min_max:
+            statistics[column.path_in_schema] = column.statistics
+    for name, op, value in conditions:
+        if name not in statistics:
+            continue
+        lowest, highest = statistics[name].min, statistics[name].max
+        try:
+            if not _range_could_match(lowest, highest, op, value):
+                return False
+        except TypeError:
+            # e.g. comparing text to a number, so we can't tell.
+            continue
+    return True
+
+
+def _range_could_match(lowest, highest, op, value):
+    if op == '==':
+        return lowest <= value <= highest
+    if op == '<':
+        return lowest < value
+    if op == '<=':
+        return lowest <= value
+    if op == '>':
+        return highest > value
+    if op == '>=':
+        return highest >= value
+    if op == 'in':
+        return any(lowest <= v <= highest for v in value)
+    return True
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        msg = 'reading parquet or feather needs pyarrow: pip install pyarrow'
+        raise ImportError(msg)
+    return pyarrow
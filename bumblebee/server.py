@@ -0,0 +1,191 @@
+"""
+Serving transforms to other processes over a local socket, so each job
+doesn't pay for starting Python, importing pandas and reading its spec.
+
+Jobs are JSON objects, one per line:
+    {"input": path, "spec": name, "output": path}
+spec being the name of a spec file in the server's directory, without its
+extension, and optionally "stream": true to transform the input a chunk at
+a time, as bb_etl.py --stream does. Each gets a JSON line back:
+    {"ok": true, "output": path, "seconds": ...}
+or {"ok": false, "error": message}.
+
+Nothing here imports pandas until a spec is loaded, so clients start fast.
+
+Jobs run as the server's user. A Unix socket is only open to who its file
+permissions allow, but any local user can connect to a TCP port, so give
+make_server input_root and output_root to limit the files jobs can read
+and write.
+"""
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# YAML, or compiled by Convertor.compile.
+_SPEC_EXTENSIONS = ('.yaml', '.yml', '.bbc')
+
+
+class UnknownSpecError(Exception):
+    pass
+
+
+class PathNotAllowedError(Exception):
+    pass
+
+
+class SpecStore:
+    """
+    Convertors for the spec files in directory, by name. Each is read when
+    first asked for, and read again when its file changes.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        path = self._path(name)
+        stat = os.stat(path)
+        fingerprint = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            loaded = self._loaded.get(name)
+        if loaded is not None and loaded[0] == fingerprint:
+            return loaded[1]
+        from .core import Convertor
+        convertor = Convertor.from_spec_file(path)
+        with self._lock:
+            self._loaded[name] = (fingerprint, convertor)
+        return convertor
+
+    def _path(self, name):
+        # just a name, so jobs can't point at files outside directory.
+        if name and os.path.basename(name) == name:
+            for extension in _SPEC_EXTENSIONS:
+                path = os.path.join(self.directory, name + extension)
+                if os.path.exists(path):
+                    return path
+        msg = 'no spec {} in {}'.format(name, self.directory)
+        raise UnknownSpecError(msg)
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # a connection can send several jobs, answered in order.
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.run_job(line)
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class _JobServer(socketserver.ThreadingMixIn):
+    """
+    Reads jobs on a thread per connection, and runs them in a pool of
+    worker threads, so only that many run at once.
+    """
+    daemon_threads = True
+
+    def start_jobs(self, spec_directory, workers=None, input_root=None,
+                   output_root=None):
+        self.specs = SpecStore(spec_directory)
+        self.input_root = input_root
+        self.output_root = output_root
+        self.pool = ThreadPoolExecutor(workers or multiprocessing.cpu_count())
+
+    def run_job(self, line):
+        return self.pool.submit(_run_job, self, line).result()
+
+    def server_close(self):
+        super(_JobServer, self).server_close()
+        self.pool.shutdown()
+
+
+class _UnixServer(_JobServer, socketserver.UnixStreamServer):
+    def server_close(self):
+        super(_UnixServer, self).server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class _TCPServer(_JobServer, socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+def make_server(spec_directory, address, workers=None, input_root=None,
+                output_root=None):
+    """
+    Returns a server for the specs in spec_directory, listening on address:
+    the path of a Unix socket, or a (host, port) pair. Call serve_forever to
+    run it, and server_close when done.
+
+    workers: jobs run at once, defaults to the number of CPUs. Jobs run in
+        threads, pandas letting go of the GIL for much of its work.
+    input_root, output_root: if given, jobs may only read files in, and
+        write files in, these directories (after following links).
+        Otherwise any file the server's user can read or write, which
+        over TCP means any local user can have the server do so.
+    """
+    if isinstance(address, tuple):
+        server = _TCPServer(address, _JobHandler)
+    else:
+        server = _UnixServer(address, _JobHandler)
+    server.start_jobs(spec_directory, workers, input_root, output_root)
+    return server
+
+
+def submit(address, input_path, spec, output_path, stream=False):
+    """
+    Sends a job to the server at address, returning its response. Paths
+    are made absolute, as the server's working directory may differ.
+    """
+    job = {
+        'input': os.path.abspath(input_path),
+        'spec': spec,
+        'output': os.path.abspath(output_path),
+        'stream': stream,
+    }
+    if isinstance(address, tuple):
+        connection = socket.create_connection(address)
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(address)
+    with connection:
+        connection.sendall(json.dumps(job).encode('utf-8') + b'\n')
+        with connection.makefile('rb') as f:
+            return json.loads(f.readline().decode('utf-8'))
+
+
+def _run_job(server, line):
+    start = time.time()
+    try:
+        job = json.loads(line.decode('utf-8'))
+        _check_path(job['input'], server.input_root)
+        _check_path(job['output'], server.output_root)
+        convertor = server.specs.get(job['spec'])
+        # as bb_etl.py does, so output is the same from both.
+        if job.get('stream'):
+            convertor.load(job['input'], job['output'])
+        else:
+            convertor.save(job['input'], job['output'])
+    except Exception as e:
+        # tell the client, rather than dropping the connection.
+        error = '{}: {}'.format(type(e).__name__, e)
+        return {'ok': False, 'error': error}
+    return {'ok': True, 'output': job['output'],
+            'seconds': time.time() - start}
+
+
+def _check_path(path, root):
+    if root is None:
+        return
+    root = os.path.realpath(root)
+    # links are followed, so they can't lead out of root.
+    real_path = os.path.realpath(path)
+    if os.path.commonpath([root, real_path]) != root:
+        msg = '{} isn\'t in {}'.format(path, root)
+        raise PathNotAllowedError(msg)
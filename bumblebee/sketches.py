@@ -0,0 +1,109 @@
+"""
+Small summaries of a group's values that can be merged, so approximate
+distinct counts and quantiles can be worked out a chunk at a time.
+
+Both take ids, the group number (0 to n - 1) of each value.
+"""
+import numpy as np
+import pandas as pd
+
+# HyperLogLog registers per group, 2 ** _HLL_BITS of them: about 3%
+# standard error on distinct counts, for 1KB per group.
+_HLL_BITS = 10
+# quantiles are within 1% of a value of the right rank.
+_RELATIVE_ACCURACY = 0.01
+_GAMMA = (1 + _RELATIVE_ACCURACY) / (1 - _RELATIVE_ACCURACY)
+
+
+def distinct_registers(ids, values, n):
+    """
+    HyperLogLog registers for the values of each of the n groups, an
+    (n, 1024) array. Merge by taking the maximum, see merge_registers.
+    """
+    present = values.notna().values
+    ids, values = ids[present], values[present]
+    if pd.api.types.is_numeric_dtype(values):
+        # so 1 and 1.0 count as the same value, whatever the chunk's type.
+        values = values.astype(np.float64)
+    hashes = pd.util.hash_pandas_object(values, index=False).values
+    register = (hashes >> np.uint64(64 - _HLL_BITS)).astype(np.intp)
+    # a 1 bit on the end, so ranks stop at 64 - _HLL_BITS + 1.
+    rest = (hashes << np.uint64(_HLL_BITS)) | np.uint64(1 << (_HLL_BITS - 1))
+    rank = (65 - _bit_length(rest)).astype(np.uint8)
+    registers = np.zeros((n, 2 ** _HLL_BITS), dtype=np.uint8)
+    np.maximum.at(registers, (ids, register), rank)
+    return registers
+
+
+def merge_registers(ids, registers, n):
+    """
+    ids: the group each row of registers now belongs to.
+    """
+    merged = np.zeros((n, registers.shape[1]), dtype=np.uint8)
+    np.maximum.at(merged, ids, registers)
+    return merged
+
+
+def distinct_count(registers):
+    m = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(2.0 ** -registers.astype(float), axis=1)
+    # few values: count the empty registers instead, it's more accurate.
+    empty = (registers == 0).sum(axis=1)
+    small = (estimate <= 2.5 * m) & (empty > 0)
+    estimate[small] = m * np.log(m / empty[small].astype(float))
+    return np.round(estimate).astype(np.int64)
+
+
+def quantile_buckets(ids, values):
+    """
+    DataFrame of (group, sign, bucket, count): how many of each group's
+    values fall in each bucket, the buckets growing exponentially in size
+    away from 0 (as in DDSketch). Merge by adding up counts, see
+    merge_buckets.
+    """
+    values = pd.to_numeric(values)
+    present = values.notna().values
+    ids, values = ids[present], values.values[present].astype(float)
+    sign = np.sign(values).astype(np.int8)
+    magnitude = np.abs(values)
+    bucket = np.zeros(len(values), dtype=np.int64)
+    nonzero = sign != 0
+    bucket[nonzero] = np.ceil(np.log(magnitude[nonzero]) / np.log(_GAMMA))
+    buckets = pd.DataFrame({'group': ids, 'sign': sign, 'bucket': bucket})
+    return merge_buckets(buckets.assign(count=1))
+
+
+def merge_buckets(buckets):
+    grouped = buckets.groupby(['group', 'sign', 'bucket'], sort=False)
+    return grouped['count'].sum().reset_index()
+
+
+def quantile(buckets, n, q):
+    """
+    Approximate q quantile of each of the n groups' values, NaN for groups
+    with none.
+    """
+    # in order of value: negative buckets by falling size, 0, positive ones.
+    buckets = buckets.assign(order=buckets['sign'] * buckets['bucket'])
+    buckets = buckets.sort_values(['group', 'sign', 'order'])
+    group = buckets['group'].values
+    cumulative = buckets.groupby('group')['count'].cumsum().values
+    totals = np.bincount(group, weights=buckets['count'].values, minlength=n)
+    wanted = cumulative > q * (totals[group] - 1)
+    chosen = buckets[wanted].drop_duplicates('group')
+    # the middle of the bucket, by relative error.
+    middle = 2 * _GAMMA ** chosen['bucket'].values / (_GAMMA + 1)
+    result = np.full(n, np.nan)
+    result[chosen['group'].values] = chosen['sign'].values * middle
+    return result
+
+
+def _bit_length(x):
+    # number of bits needed for each uint64, exactly, unlike log2 of floats.
+    length = np.zeros(x.shape, dtype=np.int64)
+    for shift in [32, 16, 8, 4, 2, 1]:
+        big = x >= np.uint64(1 << shift)
+        length[big] += shift
+        x = np.where(big, x >> np.uint64(shift), x)
+    return length + (x > 0)
@@ -0,0 +1,123 @@
+"""
+Vectorized versions of the text actions, for columns of Arrow backed
+strings (see Convertor's string_engine), run by pyarrow's compute kernels
+rather than a Python call per value.
+
+Each returns None where it can't do what the Python version does, so the
+action falls back to that.
+"""
+import re
+
+import pandas as pd
+
+ARROW_STRINGS = 'string[pyarrow]'
+
+
+def check_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        msg = 'string_engine arrow needs pyarrow: pip install pyarrow'
+        raise ImportError(msg)
+
+
+def to_arrow_strings(input_data):
+    """
+    Stores the columns of input_data that hold only text as Arrow strings.
+    """
+    for col in input_data:
+        values = input_data[col]
+        if (values.dtype == object and
+                pd.api.types.infer_dtype(values, skipna=True) == 'string'):
+            input_data[col] = values.astype(ARROW_STRINGS)
+    return input_data
+
+
+def is_arrow_strings(values):
+    return (isinstance(values.dtype, pd.StringDtype) and
+            values.dtype.storage == 'pyarrow')
+
+
+def extract(values, regex):
+    """
+    What str.extract(regex, re.VERBOSE) matches in values, for regexes with
+    one group and nothing for VERBOSE to strip.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    if not is_arrow_strings(values) or re.compile(regex).groups != 1:
+        return None
+    named = _name_group(regex)
+    if named is None:
+        return None
+    try:
+        matches = pc.extract_regex(_arrow(values), named)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        # something RE2 doesn't do, e.g. look ahead.
+        return None
+    return _series(pc.struct_field(matches, [0]), values.index)
+
+
+def replace(values, pattern, replacement):
+    """
+    values.str.replace(pattern, replacement), run by pyarrow's kernels.
+    """
+    import pyarrow as pa
+    if not is_arrow_strings(values):
+        return None
+    try:
+        return values.str.replace(pattern, replacement)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        # something RE2 doesn't do, e.g. look ahead or \1 in the pattern.
+        return None
+
+
+def as_text(values):
+    """
+    Like astype(str), with any .0 on the end cut off, for the text format.
+    """
+    import pyarrow.compute as pc
+    if not is_arrow_strings(values):
+        return None
+    # missing values become 'nan', as astype(str) makes them.
+    text = pc.fill_null(_arrow(values), 'nan')
+    return _series(pc.replace_substring_regex(text, r'\.0$', ''),
+                   values.index)
+
+
+def _name_group(regex):
+    """
+    regex with its one group named, as pyarrow's extract_regex needs, or
+    None if VERBOSE would change it.
+    """
+    escaped = in_class = False
+    group = None
+    for i, char in enumerate(regex):
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char.isspace() or char == '#':
+            # VERBOSE strips whitespace and comments outside [...].
+            return None
+        elif char == '(' and not regex.startswith('(?', i):
+            group = i
+    if group is None:
+        # already named, (?P<name>...).
+        return regex
+    return regex[:group + 1] + '?P<extracted>' + regex[group + 1:]
+
+
+def _arrow(values):
+    if isinstance(values, pd.Series):
+        import pyarrow as pa
+        return pa.array(values.array)
+    return values
+
+
+def _series(data, index):
+    return pd.Series(pd.arrays.ArrowStringArray(data), index=index)
@@ -0,0 +1,265 @@
+import collections
+import io
+import os
+
+import six
+from six.moves.urllib.parse import quote
+
+
+class UnknownOutputFormatError(Exception):
+    pass
+
+
+def writer_class(output_format):
+    writer_classes = {
+        'csv': CsvWriter,
+        'parquet': ParquetWriter,
+        'feather': FeatherWriter,
+    }
+    try:
+        return writer_classes[output_format]
+    except KeyError:
+        msg = 'output format {} unknown'.format(output_format)
+        raise UnknownOutputFormatError(msg)
+
+
+def open_writer(output_format, destination, partition_by=None):
+    """
+    Returns a writer for DataFrames, a chunk at a time, to destination: a
+    path, or a file-like object for csv.
+    partition_by: column to split the output on. destination is then a
+    directory, with a <column>=<value> directory per value of the column.
+    """
+    cls = writer_class(output_format)
+    if partition_by:
+        return PartitionedWriter(cls, destination, partition_by)
+    return cls(destination)
+
+
+class Writer:
+    """
+    Writes each DataFrame passed to write() straight to destination, after
+    the ones before it. Use as a context manager, or call close() at the end.
+    """
+    extension = None
+
+    def __init__(self, destination):
+        self.destination = destination
+
+    def write(self, output_data):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CsvWriter(Writer):
+    extension = '.csv'
+
+    def __init__(self, destination):
+        Writer.__init__(self, destination)
+        self.f = None
+
+    def write(self, output_data):
+        if self.f is None:
+            if isinstance(self.destination, six.string_types):
+                self.f = io.open(self.destination, 'w', encoding='utf-8',
+                                 newline='')
+            else:
+                self.f = self.destination
+            # only the first chunk gets a header row.
+            output_data.to_csv(self.f, index=False)
+        else:
+            output_data.to_csv(self.f, index=False, header=False)
+
+    def close(self):
+        # only close files we opened, not buffers the caller passed in.
+        if self.f is not None and self.f is not self.destination:
+            self.f.close()
+
+
+class ArrowWriter(Writer):
+    """
+    Base for formats written through pyarrow. The file's types are those of
+    the first chunks, and later chunks are cast to them, e.g. whole numbers
+    to float. A chunk that can't be cast without losing values, e.g. one
+    with a fraction in a column the first chunk had as int, raises
+    ValueError, as a file can't change type part way through.
+    A column with no values has no type to go by, so chunks are held until
+    every column has had a value, or max_rows_held rows are held, and the
+    file is then written with the type of each column's first values.
+    """
+    max_rows_held = 100000
+
+    def __init__(self, destination):
+        Writer.__init__(self, destination)
+        self.schema = None
+        self.writer = None
+        # chunks before the file's types are known.
+        self.held = []
+
+    def write(self, output_data):
+        pa = _import_pyarrow()
+        table = pa.Table.from_pandas(output_data, preserve_index=False)
+        if self.writer is not None:
+            self.write_table(pa, table)
+            return
+        self.held.append(table)
+        rows_held = sum(held.num_rows for held in self.held)
+        if rows_held < self.max_rows_held and _has_empty_columns(self.held):
+            return
+        self.write_held(pa)
+
+    def write_held(self, pa):
+        self.schema = _schema_of_values(pa, self.held)
+        self.writer = self.open_file(pa, self.schema)
+        held, self.held = self.held, []
+        for table in held:
+            self.write_table(pa, table)
+
+    def write_table(self, pa, table):
+        if not table.schema.equals(self.schema):
+            table = self.cast_to_schema(pa, table)
+        self.writer.write_table(table)
+
+    def cast_to_schema(self, pa, table):
+        if sorted(table.schema.names) != sorted(self.schema.names):
+            msg = 'a later chunk has columns {}, not the first chunk\'s ' \
+                  '{}'.format(table.schema.names, self.schema.names)
+            raise ValueError(msg)
+        columns = []
+        for field in self.schema:
+            column = table.column(field.name)
+            try:
+                columns.append(column.cast(field.type))
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                msg = 'column {} of a later chunk is {}, which can\'t be ' \
+                      'written as the first chunk\'s {}. Use save to ' \
+                      'write the output all at once'.format(
+                          field.name, column.type, field.type)
+                raise ValueError(msg)
+        return pa.Table.from_arrays(columns, schema=self.schema)
+
+    def open_file(self, pa, schema):
+        raise NotImplementedError
+
+    def close(self):
+        if self.held:
+            self.write_held(_import_pyarrow())
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ParquetWriter(ArrowWriter):
+    """
+    Each chunk is written as a row group.
+    """
+    extension = '.parquet'
+
+    def open_file(self, pa, schema):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(self.destination, schema)
+
+
+class FeatherWriter(ArrowWriter):
+    """
+    Feather version 2, i.e. an Arrow IPC file. Left uncompressed so it can
+    be memory mapped when read.
+    """
+    extension = '.feather'
+
+    def open_file(self, pa, schema):
+        return pa.ipc.new_file(self.destination, schema)
+
+
+class PartitionedWriter(Writer):
+    """
+    Splits each chunk on the partition_by column, and writes each part with
+    a writer of writer_class, to
+    destination/<partition_by>=<value>/part-0<extension>
+    The value is %-escaped as in a URL, / included, so it can't lead out of
+    destination. The column itself is left out of the files, as its value
+    is in the path.
+    At most max_open_writers files are open at once. When another is
+    needed, the one written to least recently is closed, and if its value
+    comes up again, its rows go on in a new file, part-1, part-2 and so on.
+    """
+    def __init__(self, writer_class, destination, partition_by,
+                 max_open_writers=64):
+        Writer.__init__(self, destination)
+        self.writer_class = writer_class
+        self.partition_by = partition_by
+        self.max_open_writers = max_open_writers
+        # open writers, least recently written to first.
+        self.writers = collections.OrderedDict()
+        # number of files written for each value.
+        self.parts = {}
+
+    def write(self, output_data):
+        groups = output_data.groupby(self.partition_by, sort=False,
+                                     observed=True, dropna=False)
+        for value, rows in groups:
+            # keyed on the text, as NaN != NaN.
+            key = six.text_type(value)
+            writer = self.writers.pop(key, None)
+            if writer is None:
+                if len(self.writers) >= self.max_open_writers:
+                    self.writers.popitem(last=False)[1].close()
+                writer = self.open_part(key)
+            self.writers[key] = writer
+            writer.write(rows.drop(self.partition_by, axis='columns'))
+
+    def open_part(self, key):
+        directory = '{}={}'.format(self.partition_by, quote(key, safe=''))
+        directory = os.path.join(self.destination, directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        part = self.parts.get(key, 0)
+        self.parts[key] = part + 1
+        name = 'part-{}{}'.format(part, self.writer_class.extension)
+        return self.writer_class(os.path.join(directory, name))
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+def _has_empty_columns(tables):
+    return any(all(_is_empty(table.column(name)) for table in tables)
+               for name in tables[0].schema.names)
+
+
+def _schema_of_values(pa, tables):
+    """
+    The first table's schema, with each column's type taken from the first
+    table where it has values.
+    """
+    first = tables[0].schema
+    fields = []
+    for field in first:
+        for table in tables:
+            column = table.column(field.name)
+            if not _is_empty(column):
+                field = field.with_type(column.type)
+                break
+        fields.append(field)
+    return pa.schema(fields, metadata=first.metadata)
+
+
+def _is_empty(column):
+    return column.null_count == len(column)
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        msg = 'writing parquet or feather needs pyarrow: pip install pyarrow'
+        raise ImportError(msg)
+    return pyarrow
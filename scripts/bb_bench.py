@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""
+Times Convertor.extract, each action in actions.ACTION_CLASSES on its own,
+and a few whole specs, on generated csv files of several sizes, and the
+README's example, example.yaml, on generated files laid out like
+example_weather_input.csv, with rows before the header and a footer.
+Results are written as JSON, and can be compared with an earlier run's to
+flag anything that got slower.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import bumblebee as bb
+from bumblebee.actions import ACTION_CLASSES, Transformer
+
+usage = """
+bb_bench.py --output results.json
+bb_bench.py --scales 10k,1m --output new.json --compare old.json
+"""
+
+SCALES = {'10k': 10 ** 4, '1m': 10 ** 6, '10m': 10 ** 7}
+# columns added to the narrow ones, of each of int and text, when wide.
+WIDE_EXTRA_COLUMNS = 20
+_ROWS_PER_WRITE = 100000
+
+READ_DATES = {'read_these_columns_in_these_formats': {'date': ['date']}}
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+# the README's example, and the file its generated input copies the layout
+# and rows of.
+EXAMPLE_SPEC = os.path.join(SCRIPTS_DIR, 'example.yaml')
+EXAMPLE_INPUT = os.path.join(SCRIPTS_DIR, 'example_weather_input.csv')
+
+# instructions for each action, and the columns to run it on (None: every
+# column). Every action in ACTION_CLASSES needs an entry.
+ACTION_BENCHMARKS = {
+    'change_date_or_time_format': ([{
+        'target_column': 'date',
+        'result_column': 'date_text',
+        'date_format': 'mm/dd/YYYY',
+    }], None),
+    'copy_column': (['client_copy = client'], None),
+    'rename_column': (['customer = client'], None),
+    'extract_query_string': ([{
+        'target_column': 'url',
+        'result_column': 'x',
+        'query_string': 'x',
+    }], None),
+    'extract_text': ([{
+        'target_column': 'url',
+        'result_column': 'x',
+        'regex': '.* [?&] x = ([^&#]*)',
+    }], None),
+    'only_keep_these_columns': (['date', 'client', 'a'], None),
+    'only_keep_rows_where': (['a < 50 & client == "client_3"'], None),
+    'only_edit_rows_where': ([{
+        'rows_match': 'a < 50',
+        'list_of_actions': [{'run_these_formula': ['b = 0']}],
+    }], None),
+    'run_these_formula': (['total = a * price + b'], None),
+    'remove_columns': (['url'], None),
+    'remove_duplicates': (['client', 'a'], None),
+    'replace_text': ([{
+        'target_column': 'client',
+        'result_column': 'short_client',
+        'text_to_find': 'client_',
+        'replacement_text': 'c',
+    }], None),
+    'add_text_at_end': ([{
+        'target_column': 'client',
+        'result_column': 'tagged',
+        'text': '-x',
+    }], None),
+    'add_text_at_start': ([{
+        'target_column': 'client',
+        'result_column': 'tagged',
+        'text': 'x-',
+    }], None),
+    # sums every other column, so only give it numbers.
+    'sum_up_by': (['client'], ['client', 'a', 'b', 'price']),
+    'aggregate_by': ({
+        'columns_to_group_by': ['client'],
+        'calculate': [
+            'total = sum(a)',
+            'average = mean(price)',
+            'distinct_b = approximate_distinct(b)',
+            'median_price = approximate_quantile(price, 0.5)',
+        ],
+    }, None),
+    'make_column_names_lowercase': ([], None),
+    'make_column_names_alphanumeric': ([], None),
+    'ensure_column_is_in_this_format': ([{'a': 'text'}], None),
+}
+
+# whole specs, run with Convertor.transform.
+SPEC_BENCHMARKS = {
+    # renames, a formula and a filter, on the generated columns. See
+    # EXAMPLE_SPEC for the README's example itself.
+    'rename_calculate_filter': dict(READ_DATES, list_of_actions=[
+        {'rename_column': ['time = date']},
+        {'run_these_formula': ['price_with_tax = price * 1.1']},
+        {'only_keep_rows_where': ['a < 50 & client == "client_3"']},
+        {'only_keep_these_columns': ['client', 'time', 'price',
+                                     'price_with_tax']},
+    ]),
+    'clean_text': {'list_of_actions': [
+        'make_column_names_lowercase',
+        {'extract_query_string': [{'target_column': 'url',
+                                   'result_column': 'x',
+                                   'query_string': 'x'}]},
+        {'replace_text': [{'target_column': 'client',
+                           'result_column': 'client',
+                           'text_to_find': 'client_',
+                           'replacement_text': ''}]},
+        {'remove_duplicates': ['client', 'x']},
+    ]},
+    'summarise': {'list_of_actions': [
+        {'only_keep_rows_where': ['b > 10']},
+        {'aggregate_by': {
+            'columns_to_group_by': ['client'],
+            'calculate': ['total = sum(a)', 'rows = count(a)',
+                          'average = mean(price)'],
+        }},
+    ]},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(usage=usage)
+    parser.add_argument('--scales', default='10k',
+                        help='comma separated sizes to run, of {} '
+                             '(default: 10k)'.format(', '.join(SCALES)))
+    parser.add_argument('--widths', default='narrow,wide')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='times to run each benchmark, keeping the '
+                             'fastest')
+    parser.add_argument('--data-dir', default=None,
+                        help='where to keep the generated csv files, '
+                             'reused between runs (default: a directory '
+                             'in the system\'s temporary directory)')
+    parser.add_argument('--output', default=None,
+                        help='file to write the results to, as JSON')
+    parser.add_argument('--compare', default=None,
+                        help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction slower than the earlier run that '
+                             'counts as a regression (default: 0.2)')
+    args = parser.parse_args()
+    data_dir = args.data_dir or os.path.join(tempfile.gettempdir(),
+                                             'bumblebee-bench')
+    results = {'environment': environment(), 'timings': {}}
+    for scale in args.scales.split(','):
+        path = generate_weather_csv(data_dir, scale)
+        key = 'weather-{} spec example.yaml'.format(scale)
+        convertor = bb.Convertor.from_yaml(EXAMPLE_SPEC)
+        seconds = _fastest(args.repeat, convertor.transform, path)
+        results['timings'][key] = seconds
+        print('{:<50} {:>10.4f}s'.format(key, seconds))
+        for width in args.widths.split(','):
+            path = generate_csv(data_dir, scale, width)
+            prefix = '{}-{}'.format(width, scale)
+            timings = run_benchmarks(path, args.repeat)
+            for name, seconds in sorted(timings.items()):
+                key = '{} {}'.format(prefix, name)
+                results['timings'][key] = seconds
+                print('{:<50} {:>10.4f}s'.format(key, seconds))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            earlier = json.load(f)
+        regressions = compare(earlier['timings'], results['timings'],
+                              args.tolerance)
+        for key, before, after in regressions:
+            print('slower: {} {:.4f}s -> {:.4f}s'.format(key, before, after))
+        if regressions:
+            sys.exit(1)
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def generate_csv(data_dir, scale, width):
+    """
+    Returns the path of a csv file of SCALES[scale] rows, writing it first
+    if it isn't there already.
+    """
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    path = os.path.join(data_dir, '{}-{}.csv'.format(width, scale))
+    if os.path.exists(path):
+        return path
+    rows = SCALES[scale]
+    rng = np.random.RandomState(0)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        for start in range(0, rows, _ROWS_PER_WRITE):
+            chunk = _random_rows(rng, min(_ROWS_PER_WRITE, rows - start),
+                                 width == 'wide')
+            chunk.to_csv(f, index=False, header=start == 0)
+    os.rename(temp_path, path)
+    return path
+
+
+def generate_weather_csv(data_dir, scale):
+    """
+    Returns the path of a file like EXAMPLE_INPUT, with its rows before the
+    header and its footer, and SCALES[scale] of its data rows, repeated,
+    writing it first if it isn't there already.
+    """
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    path = os.path.join(data_dir, 'weather-{}.csv'.format(scale))
+    if os.path.exists(path):
+        return path
+    with open(EXAMPLE_INPUT) as f:
+        lines = f.readlines()
+    header = max(i for i, line in enumerate(lines)
+                 if line.startswith('sort_order'))
+    footer = max(i for i, line in enumerate(lines) if line.strip())
+    preamble, rows, footer = (lines[:header + 1], lines[header + 1:footer],
+                              lines[footer:])
+    n = SCALES[scale]
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        f.writelines(preamble)
+        for start in range(0, n, _ROWS_PER_WRITE):
+            count = min(_ROWS_PER_WRITE, n - start)
+            f.writelines(rows[i % len(rows)]
+                         for i in range(start, start + count))
+        f.writelines(footer)
+    os.rename(temp_path, path)
+    return path
+
+
+def _random_rows(rng, n, wide):
+    days = rng.randint(0, 3650, n).astype('timedelta64[D]')
+    data = pd.DataFrame({
+        'date': (np.datetime64('2010-01-01') + days).astype(str),
+        'client': pd.Series(rng.randint(0, 50, n)).map('client_{}'.format),
+        'url': pd.Series(rng.randint(0, 1000, n)).map(
+            'http://example.com/page?x={}&y=1'.format),
+        'a': rng.randint(0, 100, n),
+        'b': rng.randint(0, 1000, n),
+        'price': np.round(rng.uniform(0, 500, n), 2),
+    })
+    if wide:
+        for i in range(WIDE_EXTRA_COLUMNS):
+            data['int_{}'.format(i)] = rng.randint(0, 10 ** 6, n)
+            data['text_{}'.format(i)] = pd.Series(
+                rng.randint(0, 10 ** 4, n)).map('value {}'.format)
+    return data
+
+
+def run_benchmarks(path, repeat):
+    """
+    Dict of benchmark name to the fastest of repeat runs, in seconds.
+    """
+    timings = {}
+    missing = set(ACTION_CLASSES) - set(ACTION_BENCHMARKS)
+    if missing:
+        msg = 'no benchmark for actions: {}'.format(', '.join(missing))
+        raise ValueError(msg)
+    convertor = bb.Convertor(**READ_DATES)
+    timings['extract'] = _fastest(repeat, convertor.extract, path)
+    input_data = convertor.extract(path)
+    for name, (instruction, columns) in ACTION_BENCHMARKS.items():
+        transformer = Transformer([{name: instruction}])
+        data = input_data if columns is None else input_data[columns]
+        runs = []
+        for _ in range(repeat):
+            # actions may change their input, so each run gets a copy.
+            copied = data.copy()
+            start = time.perf_counter()
+            transformer.perform_instructions(copied)
+            runs.append(time.perf_counter() - start)
+        timings['action {}'.format(name)] = min(runs)
+    for name, spec in SPEC_BENCHMARKS.items():
+        convertor = bb.Convertor(**spec)
+        timings['spec {}'.format(name)] = _fastest(repeat,
+                                                   convertor.transform, path)
+    return timings
+
+
+def _fastest(repeat, function, argument):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(argument)
+        runs.append(time.perf_counter() - start)
+    return min(runs)
+
+
+def compare(earlier, later, tolerance):
+    """
+    List of (name, earlier seconds, later seconds) of benchmarks in both
+    that took more than (1 + tolerance) times as long later.
+    """
+    regressions = []
+    for key in sorted(set(earlier) & set(later)):
+        if later[key] > earlier[key] * (1 + tolerance):
+            regressions.append((key, earlier[key], later[key]))
+    return regressions
+
+
+if __name__ == '__main__':
+    main()
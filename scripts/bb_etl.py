@@ -2,29 +2,192 @@
 
 from __future__ import print_function
 
-import bumblebee
+import argparse
 import bumblebee as bb
-from StringIO import StringIO
 import sys
 
 usage = """
 HELP
 bb_etl.py input.csv transformation_rules.yaml > output.csv
+bb_etl.py input1.csv input2.csv ... transformation_rules.yaml > output.csv
+bb_etl.py --workers 8 --output-dir out/ *.csv transformation_rules.yaml
+bb_etl.py --output output.parquet input.csv transformation_rules.yaml
+bb_etl.py --stream big_input.csv transformation_rules.yaml > output.csv
+bb_etl.py --profile profile.json input.csv transformation_rules.yaml > out.csv
+bb_etl.py --pipeline input1.csv input2.csv transformation_rules.yaml > out.csv
+bb_etl.py compile transformation_rules.yaml transformation_rules.bbc
+bb_etl.py input.csv transformation_rules.bbc > output.csv
+bb_etl.py serve --socket /tmp/bb.sock transformation_rules_dir/
+bb_etl.py submit --socket /tmp/bb.sock input.csv rules_name output.csv
 """
 
+compile_usage = """
+bb_etl.py compile transformation_rules.yaml transformation_rules.bbc
+
+Checks the transformation file and writes it in a form that loads faster,
+which can be used in its place.
+"""
+
+serve_usage = """
+bb_etl.py serve --socket /tmp/bb.sock transformation_rules_dir/
+bb_etl.py serve --port 8765 --workers 4 transformation_rules_dir/
+bb_etl.py serve --port 8765 --input-root in/ --output-root out/ rules_dir/
+
+Runs jobs sent by bb_etl.py submit, with the transformation files in the
+directory, which are read again when they change. Jobs read and write
+files as the server's user, and any local user can send jobs to a --port,
+so use --input-root and --output-root to limit which files they can.
+"""
+
+submit_usage = """
+bb_etl.py submit --socket /tmp/bb.sock input.csv rules_name output.csv
+bb_etl.py submit --stream --socket /tmp/bb.sock big.csv rules_name out.csv
+
+Has the server transform input.csv with rules_name.yaml (or .bbc) from its
+directory, writing to output.csv.
+"""
+
+
 def main():
+    commands = {'compile': compile_spec, 'serve': serve, 'submit': submit}
+    if sys.argv[1:2] and sys.argv[1] in commands:
+        commands[sys.argv[1]](sys.argv[2:])
+        return
+    parser = argparse.ArgumentParser(usage=usage)
+    parser.add_argument('input_csv', nargs='+')
+    parser.add_argument('transformation_file',
+                        help='YAML, or compiled by bb_etl.py compile')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes to spread input files over '
+                             '(default: number of CPUs)')
+    parser.add_argument('--output-dir', default=None,
+                        help='write each input file\'s output here, '
+                             'instead of all output to stdout')
+    parser.add_argument('--output', default=None,
+                        help='file to write the output to, in the '
+                             'output_format of the transformation file '
+                             '(default: stdout, for csv)')
+    parser.add_argument('--profile', default=None,
+                        help='file to write the time taken, rows and '
+                             'columns of each step to, as JSON (- for '
+                             'stderr). Inputs are then transformed one at '
+                             'a time, in this process')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='read the inputs one after the other as if '
+                             'they were one, reading each chunk while the '
+                             'one before is transformed and written')
+    parser.add_argument('--stream', action='store_true',
+                        help='transform a single input a chunk at a time '
+                             '(read_in_chunks_of_rows), so it needn\'t fit '
+                             'in memory. Column types are then picked per '
+                             'chunk, so e.g. a number can print as 5 in '
+                             'one chunk and 7.0 in another')
+    args = parser.parse_args()
+    convertor = bb.Convertor.from_spec_file(args.transformation_file)
+    if args.profile is not None and args.output_dir is not None:
+        parser.error('--profile can\'t be used with --output-dir')
+    if args.output_dir is not None:
+        convertor.transform_many(args.input_csv, workers=args.workers,
+                                 output_directory=args.output_dir)
+        return
+    if args.output is None and (convertor.output_format != 'csv' or
+                                convertor.partition_output_by):
+        parser.error('--output is needed unless writing csv to stdout')
+    destination = args.output or sys.stdout
+    if args.profile is not None:
+        convertor.profiler = bb.Profiler()
+        with convertor.open_writer(destination) as writer:
+            for path in args.input_csv:
+                writer.write(convertor.transform(path))
+        _write_profile(convertor.profiler, args.profile)
+    elif args.pipeline:
+        convertor.load_pipelined(args.input_csv, destination)
+    elif len(args.input_csv) == 1 and args.stream:
+        convertor.load(args.input_csv[0], destination)
+    elif len(args.input_csv) == 1:
+        convertor.save(args.input_csv[0], destination)
+    else:
+        output = convertor.transform_many(args.input_csv,
+                                          workers=args.workers)
+        with convertor.open_writer(destination) as writer:
+            writer.write(output)
+
+
+def compile_spec(argv):
+    parser = argparse.ArgumentParser(usage=compile_usage)
+    parser.add_argument('transformation_file')
+    parser.add_argument('compiled_file')
+    args = parser.parse_args(argv)
+    bb.Convertor.from_yaml(args.transformation_file).compile(
+        args.compiled_file)
+
+
+def serve(argv):
+    from bumblebee import server
+    parser = argparse.ArgumentParser(usage=serve_usage)
+    parser.add_argument('transformation_dir')
+    _add_address_arguments(parser)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='jobs to run at once '
+                             '(default: number of CPUs)')
+    parser.add_argument('--input-root', default=None,
+                        help='only read input files in this directory')
+    parser.add_argument('--output-root', default=None,
+                        help='only write output files in this directory')
+    args = parser.parse_args(argv)
+    address = _address(parser, args)
+    s = server.make_server(args.transformation_dir, address, args.workers,
+                           input_root=args.input_root,
+                           output_root=args.output_root)
+    print('serving on {}'.format(address), file=sys.stderr)
     try:
-        args = sys.argv[1:]
-        input_csv, transformation_file = args
-    except:
-        print(usage)
+        s.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        s.server_close()
+
+
+def submit(argv):
+    from bumblebee import server
+    parser = argparse.ArgumentParser(usage=submit_usage)
+    parser.add_argument('input_csv')
+    parser.add_argument('transformation_name')
+    parser.add_argument('output')
+    parser.add_argument('--stream', action='store_true',
+                        help='transform the input a chunk at a time, as '
+                             'bb_etl.py --stream does')
+    _add_address_arguments(parser)
+    args = parser.parse_args(argv)
+    response = server.submit(_address(parser, args), args.input_csv,
+                             args.transformation_name, args.output,
+                             stream=args.stream)
+    if not response['ok']:
+        sys.exit(response['error'])
+
+
+def _add_address_arguments(parser):
+    parser.add_argument('--socket', default=None,
+                        help='path of the Unix socket to use')
+    parser.add_argument('--port', type=int, default=None,
+                        help='port on localhost to use, instead of a '
+                             'Unix socket')
+
+
+def _address(parser, args):
+    if (args.socket is None) == (args.port is None):
+        parser.error('one of --socket or --port is needed')
+    if args.port is not None:
+        return ('127.0.0.1', args.port)
+    return args.socket
+
+
+def _write_profile(profiler, path):
+    if path == '-':
+        print(profiler.to_json(indent=2), file=sys.stderr)
         return
-    convertor = bb.Convertor.from_yaml(transformation_file)
-    output = convertor.transform(input_csv)
-    output_buffer = StringIO()
-    output.to_csv(output_buffer, index=False)
-    output_buffer.seek(0)
-    print(output_buffer.read(), end='')
+    with open(path, 'w') as f:
+        f.write(profiler.to_json(indent=2))
 
 
 if __name__ == '__main__':
@@ -3,4 +3,9 @@ import sys
 
 sys.path.insert(0, os.path.abspath('..'))
 
-from bumblebee import Convertor
+from bumblebee import Convertor, Profiler, server
+from bumblebee.actions import UnknownActionError
+from bumblebee.writers import (CsvWriter, PartitionedWriter,
+                               UnknownOutputFormatError)
+from bumblebee.readers import UnknownDataFormatError, read_parquet
+from bumblebee.dedup import SeenKeys
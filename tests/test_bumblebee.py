@@ -1,10 +1,20 @@
 # import io
+import json
 import math
+import numpy as np
 import os
 import pandas as pd
+import pytest
+import shutil
+import subprocess
+import sys
+import threading
+import tracemalloc
 
 from six import StringIO
-from .context import Convertor
+from .context import (Convertor, CsvWriter, PartitionedWriter, Profiler,
+                      SeenKeys, UnknownActionError, UnknownDataFormatError,
+                      UnknownOutputFormatError, read_parquet, server)
 
 
 class TestTransformation:
@@ -95,6 +105,19 @@ class TestTransformation:
         output = self._run_transformation(yaml_config, test_csv)
         assert len(output) == 2
 
+    def test_skip_rows_at_end_before_parsing(self):
+        yaml_config = """
+            number_of_rows_to_skip_at_file_end: 3
+        """
+        test_csv = os.path.join(self.testdatadir, '3_extra_rows_at_end.csv')
+        output = self._run_transformation(yaml_config, test_csv)
+        # footer text never reaches the parser, so numbers stay numbers.
+        assert output['age'].dtype == 'int64'
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        output = pd.concat(t.transform_iter(test_csv, chunksize=1))
+        assert output['age'].dtype == 'int64'
+        assert list(output['name']) == ['dave', 'steve']
+
     def test_skip_to_column_headers(self):
         yaml_config = """
             read_from_row_that_starts_with: name
@@ -112,6 +135,22 @@ class TestTransformation:
             output = self._run_transformation(yaml_config, f)
         assert len(output) == 2
 
+    def test_skip_to_first_or_last_column_headers(self):
+        yaml_config = """
+            read_from_row_that_starts_with: name
+            read_from_first_or_last_matching_row: {}
+        """
+        test_csv = os.path.join(self.testdatadir, 'repeated_header.csv')
+        output = self._run_transformation(yaml_config.format('first'),
+                                          test_csv)
+        assert list(output['name']) == ['dave', 'name', 'steve']
+        output = self._run_transformation(yaml_config.format('last'),
+                                          test_csv)
+        assert list(output['name']) == ['steve']
+        with open(test_csv) as f:
+            output = self._run_transformation(yaml_config.format('first'), f)
+        assert list(output['name']) == ['dave', 'name', 'steve']
+
     def test_parsing_numbers_as_text_action(self):
         yaml_config = """
             list_of_actions:
@@ -212,6 +251,47 @@ class TestTransformation:
         assert 'd' in output
         assert 'e' not in output
 
+    def test_only_load_columns_the_actions_use(self):
+        yaml_config = """
+            read_these_columns_in_these_formats:
+                number:
+                    - d
+                    - e
+            list_of_actions:
+                - copy_column:
+                    - g = c
+                - run_these_formula:
+                    - h = a * 2 + b
+                - only_keep_rows_where:
+                    - a > 1 and `h` > 0
+                - only_keep_these_columns:
+                    - g
+                    - d
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_cols.csv')
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        needed = t.action_list.columns_needed()
+        assert needed == set(['a', 'b', 'c', 'd'])
+        input_data = t.extract(test_csv)
+        assert list(input_data.columns) == ['a', 'b', 'c', 'd']
+        assert input_data['d'][0] == 1001
+
+    def test_only_load_columns_with_non_ascii_names(self, tmpdir):
+        yaml_config = u"""
+            list_of_actions:
+                - only_keep_rows_where:
+                    - temp\u00e9rature > 5
+                - only_keep_these_columns:
+                    - ville
+        """
+        test_csv = tmpdir.join('input.csv')
+        test_csv.write_text(u'ville,temp\u00e9rature,other\nA,3,x\nB,7,y\n',
+                            'utf-8')
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        assert t.action_list.columns_needed() == set([u'ville',
+                                                      u'temp\u00e9rature'])
+        assert list(t.transform(str(test_csv))['ville']) == ['B']
+
     def test_column_addition(self):
         yaml_config = """
             list_of_actions:
@@ -236,6 +316,30 @@ class TestTransformation:
         assert 'foo' in output
         assert output['foo'][0] == 'bar'
 
+    def test_formulas_compiled_once(self):
+        yaml_config = """
+            list_of_actions:
+                - run_these_formula:
+                    - total = a + b
+                    - double_total = total * 2
+                    - foo = 'bar'
+                    - a copy = a
+                    - b_copy = b
+                    - baz = not a column
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_cols.csv')
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        steps = t.action_list.actions[0].steps
+        assert [kind for kind, _, _ in steps] == [
+            'expression', 'text', 'column_or_text', 'column',
+            'column_or_text']
+        output = t.transform(test_csv)
+        assert output['double_total'][1] == 18
+        assert output['foo'][0] == 'bar'
+        assert output['a copy'][1] == 5
+        assert output['b_copy'][1] == 4
+        assert output['baz'][0] == 'not a column'
+
     def test_substitute_text(self):
         yaml_config = """
             list_of_actions:
@@ -335,6 +439,131 @@ class TestTransformation:
         assert len(output) == 1
         assert output['b'].values[0] == 2
 
+    def test_filter_rows_clause_by_clause(self):
+        # later clauses only see the rows kept by earlier ones.
+        yaml_config = """
+            list_of_actions:
+                - only_keep_rows_where:
+                    - client == "bar"
+                    - a == a.max()
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        output = self._run_transformation(yaml_config, test_csv)
+        assert list(output['client']) == ['bar']
+        yaml_config = """
+            list_of_actions:
+                - only_keep_rows_where:
+                    - b == b.max()
+                    - client == "foo"
+                    - a == a.min()
+        """
+        output = self._run_transformation(yaml_config, test_csv)
+        assert list(output.index) == [1]
+
+    def test_compact_dtypes(self):
+        yaml_config = """
+            compact_dtypes: {}
+            read_these_columns_in_these_formats:
+                text:
+                    - state
+            list_of_actions:
+                - run_these_formula:
+                    - warm = temp > 15
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_compact.csv')
+        expected = self._run_transformation(yaml_config.format('false'),
+                                            test_csv)
+        t = Convertor.from_yaml(StringIO(yaml_config.format('true')))
+        output = t.transform(test_csv)
+        assert output['station'].dtype == object
+        assert output['state'].dtype == 'category'
+        assert output['reading'].dtype == 'int16'
+        assert output['rain'].dtype == 'float32'
+        # read by the formula, so left alone.
+        assert output['temp'].dtype == 'float64'
+        assert (output.memory_usage(deep=True).sum() <
+                expected.memory_usage(deep=True).sum())
+        pd.testing.assert_frame_equal(output.astype(object),
+                                      expected.astype(object))
+        assert output.to_csv(index=False) == expected.to_csv(index=False)
+        with open(test_csv) as f:
+            output = t.transform(f)
+        assert output['state'].dtype == 'category'
+        output = pd.concat(t.transform_iter(test_csv, chunksize=5))
+        assert output['reading'].dtype == 'int16'
+        pd.testing.assert_frame_equal(output.astype(object),
+                                      expected.astype(object))
+
+    def test_filter_rows_without_copying_everything(self):
+        yaml_config = """
+            list_of_actions:
+                - only_keep_rows_where:
+                    - a > 0.3
+                    - b > 0.3
+                    - c < 0.45
+        """
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        n = 10 ** 6
+        input_data = pd.DataFrame({'a': np.linspace(0, 1, n),
+                                   'b': np.linspace(1, 0, n),
+                                   'c': np.linspace(0, 1, n),
+                                   'd': np.linspace(0, 1, n)})
+        expected = input_data[(input_data.a > 0.3) & (input_data.b > 0.3) &
+                              (input_data.c < 0.45)]
+        tracemalloc.start()
+        try:
+            output = t.action_list.perform_instructions(input_data)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # the kept rows and a few masks, no copies of the whole input.
+        assert peak < input_data.memory_usage().sum()
+        pd.testing.assert_frame_equal(output, expected)
+
+    def test_filter_rows_while_reading(self):
+        yaml_config = """
+            filter_rows_while_reading: {}
+            read_in_chunks_of_rows: 2
+            list_of_actions:
+                - add_text_at_end:
+                    - target_column: client
+                      result_column: result
+                      text: -bar
+                - only_keep_rows_where:
+                    - client == 'foo' & b < 2
+                    - result == 'foo-bar'
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        expected = self._run_transformation(yaml_config.format('false'),
+                                            test_csv)
+        t = Convertor.from_yaml(StringIO(yaml_config.format('true')))
+        assert t.filters_applied_while_reading == ["client == 'foo' & b < 2"]
+        output = t.transform(test_csv)
+        assert len(output) == 2
+        pd.testing.assert_frame_equal(output, expected)
+
+    def test_filter_rows_while_reading_after_whole_table_clause(self):
+        yaml_configs = ["""
+            filter_rows_while_reading: true
+            list_of_actions:
+                - only_keep_rows_where:
+                    - b == b.max()
+                    - client == 'bar'
+        """, """
+            filter_rows_while_reading: true
+            list_of_actions:
+                - only_keep_rows_where:
+                    - b == b.max()
+                - only_keep_rows_where:
+                    - client == 'bar'
+        """]
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        for yaml_config in yaml_configs:
+            t = Convertor.from_yaml(StringIO(yaml_config))
+            # the bar row has the highest b of the rows left if it runs first.
+            assert t.filters_applied_while_reading == []
+            assert len(t.transform(test_csv)) == 0
+
     def test_filtered_formula(self):
         yaml_config = """
             list_of_actions:
@@ -350,6 +579,116 @@ class TestTransformation:
         assert output['a'].values[0] == 1
         assert output['a'].values[1] == 666
 
+    def test_filtered_formula_matching_every_row(self):
+        input_data = pd.DataFrame({'a': [1, 2], 'b': [3, 4]})
+        for rows_match in ['a > 0', 'a > 1']:
+            t = Convertor(list_of_actions=[{'only_edit_rows_where': [
+                {'rows_match': rows_match,
+                 'list_of_actions': [{'run_these_formula': ['c = b * 10',
+                                                            'a = 666']}]}]}])
+            output = t.action_list.perform_instructions(input_data.copy())
+            # the same columns, however many rows match.
+            assert list(output.columns) == ['a', 'b']
+            assert output['a'].values[1] == 666
+
+    def test_optimized_list_of_actions(self):
+        yaml_config = """
+            optimize_list_of_actions: {}
+            list_of_actions:
+                - add_text_at_end:
+                    - target_column: client
+                      result_column: client_x
+                      text: -x
+                - copy_column:
+                    - a2 = a
+                - copy_column:
+                    - b2 = b
+                - replace_text:
+                    - target_column: client
+                      result_column: unused
+                      text_to_find: f
+                      replacement_text: F
+                - rename_column:
+                    - customer = client
+                - rename_column:
+                    - day = date
+                - only_keep_rows_where:
+                    - b > 1
+                - only_keep_these_columns:
+                    - day
+                    - customer
+                    - client_x
+                    - a2
+                    - b2
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        expected = self._run_transformation(yaml_config.format('false'),
+                                            test_csv)
+        t = Convertor.from_yaml(StringIO(yaml_config.format('true')))
+        planned = [type(a).__name__ for a in t.action_list.actions]
+        assert planned == ['FilterRowAction', 'AppendTextAction',
+                           'CopyAction', 'RenameAction', 'FilterColumnAction']
+        output = t.transform(test_csv)
+        assert len(output) == 2
+        pd.testing.assert_frame_equal(output, expected)
+
+    def test_optimized_list_of_actions_with_whole_column_formula(self):
+        yaml_config = """
+            optimize_list_of_actions: {}
+            list_of_actions:
+                - run_these_formula:
+                    - c = a - a.mean()
+                - only_keep_rows_where:
+                    - b > 1
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        expected = self._run_transformation(yaml_config.format('false'),
+                                            test_csv)
+        assert np.allclose(expected['c'], [0.8, -0.2])
+        t = Convertor.from_yaml(StringIO(yaml_config.format('true')))
+        planned = [type(a).__name__ for a in t.action_list.actions]
+        assert planned == ['FormulaAction', 'FilterRowAction']
+        pd.testing.assert_frame_equal(t.transform(test_csv), expected)
+
+    def test_optimized_list_of_actions_with_removed_columns(self):
+        yaml_config = """
+            optimize_list_of_actions: {}
+            list_of_actions:
+                - replace_text:
+                    - target_column: client
+                      result_column: tmp
+                      text_to_find: foo
+                      replacement_text: x
+                - run_these_formula:
+                    - a = b * 2
+                    - total = a + b
+                - remove_columns:
+                    - tmp
+                    - a
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        expected = self._run_transformation(yaml_config.format('false'),
+                                            test_csv)
+        t = Convertor.from_yaml(StringIO(yaml_config.format('true')))
+        planned = [type(a).__name__ for a in t.action_list.actions]
+        # a is read by total, tmp isn't read at all.
+        assert planned == ['FormulaAction', 'RemoveColumnAction']
+        pd.testing.assert_frame_equal(t.transform(test_csv), expected)
+        yaml_config = """
+            optimize_list_of_actions: true
+            list_of_actions:
+                - run_these_formula:
+                    - a = b * 2
+                - remove_columns:
+                    - a
+        """
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        planned = [type(a).__name__ for a in t.action_list.actions]
+        assert planned == ['RemoveColumnAction']
+        # a was read in, so is still removed.
+        output = t.transform(test_csv)
+        assert list(output.columns) == ['date', 'client', 'b']
+
     def test_drop_duplicates(self):
         yaml_config = """
             list_of_actions:
@@ -361,6 +700,340 @@ class TestTransformation:
         output = self._run_transformation(yaml_config, test_csv)
         assert len(output) == 3
 
+    def test_remove_duplicates_in_chunks(self):
+        yaml_config = """
+            list_of_actions:
+                - remove_duplicates:
+                    - date
+                    - client
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        expected = self._run_transformation(yaml_config, test_csv)
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        output = pd.concat(t.transform_iter(test_csv, chunksize=2))
+        pd.testing.assert_frame_equal(output, expected)
+        assert t.action_list.actions[0].duplicates_dropped == 2
+        # across files too.
+        output = pd.concat(t.transform_many_iter([test_csv, test_csv],
+                                                 chunksize=2))
+        pd.testing.assert_frame_equal(output, expected)
+        assert t.action_list.actions[0].duplicates_dropped == 7
+
+    def test_seen_keys_spill_to_disk(self, tmpdir):
+        seen = SeenKeys(max_bytes=800, spill_directory=str(tmpdir))
+        rng = np.random.RandomState(0)
+        seen_before = set()
+        for _ in range(20):
+            hashes = rng.randint(0, 1000, 60).astype(np.uint64)
+            expected = []
+            for value in hashes:
+                expected.append(value not in seen_before)
+                seen_before.add(value)
+            assert list(seen.add(hashes)) == expected
+        assert seen.spilled
+        assert len(seen) == len(seen_before)
+        assert seen.duplicates == 20 * 60 - len(seen_before)
+        seen.close()
+        assert tmpdir.listdir() == []
+
+    def test_profile_actions(self):
+        yaml_config = """
+            list_of_actions:
+                - remove_duplicates:
+                    - date
+                    - client
+                - rename_column:
+                    - bee = b
+                - remove_columns:
+                    - a
+                - run_these_formula:
+                    - total = bee * 2
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        expected = self._run_transformation(yaml_config, test_csv)
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        recorded = []
+        t.profiler = Profiler(callback=recorded.append)
+        output = t.transform(test_csv)
+        pd.testing.assert_frame_equal(output, expected)
+        steps = t.profiler.steps
+        assert recorded == steps
+        assert [step['step'] for step in steps] == [
+            'extract', 'RemoveDuplicatesAction', 'RenameAction',
+            'RemoveColumnAction', 'FormulaAction']
+        assert [step['index'] for step in steps] == [None, 0, 1, 2, 3]
+        assert steps[0]['rows_in'] is None
+        assert steps[0]['rows_out'] == 5
+        assert steps[1]['rows_in'] == 5
+        assert steps[1]['rows_out'] == 3
+        assert steps[2]['columns_added'] == ['bee']
+        assert steps[2]['columns_removed'] == ['b']
+        assert steps[3]['columns_removed'] == ['a']
+        assert steps[3]['memory_change_bytes'] < 0
+        # run_these_formula adds its column to its input in place.
+        assert steps[4]['columns_added'] == ['total']
+        assert steps[4]['memory_change_bytes'] > 0
+        assert all(step['wall_seconds'] >= 0 for step in steps)
+        assert t.profiler.total_seconds() >= 0
+        assert json.loads(t.profiler.to_json()) == steps
+
+    def test_compile_spec(self, tmpdir):
+        yaml_config = """
+            list_of_actions:
+                - rename_column:
+                    - bee = b
+                - run_these_formula:
+                    - total = a + bee
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        expected = self._run_transformation(yaml_config, test_csv)
+        yaml_path = str(tmpdir.join('spec.yaml'))
+        with open(yaml_path, 'w') as f:
+            f.write(yaml_config)
+        compiled_path = str(tmpdir.join('spec.bbc'))
+        Convertor.from_yaml(yaml_path).compile(compiled_path)
+        t = Convertor.from_compiled(compiled_path)
+        pd.testing.assert_frame_equal(t.transform(test_csv), expected)
+        t = Convertor.from_spec_file(compiled_path)
+        pd.testing.assert_frame_equal(t.transform(test_csv), expected)
+        t = Convertor.from_spec_file(yaml_path)
+        pd.testing.assert_frame_equal(t.transform(test_csv), expected)
+        with pytest.raises(ValueError):
+            Convertor.from_compiled(yaml_path)
+
+    def test_compile_spec_keeps_only_options(self, tmpdir):
+        cache_dir = str(tmpdir.join('cache'))
+        t = Convertor(list_of_actions=[{'rename_column': ['bee = b']}],
+                      cache_results_in_directory=cache_dir)
+        t.profiler = Profiler()
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        t.transform(test_csv)
+        compiled_path = str(tmpdir.join('spec.bbc'))
+        t.compile(compiled_path)
+        with open(compiled_path, 'rb') as f:
+            f.readline()
+            assert json.loads(f.read().decode('utf-8')) == t.options
+        compiled = Convertor.from_compiled(compiled_path)
+        assert compiled.profiler is None
+        assert compiled.result_cache.directory == cache_dir
+        assert compiled.spec == t.spec
+
+    def test_compile_spec_refuses_what_json_would_change(self, tmpdir):
+        compiled_path = str(tmpdir.join('spec.bbc'))
+        for yaml_config, where in [("""
+            list_of_actions:
+                - ensure_column_is_in_this_format:
+                    - 2014: text
+        """, '2014'), ("""
+            read_from_row_that_starts_with: 2014-01-01
+        """, 'read_from_row_that_starts_with')]:
+            t = Convertor.from_yaml(StringIO(yaml_config))
+            with pytest.raises(ValueError) as error:
+                t.compile(compiled_path)
+            assert where in str(error.value)
+            assert not os.path.exists(compiled_path)
+
+    def test_import_is_lazy(self):
+        package_dir = os.path.dirname(os.path.dirname(__file__))
+        code = ('import sys, bumblebee; '
+                'assert "pandas" not in sys.modules; '
+                'bumblebee.Convertor; '
+                'assert "pandas" in sys.modules; '
+                'assert "yaml" not in sys.modules')
+        subprocess.check_call([sys.executable, '-c', code], cwd=package_dir)
+
+    def test_server_runs_jobs(self, tmpdir):
+        spec_dir = tmpdir.mkdir('specs')
+        spec_path = spec_dir.join('totals.yaml')
+        spec_path.write("""
+            list_of_actions:
+                - run_these_formula:
+                    - total = a + b
+        """)
+        address = str(tmpdir.join('bb.sock'))
+        s = server.make_server(str(spec_dir), address, workers=2)
+        thread = threading.Thread(target=s.serve_forever)
+        thread.start()
+        try:
+            test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+            output_path = str(tmpdir.join('out.csv'))
+            response = server.submit(address, test_csv, 'totals',
+                                     output_path)
+            assert response['ok']
+            output = pd.read_csv(output_path)
+            assert list(output['total']) == [4, 3, 2, 2, 2]
+            # changed specs are read again.
+            spec_path.write("""
+                list_of_actions:
+                    - run_these_formula:
+                        - total = a * 10
+            """)
+            os.utime(str(spec_path), (0, 0))
+            response = server.submit(address, test_csv, 'totals',
+                                     output_path)
+            assert response['ok']
+            output = pd.read_csv(output_path)
+            assert list(output['total']) == [20, 10, 10, 10, 10]
+            response = server.submit(address, test_csv, '../totals',
+                                     output_path)
+            assert not response['ok']
+            assert 'UnknownSpecError' in response['error']
+            # types are picked for the whole file, as by bb_etl.py, unless
+            # the job asks to stream.
+            spec_dir.join('chunked.yaml').write('read_in_chunks_of_rows: 2')
+            gappy_csv = tmpdir.join('gappy.csv')
+            gappy_csv.write('x,y\n5,a\n6,b\n,c\n8,d\n')
+            for stream, expected in [(False, '5.0,6.0,,8.0'),
+                                     (True, '5,6,,8.0')]:
+                response = server.submit(address, str(gappy_csv), 'chunked',
+                                         output_path, stream=stream)
+                assert response['ok']
+                with open(output_path) as f:
+                    x = [line.split(',')[0] for line in f.read().split()]
+                assert ','.join(x[1:]) == expected
+        finally:
+            s.shutdown()
+            thread.join()
+            s.server_close()
+        assert not os.path.exists(address)
+
+    def test_server_keeps_jobs_to_roots(self, tmpdir):
+        spec_dir = tmpdir.mkdir('specs')
+        spec_dir.join('copy.yaml').write('{}')
+        input_root = tmpdir.mkdir('in')
+        output_root = tmpdir.mkdir('out')
+        test_csv = input_root.join('data.csv')
+        test_csv.write('a,b\n1,2\n')
+        # a link out of the root doesn't count as in it.
+        os.symlink(str(tmpdir), str(output_root.join('up')))
+        address = str(tmpdir.join('bb.sock'))
+        s = server.make_server(str(spec_dir), address,
+                               input_root=str(input_root),
+                               output_root=str(output_root))
+        thread = threading.Thread(target=s.serve_forever)
+        thread.start()
+        try:
+            output_path = str(output_root.join('data.csv'))
+            response = server.submit(address, str(test_csv), 'copy',
+                                     output_path)
+            assert response['ok']
+            assert pd.read_csv(output_path)['b'].tolist() == [2]
+            for input_path, output_path in [
+                    (str(spec_dir.join('copy.yaml')), output_path),
+                    (str(test_csv), str(tmpdir.join('data.csv'))),
+                    (str(test_csv), str(output_root.join('up', 'x.csv'))),
+                    (str(test_csv),
+                     str(output_root.join(os.pardir, 'x.csv')))]:
+                response = server.submit(address, input_path, 'copy',
+                                         output_path)
+                assert not response['ok']
+                assert 'PathNotAllowedError' in response['error']
+            assert not tmpdir.join('data.csv').exists()
+            assert not tmpdir.join('x.csv').exists()
+        finally:
+            s.shutdown()
+            thread.join()
+            s.server_close()
+
+    def test_load_pipelined(self, tmpdir):
+        yaml_config = """
+            read_in_chunks_of_rows: 2
+            list_of_actions:
+                - remove_duplicates:
+                    - date
+                    - client
+                - run_these_formula:
+                    - total = a + b
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        expected = pd.concat(t.transform_many_iter([test_csv, test_csv],
+                                                   chunksize=2))
+        output_path = str(tmpdir.join('out.csv'))
+        t.load_pipelined([test_csv, test_csv], output_path)
+        output = pd.read_csv(output_path)
+        pd.testing.assert_frame_equal(output,
+                                      expected.reset_index(drop=True))
+        # a stage failing stops the others.
+        missing = os.path.join(self.testdatadir, 'missing.csv')
+        with pytest.raises(IOError):
+            t.load_pipelined([test_csv, missing], output_path)
+
+    def test_arrow_string_engine(self):
+        yaml_config = """
+            string_engine: {}
+            list_of_actions:
+                - add_text_at_end:
+                    - target_column: url
+                      result_column: ended
+                      text: '&end=1'
+                - add_text_at_start:
+                    - target_column: date
+                      result_column: started
+                      text: 'on '
+                - replace_text:
+                    - target_column: url
+                      result_column: replaced
+                      text_to_find: google
+                      replacement_text: example
+                    - target_column: url
+                      result_column: looked_ahead
+                      text_to_find: 'o(?=o)'
+                      replacement_text: '0'
+                    - target_column: url
+                      result_column: backreferenced
+                      text_to_find: '(o)\\1'
+                      replacement_text: '0'
+                    - target_column: url
+                      result_column: prefixed
+                      text_to_find: ^
+                      replacement_text: '> '
+                - extract_text:
+                    - target_column: url
+                      result_column: x_value
+                      regex: '[?&]x=([^&#]*)'
+                    - target_column: url
+                      result_column: x_verbose
+                      regex: '[?&] x = ([^&#]*)'
+                - ensure_column_is_in_this_format:
+                    - date: text
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_urls.csv')
+        expected = self._run_transformation(yaml_config.format('python'),
+                                            test_csv)
+        output = self._run_transformation(yaml_config.format('arrow'),
+                                          test_csv)
+        for col in ['url', 'ended', 'started', 'replaced', 'looked_ahead',
+                    'backreferenced', 'x_value', 'x_verbose', 'date']:
+            assert output[col].dtype == 'string[pyarrow]'
+        assert list(output['x_value'].fillna('-')) == [
+            'foo', 'foo', 'foo', 'foo', '-', '-']
+        output = output.astype(object).where(output.notna(), np.nan)
+        pd.testing.assert_frame_equal(output, expected.astype(object))
+        with pytest.raises(ValueError):
+            Convertor(string_engine='java')
+
+    def test_arrow_string_engine_parses_text_as_arrow_strings(self, tmpdir):
+        n = 10 ** 6
+        input_data = pd.DataFrame({'name': ['customer-{}'.format(i)
+                                            for i in range(n)],
+                                   'x': np.arange(n)})
+        test_csv = tmpdir.join('names.csv')
+        input_data.to_csv(str(test_csv), index=False)
+        as_objects = input_data['name'].memory_usage(deep=True)
+        del input_data
+        t = Convertor(string_engine='arrow', read_in_chunks_of_rows=n)
+        tracemalloc.start()
+        try:
+            output = t.transform(str(test_csv))
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert output['name'].dtype == 'string[pyarrow]'
+        assert output['x'].dtype == np.int64
+        # never the whole column as Python strings.
+        assert peak < as_objects / 2
+
     def test_output_date_in_particular_format(self):
         yaml_config = """
             read_these_columns_in_these_formats:
@@ -388,6 +1061,25 @@ class TestTransformation:
         assert output['date_string'][0] == '01/13/2014'
         assert output['date_string_x'][0] == '01/13/14'
 
+    def test_output_time_in_particular_format(self):
+        yaml_config = """
+            read_these_columns_in_these_formats:
+                date:
+                    - time
+            list_of_actions:
+                - change_date_or_time_format:
+                    - target_column: time
+                      result_column: long_time
+                      date_format: dddd DD MMM YYYY hh:mm:ss.fff
+                    - target_column: time
+                      result_column: short_time
+                      date_format: hh:mm AM/PM
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_dates.csv')
+        output = self._run_transformation(yaml_config, test_csv)
+        assert output['long_time'][0] == 'Wednesday 01 Jan 2014 12:00:00.000'
+        assert output['short_time'][1] == '01:00 PM'
+
     def test_regex_extraction(self):
         yaml_config = """
             list_of_actions:
@@ -427,6 +1119,30 @@ class TestTransformation:
         assert math.isnan(output['x_value'][4])
         assert math.isnan(output['x_value'][5])
 
+    def test_query_string_extraction_of_several_keys(self):
+        yaml_config = """
+            list_of_actions:
+                - extract_query_string:
+        """
+        regex_config = """
+            list_of_actions:
+                - extract_text:
+        """
+        for key in ['x', 'y', 'a', 'z', 'not_x', 'missing']:
+            yaml_config += """
+                    - target_column: url
+                      result_column: {0}_value
+                      query_string: {0}""".format(key)
+            regex_config += """
+                    - target_column: url
+                      result_column: {0}_value
+                      regex: .*[?&]{0}=([^&#]*)""".format(key)
+        test_csv = os.path.join(self.testdatadir, 'data_urls.csv')
+        output = self._run_transformation(yaml_config, test_csv)
+        expected = self._run_transformation(regex_config, test_csv)
+        pd.testing.assert_frame_equal(output, expected)
+        assert output['z_value'][3] == 'zoo'
+
     def test_summed_group(self):
         yaml_config = """
             list_of_actions:
@@ -471,6 +1187,702 @@ class TestTransformation:
         print(output.iloc[:3])
         print(output.iloc[-3:])
 
+    def test_transform_in_chunks(self):
+        yaml_config = """
+            list_of_actions:
+                - add_text_at_end:
+                    - target_column: client
+                      result_column: result
+                      text: -bar
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        chunks = list(t.transform_iter(test_csv, chunksize=2))
+        assert len(chunks) == 3
+        output = pd.concat(chunks)
+        pd.testing.assert_frame_equal(output, t.transform(test_csv))
+
+    def test_transform_in_chunks_with_summed_group(self):
+        yaml_config = """
+            list_of_actions:
+                - sum_up_by:
+                    - date
+                    - client
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        chunks = list(t.transform_iter(test_csv, chunksize=2))
+        assert len(chunks) == 1
+        pd.testing.assert_frame_equal(chunks[0], t.transform(test_csv))
+
+    def test_transform_in_chunks_with_whole_column_clauses(self):
+        yaml_config = """
+            list_of_actions:
+                - run_these_formula:
+                    - c = b - b.mean()
+                - only_keep_rows_where:
+                    - b == b.max()
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        expected = t.transform(test_csv)
+        assert len(expected) == 2
+        assert np.allclose(expected['c'], [0.6, 0.6])
+        output = pd.concat(t.transform_iter(test_csv, chunksize=2))
+        pd.testing.assert_frame_equal(output, expected)
+
+    def test_row_wise_clauses_and_formulas(self):
+        row_wise = ['a * 2 > 3', 'a > b + 1', '`max temp` > 3',
+                    "client == 'foo' | a > 1"]
+        whole_column = ['a == a.max()', '`max temp` > `max temp`.mean()',
+                        'a > a[0]']
+        for clause in row_wise + whole_column:
+            t = Convertor(list_of_actions=[
+                {'only_keep_rows_where': [clause]},
+                {'run_these_formula': ['c = ' + clause]}])
+            # filters and formulas are told apart the same way.
+            expected = clause in row_wise
+            assert [action.row_local for action in t.action_list.actions] == [
+                expected, expected]
+
+    def test_transform_in_chunks_skip_rows_at_end(self):
+        yaml_config = """
+            number_of_rows_to_skip_at_file_end: 3
+        """
+        test_csv = os.path.join(self.testdatadir, '3_extra_rows_at_end.csv')
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        output = pd.concat(t.transform_iter(test_csv, chunksize=1))
+        assert list(output['name']) == ['dave', 'steve']
+
+    def test_transform_many_files(self, tmpdir):
+        yaml_config = """
+            list_of_actions:
+                - copy_column:
+                    - result = b
+        """
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        test_csvs = [os.path.join(self.testdatadir, 'data_group.csv'),
+                     os.path.join(self.testdatadir, 'data_filter.csv')]
+        output = t.transform_many(test_csvs, workers=2)
+        expected = pd.concat([t.transform(path) for path in test_csvs],
+                             ignore_index=True)
+        pd.testing.assert_frame_equal(output, expected)
+        output_directory = str(tmpdir.join('not', 'made', 'yet'))
+        written = t.transform_many(test_csvs, workers=2,
+                                   output_directory=output_directory)
+        assert len(written) == 2
+        assert os.path.dirname(written[0]) == output_directory
+        output = pd.read_csv(written[0])
+        assert list(output['result']) == list(expected['result'][:5])
+
+    def test_transform_many_refuses_to_overwrite_input(self, tmpdir):
+        t = Convertor()
+        test_csv = tmpdir.join('data.csv')
+        test_csv.write('a,b\n1,2\n')
+        with pytest.raises(ValueError):
+            t.transform_many([str(test_csv)], output_directory=str(tmpdir))
+        assert test_csv.read() == 'a,b\n1,2\n'
+        # the same directory, by another path.
+        other_path = str(tmpdir.join('sub', os.pardir))
+        tmpdir.mkdir('sub')
+        with pytest.raises(ValueError):
+            t.transform_many([str(test_csv)], output_directory=other_path)
+        t = Convertor(output_format='parquet')
+        written = t.transform_many([str(test_csv)],
+                                   output_directory=str(tmpdir))
+        assert written == [str(tmpdir.join('data.parquet'))]
+
+    def test_unknown_action(self):
+        with pytest.raises(UnknownActionError):
+            Convertor(list_of_actions=[{'make_coffee': []}])
+        # a missing key isn't mistaken for an unknown action.
+        with pytest.raises(KeyError) as error:
+            Convertor(list_of_actions=[{'change_date_or_time_format': [
+                {'target_column': 'date', 'result_column': 'date'}]}])
+        assert 'date_format' in str(error.value)
+
+    def test_load_csv_a_chunk_at_a_time(self, tmpdir):
+        yaml_config = """
+            read_in_chunks_of_rows: 2
+            list_of_actions:
+                - copy_column:
+                    - result = b
+        """
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        output_path = str(tmpdir.join('output.csv'))
+        t.load(test_csv, output_path)
+        output = pd.read_csv(output_path)
+        pd.testing.assert_frame_equal(output, t.transform(test_csv))
+        output_buffer = StringIO()
+        t.load(test_csv, output_buffer)
+        with open(output_path) as f:
+            assert output_buffer.getvalue() == f.read()
+
+    def test_load_columnar_formats(self, tmpdir):
+        pytest.importorskip('pyarrow')
+        yaml_config = """
+            read_in_chunks_of_rows: 2
+            output_format: {}
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        for output_format in ['parquet', 'feather']:
+            config = StringIO(yaml_config.format(output_format))
+            t = Convertor.from_yaml(config)
+            output_path = str(tmpdir.join('output.' + output_format))
+            t.load(test_csv, output_path)
+            if output_format == 'parquet':
+                output = pd.read_parquet(output_path)
+            else:
+                output = pd.read_feather(output_path)
+            pd.testing.assert_frame_equal(output, t.transform(test_csv))
+
+    def test_load_columnar_formats_widening_types(self, tmpdir):
+        pytest.importorskip('pyarrow')
+        yaml_config = """
+            read_in_chunks_of_rows: 2
+            output_format: {}
+        """
+        test_csv = str(tmpdir.join('widening.csv'))
+        with open(test_csv, 'w') as f:
+            # a fraction in the first chunk, ints in the second.
+            f.write('name,x\na,5.5\nb,6\nc,7\nd,8\ne,9\n')
+        narrowing_csv = str(tmpdir.join('narrowing.csv'))
+        with open(narrowing_csv, 'w') as f:
+            # ints in the first chunk, a fraction in the second.
+            f.write('name,x\na,5\nb,6\nc,7.5\nd,8\ne,9\n')
+        for output_format in ['parquet', 'feather']:
+            config = StringIO(yaml_config.format(output_format))
+            t = Convertor.from_yaml(config)
+            output_path = str(tmpdir.join('output.' + output_format))
+            t.load(test_csv, output_path)
+            if output_format == 'parquet':
+                output = pd.read_parquet(output_path)
+            else:
+                output = pd.read_feather(output_path)
+            pd.testing.assert_frame_equal(output, t.transform(test_csv))
+            # the first chunk's types are kept, not rewritten wider.
+            with pytest.raises(ValueError) as error:
+                t.load(narrowing_csv, output_path)
+            assert 'column x' in str(error.value)
+
+    def test_load_columnar_formats_with_empty_first_chunks(self, tmpdir):
+        pytest.importorskip('pyarrow')
+        yaml_config = """
+            read_in_chunks_of_rows: 5
+            output_format: {}
+        """
+        test_csv = str(tmpdir.join('sparse.csv'))
+        with open(test_csv, 'w') as f:
+            # no note until the third chunk.
+            f.write('x,note\n')
+            for x in range(15):
+                f.write('{},{}\n'.format(x, 'seen' if x >= 10 else ''))
+        for output_format in ['parquet', 'feather']:
+            config = StringIO(yaml_config.format(output_format))
+            t = Convertor.from_yaml(config)
+            output_path = str(tmpdir.join('output.' + output_format))
+            t.load(test_csv, output_path)
+            if output_format == 'parquet':
+                output = pd.read_parquet(output_path)
+            else:
+                output = pd.read_feather(output_path)
+            assert list(output['note'].fillna('-')) == ['-'] * 10 + [
+                'seen'] * 5
+            pd.testing.assert_frame_equal(output, t.transform(test_csv))
+
+    def test_save_matches_transform(self, tmpdir):
+        t = Convertor(read_in_chunks_of_rows=2)
+        test_csv = str(tmpdir.join('widening.csv'))
+        with open(test_csv, 'w') as f:
+            f.write('name,x\na,5\nb,6\nc,7.5\nd,8\n')
+        output_path = str(tmpdir.join('output.csv'))
+        t.save(test_csv, output_path)
+        with open(output_path) as f:
+            assert f.read() == t.transform(test_csv).to_csv(index=False)
+
+    def test_load_partitioned_by_column(self, tmpdir):
+        yaml_config = """
+            read_in_chunks_of_rows: 2
+            partition_output_by: client
+        """
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        t.load(test_csv, str(tmpdir))
+        expected = t.transform(test_csv)
+        for client, rows in expected.groupby('client'):
+            output_path = tmpdir.join('client=' + client, 'part-0.csv')
+            output = pd.read_csv(str(output_path))
+            expected_rows = rows.drop('client', axis='columns')
+            assert output.values.tolist() == expected_rows.values.tolist()
+
+    def test_load_partitioned_by_column_escapes_values(self, tmpdir):
+        t = Convertor(partition_output_by='client')
+        test_csv = tmpdir.join('input.csv')
+        test_csv.write('client,a\n../../up,1\na/b,2\n50%,3\n')
+        destination = tmpdir.mkdir('out')
+        t.load(str(test_csv), str(destination))
+        assert sorted(os.listdir(str(destination))) == [
+            'client=..%2F..%2Fup', 'client=50%25', 'client=a%2Fb']
+        assert not tmpdir.join('up').exists()
+
+    def test_partitioned_writer_limits_open_files(self, tmpdir):
+        expected = pd.DataFrame({'client': ['a', 'b', 'c', 'a', 'b', 'a'],
+                                 'x': [1, 2, 3, 4, 5, 6]})
+        with PartitionedWriter(CsvWriter, str(tmpdir), 'client',
+                               max_open_writers=2) as writer:
+            for start in range(0, len(expected), 2):
+                writer.write(expected.iloc[start:start + 2])
+                assert len(writer.writers) <= 2
+        # a closed partition goes on in a new file.
+        assert sorted(os.listdir(str(tmpdir.join('client=a')))) == [
+            'part-0.csv', 'part-1.csv']
+        for client, rows in expected.groupby('client'):
+            directory = tmpdir.join('client=' + client)
+            parts = sorted(os.listdir(str(directory)))
+            output = pd.concat([pd.read_csv(str(directory.join(part)))
+                                for part in parts])
+            assert list(output['x']) == list(rows['x'])
+
+    def test_unknown_output_format(self):
+        with pytest.raises(UnknownOutputFormatError):
+            Convertor(output_format='xls')
+
+    def test_read_columnar_formats(self, tmpdir):
+        pytest.importorskip('pyarrow')
+        yaml_config = """
+            data_format: {}
+            read_in_chunks_of_rows: 2
+            list_of_actions:
+                - only_keep_rows_where:
+                    - b < 2
+                - add_text_at_end:
+                    - target_column: client
+                      result_column: result
+                      text: -bar
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        expected = self._run_transformation(yaml_config.format('csv'),
+                                            test_csv)
+        expected = expected.reset_index(drop=True)
+        input_data = pd.read_csv(test_csv)
+        input_path = str(tmpdir.join('input'))
+        for data_format in ['parquet', 'feather', 'jsonl']:
+            if data_format == 'parquet':
+                input_data.to_parquet(input_path, row_group_size=2)
+            elif data_format == 'feather':
+                input_data.to_feather(input_path)
+            else:
+                input_data.to_json(input_path, orient='records', lines=True)
+            config = StringIO(yaml_config.format(data_format))
+            t = Convertor.from_yaml(config)
+            output = t.transform(input_path).reset_index(drop=True)
+            pd.testing.assert_frame_equal(output, expected)
+            output = pd.concat(t.transform_iter(input_path, chunksize=2))
+            pd.testing.assert_frame_equal(output.reset_index(drop=True),
+                                          expected)
+
+    def test_read_parquet_skips_row_groups(self, tmpdir):
+        pytest.importorskip('pyarrow')
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        input_path = str(tmpdir.join('input.parquet'))
+        pd.read_csv(test_csv).to_parquet(input_path, row_group_size=2)
+        chunks = read_parquet(input_path, columns=set(['a', 'b']),
+                              conditions=[('a', '>', 1)])
+        output = pd.concat(chunks)
+        # only the first row group has an a over 1.
+        assert list(output.columns) == ['a', 'b']
+        assert list(output['a']) == [2, 1]
+        yaml_config = """
+            data_format: parquet
+            filter_rows_while_reading: true
+            list_of_actions:
+                - only_keep_rows_where:
+                    - a > 1
+        """
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        assert list(t.transform(input_path)['a']) == [2]
+
+    def test_read_parquet_with_operators_in_text(self, tmpdir):
+        pytest.importorskip('pyarrow')
+        input_path = str(tmpdir.join('input.parquet'))
+        data = pd.DataFrame({'name': ['A', 'A&B', 'A|B', 'A and B'],
+                             'a': [1, 2, 3, 4]})
+        data.to_parquet(input_path, row_group_size=1)
+        yaml_config = """
+            data_format: parquet
+            filter_rows_while_reading: true
+            list_of_actions:
+                - only_keep_rows_where:
+                    - name == 'A&B' | name == "A|B"
+                    - a > 1 & name != 'A&B'
+        """
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        assert list(t.transform(input_path)['name']) == ['A|B']
+        yaml_config = """
+            data_format: parquet
+            filter_rows_while_reading: true
+            list_of_actions:
+                - only_keep_rows_where:
+                    - name == 'A&B' & a > 1
+        """
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        assert list(t.transform(input_path)['a']) == [2]
+
+    def test_unknown_data_format(self):
+        with pytest.raises(UnknownDataFormatError):
+            Convertor(data_format='xls')
+
+    def test_cache_results(self, tmpdir):
+        yaml_config = """
+            cache_results_in_directory: {}
+            list_of_actions:
+                - copy_column:
+                    - result = b
+        """
+        config = StringIO(yaml_config.format(tmpdir.join('cache')))
+        t = Convertor.from_yaml(config)
+        test_csv = tmpdir.join('input.csv')
+        with open(os.path.join(self.testdatadir, 'data_group.csv')) as f:
+            test_csv.write(f.read())
+        expected = t.transform(str(test_csv))
+        assert (t.result_cache.hits, t.result_cache.misses) == (0, 1)
+        output = t.transform(str(test_csv))
+        assert (t.result_cache.hits, t.result_cache.misses) == (1, 1)
+        pd.testing.assert_frame_equal(output, expected)
+        # touched but the same content still hits.
+        test_csv.setmtime(test_csv.mtime() + 10)
+        t.transform(str(test_csv))
+        assert (t.result_cache.hits, t.result_cache.misses) == (2, 1)
+        test_csv.write(test_csv.read().replace('bar', 'baz'))
+        output = t.transform(str(test_csv))
+        assert (t.result_cache.hits, t.result_cache.misses) == (2, 2)
+        assert output['client'].iloc[-1] == 'baz'
+
+    @pytest.mark.skipif(not hasattr(os, 'getuid'),
+                        reason='no Unix file permissions')
+    def test_pickles_only_read_from_private_places(self, tmpdir):
+        cache_dir = tmpdir.join('cache')
+        Convertor(cache_results_in_directory=str(cache_dir))
+        assert cache_dir.stat().mode & 0o077 == 0
+        shared_dir = tmpdir.mkdir('shared')
+        shared_dir.chmod(0o777)
+        with pytest.raises(ValueError):
+            Convertor(cache_results_in_directory=str(shared_dir))
+        t = Convertor()
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        checkpoint = tmpdir.join('input.checkpoint')
+        t.transform_new_rows(test_csv, str(checkpoint))
+        assert checkpoint.stat().mode & 0o077 == 0
+        checkpoint.chmod(0o666)
+        with pytest.raises(ValueError):
+            t.transform_new_rows(test_csv, str(checkpoint))
+
+    def test_cache_hit_matches_cold_run(self, tmpdir):
+        yaml_config = """
+            cache_results_in_directory: {}
+            list_of_actions:
+                - extract_query_string:
+                    - target_column: url
+                      result_column: x_value
+                      query_string: x
+                - only_keep_rows_where:
+                    - clicks > 0
+        """.format(str(tmpdir))
+        test_csv = os.path.join(self.testdatadir, 'data_urls.csv')
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        cold = t.transform(test_csv)
+        hit = t.transform(test_csv)
+        assert t.result_cache.hits == 1
+        pd.testing.assert_frame_equal(hit, cold)
+        assert isinstance(hit['x_value'].iloc[-1], float)
+
+    def test_cache_evicts_least_recently_used(self, tmpdir):
+        yaml_config = """
+            cache_results_in_directory: {}
+            cache_size_limit_in_megabytes: 0
+        """
+        config = StringIO(yaml_config.format(tmpdir.join('cache')))
+        t = Convertor.from_yaml(config)
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        t.transform(test_csv)
+        t.transform(test_csv)
+        assert (t.result_cache.hits, t.result_cache.misses) == (0, 2)
+
+    def test_cache_written_from_threads(self, tmpdir):
+        t = Convertor(cache_results_in_directory=str(tmpdir))
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        expected = t.transform(test_csv)
+        key = t.result_cache.key_for(t.spec, test_csv)
+        errors = []
+
+        def put():
+            try:
+                for _ in range(20):
+                    t.result_cache.put(key, expected)
+            except Exception as error:
+                errors.append(error)
+        threads = [threading.Thread(target=put) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        pd.testing.assert_frame_equal(t.result_cache.get(key), expected)
+        assert not [name for name in os.listdir(str(tmpdir))
+                    if name.endswith('.tmp')]
+
+    def test_cache_forgets_hashes_of_deleted_files(self, tmpdir):
+        t = Convertor(cache_results_in_directory=str(tmpdir.join('cache')))
+        for name in ['first.csv', 'second.csv']:
+            test_csv = tmpdir.join(name)
+            test_csv.write('a\n1\n')
+            t.transform(str(test_csv))
+            test_csv.remove()
+        test_csv = tmpdir.join('third.csv')
+        test_csv.write('a\n1\n')
+        t.transform(str(test_csv))
+        with open(str(tmpdir.join('cache', 'content_hashes.json'))) as f:
+            index = json.load(f)
+        assert list(index) == [os.path.realpath(str(test_csv))]
+
+    def test_cache_key_changes_with_the_code(self, tmpdir):
+        package_dir = os.path.dirname(os.path.dirname(__file__))
+        copy_dir = tmpdir.join('copy')
+        tmpdir.join('cache').mkdir().chmod(0o700)
+        test_csv = tmpdir.join('input.csv')
+        test_csv.write('a\n1\n')
+        code = ('from bumblebee.cache import ResultCache; '
+                'print(ResultCache({!r}).key_for({{}}, {!r}))'.format(
+                    str(tmpdir.join('cache')), str(test_csv)))
+        keys = []
+        for change in ['', '# changed\n']:
+            shutil.rmtree(str(copy_dir), ignore_errors=True)
+            shutil.copytree(os.path.join(package_dir, 'bumblebee'),
+                            str(copy_dir.join('bumblebee')))
+            copy_dir.join('bumblebee', 'actions.py').write(change, mode='a')
+            keys.append(subprocess.check_output([sys.executable, '-c', code],
+                                                cwd=str(copy_dir)))
+        assert keys[0] != keys[1]
+
+    def test_transform_new_rows(self, tmpdir):
+        yaml_configs = ["""
+            list_of_actions:
+                - copy_column:
+                    - result = b
+                - remove_duplicates:
+                    - client
+                    - a
+        """, """
+            list_of_actions:
+                - sum_up_by:
+                    - date
+                    - client
+                - run_these_formula:
+                    - total = a + b
+        """]
+        with open(os.path.join(self.testdatadir, 'data_group.csv')) as f:
+            lines = f.readlines()
+        for summed, yaml_config in enumerate(yaml_configs):
+            t = Convertor.from_yaml(StringIO(yaml_config))
+            test_csv = tmpdir.join('input.csv')
+            checkpoint = str(tmpdir.join('input.checkpoint'))
+            output_csv = str(tmpdir.join('output.csv'))
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+            # the last row is half written to start with.
+            test_csv.write(''.join(lines[:3]) + lines[3].rstrip('\n'))
+            output = t.transform_new_rows(str(test_csv), checkpoint,
+                                          output_csv)
+            complete_csv = tmpdir.join('complete.csv')
+            complete_csv.write(''.join(lines[:3]))
+            first = t.transform(str(complete_csv))
+            pd.testing.assert_frame_equal(output, first)
+            test_csv.write('\n' + ''.join(lines[4:]), mode='a')
+            output = t.transform_new_rows(str(test_csv), checkpoint,
+                                          output_csv)
+            expected = t.transform(str(test_csv))
+            if summed:
+                # sum_up_by gives all the output each time.
+                pd.testing.assert_frame_equal(output, expected)
+            else:
+                pd.testing.assert_frame_equal(output,
+                                              expected.iloc[len(first):])
+            pd.testing.assert_frame_equal(pd.read_csv(output_csv),
+                                          expected.reset_index(drop=True))
+            assert 'output' not in pd.read_pickle(checkpoint)
+            # nothing new.
+            output = t.transform_new_rows(str(test_csv), checkpoint,
+                                          output_csv)
+            assert len(output) == (len(expected) if summed else 0)
+            pd.testing.assert_frame_equal(pd.read_csv(output_csv),
+                                          expected.reset_index(drop=True))
+            # a replaced file starts over.
+            test_csv.write(''.join(lines[:2]))
+            output = t.transform_new_rows(str(test_csv), checkpoint,
+                                          output_csv)
+            expected = t.transform(str(test_csv))
+            pd.testing.assert_frame_equal(output, expected)
+            pd.testing.assert_frame_equal(pd.read_csv(output_csv),
+                                          expected.reset_index(drop=True))
+
+    def test_transform_new_rows_needing_every_row(self, tmpdir):
+        number = {'ensure_column_is_in_this_format': [{'a': 'number'}]}
+        checkpoint = str(tmpdir.join('input.checkpoint'))
+        missing = str(tmpdir.join('missing.csv'))
+        for actions in [[number],
+                        [{'only_edit_rows_where': [
+                            {'rows_match': 'b > 1',
+                             'list_of_actions': [number]}]}]]:
+            t = Convertor(list_of_actions=actions)
+            # before the file is opened.
+            with pytest.raises(ValueError):
+                t.transform_new_rows(missing, checkpoint)
+        # run on all the output, after sum_up_by.
+        t = Convertor(list_of_actions=[{'sum_up_by': ['client']}, number])
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        pd.testing.assert_frame_equal(
+            t.transform_new_rows(test_csv, checkpoint), t.transform(test_csv))
+
+    def test_transform_new_rows_removing_duplicates_of_other_types(
+            self, tmpdir):
+        t = Convertor(list_of_actions=[{'remove_duplicates': ['key']}])
+        test_csv = tmpdir.join('input.csv')
+        checkpoint = str(tmpdir.join('input.checkpoint'))
+        # parsed as text the first time, then as numbers.
+        test_csv.write('key,value\na,1\nb,2\na,3\n')
+        output = t.transform_new_rows(str(test_csv), checkpoint)
+        assert list(output['value']) == [1, 2]
+        test_csv.write('1,4\n2,5\n1,6\n', mode='a')
+        output = t.transform_new_rows(str(test_csv), checkpoint)
+        assert list(output['value']) == [4, 5]
+        assert t.action_list.actions[0].duplicates_dropped == 1
+        test_csv.write('b,7\nc,8\n', mode='a')
+        output = t.transform_new_rows(str(test_csv), checkpoint)
+        assert list(output['value']) == [8]
+
+    def test_transform_new_rows_with_whole_column_clauses(self, tmpdir):
+        yaml_config = """
+            list_of_actions:
+                - only_keep_rows_where:
+                    - b == b.max()
+                - run_these_formula:
+                    - c = a - a.mean()
+        """
+        with open(os.path.join(self.testdatadir, 'data_group.csv')) as f:
+            lines = f.readlines()
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        test_csv = tmpdir.join('input.csv')
+        checkpoint = str(tmpdir.join('input.checkpoint'))
+        output_csv = str(tmpdir.join('output.csv'))
+        test_csv.write(''.join(lines[:2]))
+        output = t.transform_new_rows(str(test_csv), checkpoint, output_csv)
+        pd.testing.assert_frame_equal(output, t.transform(str(test_csv)))
+        # every row is run again, as the new rows change the old ones' c.
+        test_csv.write(''.join(lines[2:]), mode='a')
+        output = t.transform_new_rows(str(test_csv), checkpoint, output_csv)
+        expected = t.transform(str(test_csv))
+        assert np.allclose(expected['c'], [0.5, -0.5])
+        pd.testing.assert_frame_equal(output, expected)
+        pd.testing.assert_frame_equal(pd.read_csv(output_csv),
+                                      expected.reset_index(drop=True))
+
+    def test_aggregate_by(self):
+        yaml_config = """
+            list_of_actions:
+                - aggregate_by:
+                    columns_to_group_by:
+                        - client
+                    calculate:
+                        - total = sum(a)
+                        - rows = count(a)
+                        - lowest = min(b)
+                        - highest = max(b)
+                        - average = mean(a)
+                        - first_date = first(date)
+                        - last_date = last(date)
+                        - dates = approximate_distinct(date)
+                        - median = approximate_quantile(b, 0.5)
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        output = self._run_transformation(yaml_config, test_csv)
+        assert list(output['client']) == ['bar', 'foo']
+        assert list(output['total']) == [1, 5]
+        assert list(output['rows']) == [1, 4]
+        assert list(output['lowest']) == [1, 1]
+        assert list(output['highest']) == [1, 2]
+        assert list(output['average']) == [1, 1.25]
+        assert list(output['first_date']) == ['2014-01-02', '2014-01-01']
+        assert list(output['last_date']) == ['2014-01-02', '2014-01-02']
+        assert list(output['dates']) == [1, 2]
+        assert np.allclose(output['median'], [1, 1], rtol=0.01)
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        chunks = list(t.transform_iter(test_csv, chunksize=2))
+        assert len(chunks) == 1
+        pd.testing.assert_frame_equal(chunks[0], output)
+
+    def test_sum_up_by_in_chunks(self):
+        yaml_config = """
+            list_of_actions:
+                - sum_up_by:
+                    - date
+                    - client
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        expected = self._run_transformation(yaml_config, test_csv)
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        chunks = list(t.transform_iter(test_csv, chunksize=2))
+        assert len(chunks) == 1
+        pd.testing.assert_frame_equal(chunks[0], expected)
+
+    def test_transform_parallel(self):
+        yaml_config = """
+            column_headers_are_on_row_number: 20
+            number_of_rows_to_skip_at_file_end: 2
+            list_of_actions:
+                - rename_column:
+                    - name = name[80]
+                - only_keep_rows_where:
+                    - apparent_t < 10
+                - only_keep_these_columns:
+                    - name
+                    - air_temp
+                    - apparent_t
+        """
+        test_csv = os.path.join(self.testdatadir, 'melb_weather.csv')
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        output = t.transform_parallel(test_csv, workers=3)
+        pd.testing.assert_frame_equal(output, t.transform(test_csv))
+
+    def test_transform_parallel_with_summed_group(self):
+        yaml_config = """
+            list_of_actions:
+                - sum_up_by:
+                    - date
+                    - client
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        output = t.transform_parallel(test_csv, workers=2)
+        pd.testing.assert_frame_equal(output, t.transform(test_csv))
+
+    def test_transform_parallel_with_whole_column_clause(self):
+        yaml_config = """
+            list_of_actions:
+                - add_text_at_end:
+                    - target_column: client
+                      result_column: result
+                      text: -bar
+                - only_keep_rows_where:
+                    - b == b.max()
+        """
+        test_csv = os.path.join(self.testdatadir, 'data_group.csv')
+        t = Convertor.from_yaml(StringIO(yaml_config))
+        expected = t.transform(test_csv)
+        assert len(expected) == 2
+        output = t.transform_parallel(test_csv, workers=2)
+        pd.testing.assert_frame_equal(output, expected)
+
     def _run_transformation(self, yaml_text, test_csvpath):
         config = StringIO(yaml_text)
         t = Convertor.from_yaml(config)